@@ -2,13 +2,14 @@ from uuid import UUID
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, exists, update, delete
 
 from app.core.database import get_db
 from app.core.security import hash_password
 from app.models.models import User
 from app.schemas.auth import UserCreate, UserUpdate, UserResponse, UserListResponse
-from app.api.deps import require_admin
+from app.api.deps import require_admin, invalidate_user_cache
+from app.api.utils import get_query_count
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
@@ -20,18 +21,16 @@ async def list_users(
     db: AsyncSession = Depends(get_db),
     _: User = Depends(require_admin),
 ):
-    # Count total
-    count_result = await db.execute(select(func.count(User.id)))
-    total = count_result.scalar()
+    # Only the columns in UserResponse (no password_hash, no ORM instances)
+    query = select(
+        User.id, User.name, User.email, User.role,
+        User.is_active, User.telegram_chat_id, User.created_at,
+    ).order_by(User.created_at.desc())
+    total = await get_query_count(query, db)
 
     # Get users
-    result = await db.execute(
-        select(User)
-        .order_by(User.created_at.desc())
-        .offset(skip)
-        .limit(limit)
-    )
-    users = result.scalars().all()
+    result = await db.execute(query.offset(skip).limit(limit))
+    users = [UserResponse.model_construct(**row._mapping) for row in result]
 
     return UserListResponse(users=users, total=total)
 
@@ -43,8 +42,8 @@ async def create_user(
     _: User = Depends(require_admin),
 ):
     # Check if email already exists
-    existing = await db.execute(select(User).where(User.email == request.email))
-    if existing.scalar_one_or_none():
+    email_taken = await db.scalar(select(exists().where(User.email == request.email)))
+    if email_taken:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email ja cadastrado",
@@ -58,7 +57,6 @@ async def create_user(
     )
     db.add(user)
     await db.commit()
-    await db.refresh(user)
 
     return user
 
@@ -101,10 +99,10 @@ async def update_user(
         user.name = request.name
     if request.email is not None:
         # Check if email is taken by another user
-        existing = await db.execute(
-            select(User).where(User.email == request.email, User.id != user_id)
+        email_taken = await db.scalar(
+            select(exists().where(User.email == request.email, User.id != user_id))
         )
-        if existing.scalar_one_or_none():
+        if email_taken:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Email ja em uso",
@@ -118,7 +116,7 @@ async def update_user(
         user.is_active = request.is_active
 
     await db.commit()
-    await db.refresh(user)
+    invalidate_user_cache(user_id)
 
     return user
 
@@ -135,17 +133,21 @@ async def deactivate_user(
             detail="Nao e possivel desativar sua propria conta",
         )
 
-    result = await db.execute(select(User).where(User.id == user_id))
-    user = result.scalar_one_or_none()
-
-    if not user:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Usuario nao encontrado",
+    # Active users are deactivated; already inactive users are deleted
+    result = await db.execute(
+        update(User)
+        .where(User.id == user_id, User.is_active.is_(True))
+        .values(is_active=False)
+        .returning(User.id)
+    )
+    if result.scalar_one_or_none() is None:
+        result = await db.execute(
+            delete(User).where(User.id == user_id).returning(User.id)
         )
-
-    if user.is_active:
-        user.is_active = False
-    else:
-        await db.delete(user)
+        if result.scalar_one_or_none() is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Usuario nao encontrado",
+            )
     await db.commit()
+    invalidate_user_cache(user_id)
@@ -1,48 +1,95 @@
 import asyncio
-import json
 from uuid import UUID
 from typing import Optional
 
+import orjson
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, func, update, delete, or_
+from sqlalchemy.orm import selectinload, joinedload, raiseload
 
 from app.core.config import get_settings
-from app.core.database import get_db
-from app.models.models import User, Conversation, Message, Processo
+from app.core.database import get_db, AsyncSessionLocal
+from app.core.openai_client import openai_client
+from app.models.models import User, Conversation, Message
 from app.schemas.chat import (
     ConversationCreate, ConversationUpdate, ConversationResponse, ConversationListResponse,
     MessageCreate, MessageResponse, ChatResponse, MessageHistoryResponse, SourceInfo
 )
-from app.api.deps import get_current_user, get_processo_with_access
-from app.services.rag_engine import chat as rag_chat, chat_stream as rag_chat_stream
+from app.api.deps import get_current_user, check_processo_access
+from app.api.utils import get_query_count
+from app.services import semantic_cache
+from app.services.telegram_bot import (
+    forget_history as forget_telegram_history, forget_conversations as forget_telegram_conversations,
+)
+from app.services.rag_engine import (
+    chat as rag_chat, chat_stream as rag_chat_stream, replay_stream as rag_replay_stream, embed_query,
+    HISTORY_MESSAGES,
+)
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
 settings = get_settings()
 
 
-async def _generate_title(conversation_id: UUID, content: str):
-    """Generate conversation title in background (separate DB session)."""
-    from app.core.database import AsyncSessionLocal
-    from openai import AsyncOpenAI
+# Title generation and streamed-answer persistence run in fire-and-forget
+# tasks: bound their concurrency and keep references so they are not
+# garbage-collected mid-flight.
+_DEFAULT_TITLE = "Nova conversa"
+_title_semaphore = asyncio.Semaphore(8)
+_persist_semaphore = asyncio.Semaphore(16)
+_background_tasks: set[asyncio.Task] = set()
 
-    _openai = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
 
-    async with AsyncSessionLocal() as db:
-        try:
-            result = await db.execute(
-                select(Conversation).where(Conversation.id == conversation_id)
-            )
-            conversation = result.scalar_one_or_none()
-            if not conversation:
-                return
+def _spawn(coro) -> None:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _needs_title(conversation: Conversation) -> bool:
+    return not conversation.titulo or conversation.titulo == _DEFAULT_TITLE
 
-            if conversation.titulo and conversation.titulo != "Nova conversa":
-                return
 
-            title_resp = await _openai.chat.completions.create(
+def _schedule_title(conversation: Conversation, content: str) -> None:
+    if _needs_title(conversation):
+        _spawn(_generate_title(conversation.id, content))
+
+
+async def _persist_assistant_message(
+    conversation_id: UUID,
+    rag_result_data: dict,
+    cache_entry: Optional[tuple[str, list[float], UUID]] = None,
+):
+    """Save a streamed answer after the response is done (separate DB session).
+
+    ``cache_entry`` is (query, query_embedding, processo_id) for answers to
+    store in the semantic cache, committed together with the message.
+    """
+    async with _persist_semaphore, AsyncSessionLocal() as db:
+        if cache_entry is not None:
+            query, query_embedding, processo_id = cache_entry
+            await semantic_cache.store(query, query_embedding, processo_id, rag_result_data, db)
+        db.add(Message(
+            conversation_id=conversation_id,
+            role="assistant",
+            content=rag_result_data["answer"],
+            chunks_usados=rag_result_data["chunks_used"],
+            tokens_input=rag_result_data["tokens_input"],
+            tokens_output=rag_result_data["tokens_output"],
+            custo_estimado=rag_result_data["cost_usd"],
+            metadata_={"sources": rag_result_data["sources"]},
+        ))
+        await db.commit()
+    forget_telegram_history(conversation_id)
+
+
+async def _generate_title(conversation_id: UUID, content: str):
+    """Generate conversation title in background (separate DB session)."""
+    async with _title_semaphore:
+        try:
+            title_resp = await openai_client.chat.completions.create(
                 model=settings.PROCESSING_MODEL,
                 messages=[
                     {"role": "system", "content": "Gere um titulo curto (maximo 6 palavras) em portugues para uma conversa que comeca com a seguinte pergunta. Responda APENAS com o titulo, sem aspas ou pontuacao final."},
@@ -57,14 +104,46 @@ async def _generate_title(conversation_id: UUID, content: str):
                     p.get("text", "") if isinstance(p, dict) else str(p)
                     for p in raw_title
                 )
-            conversation.titulo = (raw_title or content[:60]).strip()
+            titulo = (raw_title or content[:60]).strip()
+        except Exception:
+            titulo = content[:60]
+
+    # Only hold a DB connection for the write; skip if a title was set meanwhile
+    async with AsyncSessionLocal() as db:
+        try:
+            await db.execute(
+                update(Conversation)
+                .where(
+                    Conversation.id == conversation_id,
+                    or_(Conversation.titulo.is_(None), Conversation.titulo == _DEFAULT_TITLE),
+                )
+                .values(titulo=titulo)
+            )
             await db.commit()
         except Exception:
-            conversation.titulo = content[:60]
-            try:
-                await db.commit()
-            except Exception:
-                pass
+            pass
+
+
+def _format_sse(event: str, data: dict) -> bytes:
+    """Format a Server-Sent Event (UTF-8 bytes, sent by StreamingResponse as is)."""
+    return b"event: %s\ndata: %s\n\n" % (event.encode(), orjson.dumps(data))
+
+
+async def _load_history(conversation_id: UUID) -> list[dict]:
+    """Load role/content of the messages sent to the LLM (the last
+    HISTORY_MESSAGES, oldest first) in a separate session, so it can overlap
+    with other queries of the request session."""
+    async with AsyncSessionLocal() as db:
+        history_result = await db.execute(
+            select(Message.role, Message.content)
+            .where(Message.conversation_id == conversation_id)
+            .order_by(Message.created_at.desc())
+            .limit(HISTORY_MESSAGES)
+        )
+        return [
+            {"role": role, "content": content}
+            for role, content in reversed(history_result.all())
+        ]
 
 
 @router.get("/conversations", response_model=ConversationListResponse)
@@ -79,36 +158,37 @@ async def list_conversations(
 
     if processo_id:
         # Verify access to processo
-        await get_processo_with_access(processo_id, db, current_user)
+        await check_processo_access(processo_id, db, current_user)
         query = query.where(Conversation.processo_id == processo_id)
 
-    # Count
-    count_query = select(func.count()).select_from(query.subquery())
-    count_result = await db.execute(count_query)
-    total = count_result.scalar() or 0
-
-    # Get conversations with message count
-    result = await db.execute(
-        query.order_by(Conversation.updated_at.desc()).offset(skip).limit(limit)
+    # Project only the ConversationResponse columns; message_count is a
+    # denormalized column and the window count carries the total
+    page_query = (
+        query.with_only_columns(
+            Conversation.id,
+            Conversation.processo_id,
+            Conversation.user_id,
+            Conversation.canal,
+            Conversation.titulo,
+            Conversation.created_at,
+            Conversation.updated_at,
+            Conversation.message_count,
+            func.count().over().label("total"),
+        )
+        .order_by(Conversation.updated_at.desc())
+        .offset(skip)
+        .limit(limit)
     )
-    conversations = result.scalars().all()
+    rows = (await db.execute(page_query)).all()
 
-    # Build responses with message counts
     responses = []
-    for conv in conversations:
-        msg_count = await db.execute(
-            select(func.count(Message.id)).where(Message.conversation_id == conv.id)
-        )
-        responses.append(ConversationResponse(
-            id=conv.id,
-            processo_id=conv.processo_id,
-            user_id=conv.user_id,
-            canal=conv.canal,
-            titulo=conv.titulo,
-            created_at=conv.created_at,
-            updated_at=conv.updated_at,
-            message_count=msg_count.scalar() or 0,
-        ))
+    for row in rows:
+        fields = dict(row._mapping)
+        fields.pop("total")
+        responses.append(ConversationResponse.model_construct(**fields))
+
+    # Empty page (e.g. skip past the end): no row to read the total from
+    total = rows[0].total if rows else await get_query_count(query, db)
 
     return ConversationListResponse(conversations=responses, total=total)
 
@@ -120,7 +200,7 @@ async def create_conversation(
     current_user: User = Depends(get_current_user),
 ):
     # Verify access to processo
-    await get_processo_with_access(request.processo_id, db, current_user)
+    await check_processo_access(request.processo_id, db, current_user)
 
     conversation = Conversation(
         processo_id=request.processo_id,
@@ -130,7 +210,6 @@ async def create_conversation(
     )
     db.add(conversation)
     await db.commit()
-    await db.refresh(conversation)
 
     return ConversationResponse(
         id=conversation.id,
@@ -151,23 +230,25 @@ async def get_conversation(
     current_user: User = Depends(get_current_user),
 ):
     result = await db.execute(
-        select(Conversation).where(Conversation.id == conversation_id)
+        select(Conversation)
+        .options(
+            selectinload(Conversation.messages),
+            joinedload(Conversation.processo),
+            raiseload("*"),
+        )
+        .where(Conversation.id == conversation_id)
     )
     conversation = result.scalar_one_or_none()
 
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversa nao encontrada")
 
-    # Verify access
-    await get_processo_with_access(conversation.processo_id, db, current_user)
-
-    # Get messages
-    msg_result = await db.execute(
-        select(Message)
-        .where(Message.conversation_id == conversation_id)
-        .order_by(Message.created_at)
+    # Verify access (owner check uses the eagerly loaded processo)
+    await check_processo_access(
+        conversation.processo_id, db, current_user, conversation.processo
     )
-    messages = msg_result.scalars().all()
+
+    messages = conversation.messages
 
     msg_count = len(messages)
 
@@ -203,24 +284,19 @@ async def update_conversation(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
+    # Ownership check and update in one statement
     result = await db.execute(
-        select(Conversation).where(Conversation.id == conversation_id)
+        update(Conversation)
+        .where(Conversation.id == conversation_id, Conversation.user_id == current_user.id)
+        .values(titulo=payload.titulo)
+        .returning(Conversation)
     )
     conversation = result.scalar_one_or_none()
 
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversa nao encontrada")
 
-    if conversation.user_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Sem permissao")
-
-    conversation.titulo = payload.titulo
     await db.commit()
-    await db.refresh(conversation)
-
-    msg_count = await db.execute(
-        select(func.count(Message.id)).where(Message.conversation_id == conversation.id)
-    )
 
     return ConversationResponse(
         id=conversation.id,
@@ -230,7 +306,7 @@ async def update_conversation(
         titulo=conversation.titulo,
         created_at=conversation.created_at,
         updated_at=conversation.updated_at,
-        message_count=msg_count.scalar() or 0,
+        message_count=conversation.message_count,
     )
 
 
@@ -240,19 +316,18 @@ async def delete_conversation(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
+    # Ownership check and delete in one statement (messages cascade in the DB)
     result = await db.execute(
-        select(Conversation).where(Conversation.id == conversation_id)
+        delete(Conversation)
+        .where(Conversation.id == conversation_id, Conversation.user_id == current_user.id)
+        .returning(Conversation.id)
     )
-    conversation = result.scalar_one_or_none()
 
-    if not conversation:
+    if result.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Conversa nao encontrada")
 
-    if conversation.user_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Sem permissao")
-
-    await db.delete(conversation)
     await db.commit()
+    forget_telegram_conversations(conversation_id=conversation_id)
 
 
 @router.post("/message", response_model=ChatResponse)
@@ -264,26 +339,22 @@ async def send_message(
     """Non-streaming message endpoint (kept for Telegram and backward compatibility)."""
     # Get conversation
     result = await db.execute(
-        select(Conversation).where(Conversation.id == request.conversation_id)
+        select(Conversation)
+        .options(joinedload(Conversation.processo), raiseload("*"))
+        .where(Conversation.id == request.conversation_id)
     )
     conversation = result.scalar_one_or_none()
 
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversa nao encontrada")
 
-    # Verify access
-    await get_processo_with_access(conversation.processo_id, db, current_user)
-
-    # Get conversation history
-    history_result = await db.execute(
-        select(Message)
-        .where(Message.conversation_id == request.conversation_id)
-        .order_by(Message.created_at)
+    # Verify access and load history concurrently (history uses its own session)
+    _, history = await asyncio.gather(
+        check_processo_access(
+            conversation.processo_id, db, current_user, conversation.processo
+        ),
+        _load_history(request.conversation_id),
     )
-    history = [
-        {"role": m.role, "content": m.content}
-        for m in history_result.scalars().all()
-    ]
 
     # Save user message
     user_message = Message(
@@ -292,53 +363,66 @@ async def send_message(
         content=request.content,
     )
     db.add(user_message)
-    await db.commit()
-    await db.refresh(user_message)
-
-    # Fetch processo contexto
-    processo_result = await db.execute(
-        select(Processo).where(Processo.id == conversation.processo_id)
-    )
-    processo = processo_result.scalar_one_or_none()
-    processo_contexto = processo.contexto if processo else None
-
-    # Get RAG response
-    rag_result = await rag_chat(
-        query=request.content,
-        conversation_history=history,
-        db=db,
-        processo_id=conversation.processo_id,
-        processo_contexto=processo_contexto,
-    )
+    await db.flush()
+
+    processo_contexto = conversation.processo.contexto
+
+    try:
+        # First question of a conversation: try the semantic cache
+        query_embedding = None
+        rag_result = None
+        if not history:
+            query_embedding = await embed_query(request.content)
+            rag_result = await semantic_cache.lookup(
+                request.content, query_embedding, conversation.processo_id, db
+            )
 
-    # Convert sources to SourceInfo
-    sources = [
-        SourceInfo(
-            doc_titulo=s["doc_titulo"],
-            doc_tipo=s["doc_tipo"],
-            documento_id=s["documento_id"],
-            similarity=s["similarity"],
-        )
-        for s in rag_result["sources"]
-    ]
+        # Get RAG response
+        if rag_result is None:
+            rag_result = await rag_chat(
+                query=request.content,
+                conversation_history=history,
+                db=db,
+                processo_id=conversation.processo_id,
+                processo_contexto=processo_contexto,
+                query_embedding=query_embedding,
+            )
+            if query_embedding is not None:
+                await semantic_cache.store(
+                    request.content, query_embedding, conversation.processo_id, rag_result, db
+                )
+    except Exception:
+        # The exchange is committed once at the end; if answering fails,
+        # still keep the user's question
+        await db.rollback()
+        db.add(user_message)
+        await db.commit()
+        forget_telegram_history(request.conversation_id)
+        raise
+
+    # Sources are stored as the plain dicts from the RAG result;
+    # SourceInfo is only built for the response
+    source_dicts = rag_result["sources"]
+    sources = [SourceInfo.model_validate(s) for s in source_dicts]
 
     # Save assistant message
     assistant_message = Message(
         conversation_id=request.conversation_id,
         role="assistant",
         content=rag_result["answer"],
-        chunks_usados=[UUID(c) for c in rag_result["chunks_used"]],
+        chunks_usados=rag_result["chunks_used"],
         tokens_input=rag_result["tokens_input"],
         tokens_output=rag_result["tokens_output"],
         custo_estimado=rag_result["cost_usd"],
-        metadata_={"sources": [s.model_dump() for s in sources]},
+        metadata_={"sources": source_dicts},
     )
     db.add(assistant_message)
+    # Single commit for both messages of the exchange
     await db.commit()
-    await db.refresh(assistant_message)
+    forget_telegram_history(request.conversation_id)
 
     # Generate title in background
-    asyncio.create_task(_generate_title(conversation.id, request.content))
+    _schedule_title(conversation, request.content)
 
     return ChatResponse(
         user_message=MessageResponse(
@@ -375,26 +459,22 @@ async def send_message_stream(
     """Streaming message endpoint using Server-Sent Events."""
     # Get conversation
     result = await db.execute(
-        select(Conversation).where(Conversation.id == request.conversation_id)
+        select(Conversation)
+        .options(joinedload(Conversation.processo), raiseload("*"))
+        .where(Conversation.id == request.conversation_id)
     )
     conversation = result.scalar_one_or_none()
 
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversa nao encontrada")
 
-    # Verify access
-    await get_processo_with_access(conversation.processo_id, db, current_user)
-
-    # Get conversation history
-    history_result = await db.execute(
-        select(Message)
-        .where(Message.conversation_id == request.conversation_id)
-        .order_by(Message.created_at)
+    # Verify access and load history concurrently (history uses its own session)
+    _, history = await asyncio.gather(
+        check_processo_access(
+            conversation.processo_id, db, current_user, conversation.processo
+        ),
+        _load_history(request.conversation_id),
     )
-    history = [
-        {"role": m.role, "content": m.content}
-        for m in history_result.scalars().all()
-    ]
 
     # Save user message
     user_message = Message(
@@ -404,62 +484,50 @@ async def send_message_stream(
     )
     db.add(user_message)
     await db.commit()
-    await db.refresh(user_message)
+    forget_telegram_history(request.conversation_id)
 
-    # Fetch processo contexto
-    processo_result = await db.execute(
-        select(Processo).where(Processo.id == conversation.processo_id)
-    )
-    processo = processo_result.scalar_one_or_none()
-    processo_contexto = processo.contexto if processo else None
+    processo_contexto = conversation.processo.contexto
 
     async def event_generator():
         rag_result_data = None
 
-        async for event in rag_chat_stream(
-            query=request.content,
-            conversation_history=history,
-            db=db,
-            processo_id=conversation.processo_id,
-            processo_contexto=processo_contexto,
-        ):
-            # Capture the done event data for saving
-            if event.startswith("event: done"):
-                lines = event.strip().split("\n")
-                for line in lines:
-                    if line.startswith("data: "):
-                        rag_result_data = json.loads(line[6:])
-                        break
-
-            yield event
-
-        # Save assistant message after streaming completes
-        if rag_result_data:
-            sources = [
-                SourceInfo(
-                    doc_titulo=s["doc_titulo"],
-                    doc_tipo=s["doc_tipo"],
-                    documento_id=s["documento_id"],
-                    similarity=s["similarity"],
-                )
-                for s in rag_result_data["sources"]
-            ]
-
-            assistant_message = Message(
-                conversation_id=request.conversation_id,
-                role="assistant",
-                content=rag_result_data["answer"],
-                chunks_usados=[UUID(c) for c in rag_result_data["chunks_used"]],
-                tokens_input=rag_result_data["tokens_input"],
-                tokens_output=rag_result_data["tokens_output"],
-                custo_estimado=rag_result_data["cost_usd"],
-                metadata_={"sources": [s.model_dump() for s in sources]},
+        # First question of a conversation: try the semantic cache
+        query_embedding = None
+        cached = None
+        if not history:
+            query_embedding = await embed_query(request.content)
+            cached = await semantic_cache.lookup(
+                request.content, query_embedding, conversation.processo_id, db
             )
-            db.add(assistant_message)
-            await db.commit()
+
+        if cached is not None:
+            events = rag_replay_stream(cached)
+        else:
+            events = rag_chat_stream(
+                query=request.content,
+                conversation_history=history,
+                db=db,
+                processo_id=conversation.processo_id,
+                processo_contexto=processo_contexto,
+                query_embedding=query_embedding,
+            )
+
+        async for event, payload in events:
+            # Keep the done payload for saving
+            if event == "done":
+                rag_result_data = payload
+
+            yield _format_sse(event, payload)
+
+        # Save assistant message in background so the stream closes right away
+        if rag_result_data:
+            cache_entry = None
+            if cached is None and query_embedding is not None:
+                cache_entry = (request.content, query_embedding, conversation.processo_id)
+            _spawn(_persist_assistant_message(request.conversation_id, rag_result_data, cache_entry))
 
         # Generate title in background
-        asyncio.create_task(_generate_title(conversation.id, request.content))
+        _schedule_title(conversation, request.content)
 
     return StreamingResponse(
         event_generator(),
@@ -489,6 +557,6 @@ async def get_message_sources(
         select(Conversation).where(Conversation.id == message.conversation_id)
     )
     conversation = conv_result.scalar_one_or_none()
-    await get_processo_with_access(conversation.processo_id, db, current_user)
+    await check_processo_access(conversation.processo_id, db, current_user)
 
     return {"sources": message.metadata_.get("sources", []) if message.metadata_ else []}
@@ -1,17 +1,81 @@
+import copy
 from typing import Optional
 from uuid import UUID
 
-from fastapi import Depends, HTTPException, status
+from cachetools import TTLCache
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, exists, or_
+from sqlalchemy.orm import make_transient_to_detached, contains_eager
 
+from app.core.config import get_settings
 from app.core.database import get_db
 from app.core.security import decode_token
-from app.models.models import User, Processo, ProcessoUser
+from app.models.models import User, Processo, ProcessoUser, Document, Transacao
+from app.services.s3_storage import S3Storage
+
+settings = get_settings()
 
 security = HTTPBearer()
 
+# Short-lived cache of user rows (column values only), keyed by user id
+_user_cache: TTLCache = TTLCache(maxsize=settings.USER_CACHE_MAXSIZE, ttl=settings.USER_CACHE_TTL)
+
+# Positive processo access decisions, keyed by (user_id, processo_id)
+_acl_cache: TTLCache = TTLCache(maxsize=4096, ttl=settings.ACL_CACHE_TTL)
+
+# Processo rows (column values only) backing cached access decisions
+_processo_cache: TTLCache = TTLCache(maxsize=4096, ttl=settings.ACL_CACHE_TTL)
+
+
+def _snapshot(obj) -> dict:
+    return {attr.key: getattr(obj, attr.key) for attr in type(obj).__mapper__.column_attrs}
+
+
+async def _restore(model, data: dict, db: AsyncSession):
+    """Rebuild a persistent instance from a snapshot without a SELECT."""
+    obj = model(**copy.deepcopy(data))  # JSONB values must not be shared
+    make_transient_to_detached(obj)
+    return await db.merge(obj, load=False)
+
+
+def invalidate_acl_cache(processo_id: UUID, user_id: Optional[UUID] = None) -> None:
+    """Forget cached access to a processo (for one user or for everyone)."""
+    if user_id is not None:
+        _acl_cache.pop((user_id, processo_id), None)
+        return
+    for key in [k for k in list(_acl_cache.keys()) if k[1] == processo_id]:
+        _acl_cache.pop(key, None)
+    _processo_cache.pop(processo_id, None)
+
+
+def invalidate_processo_cache(processo_id: UUID) -> None:
+    """Drop a cached processo row; call after changing the processo."""
+    _processo_cache.pop(processo_id, None)
+
+
+def invalidate_user_cache(user_id: UUID) -> None:
+    """Drop a cached user row; call after changing or deleting the user."""
+    _user_cache.pop(user_id, None)
+
+
+async def _load_user(user_id: UUID, db: AsyncSession) -> Optional[User]:
+    cached = _user_cache.get(user_id)
+    if cached is not None:
+        return await _restore(User, cached, db)
+
+    result = await db.execute(select(User).where(User.id == user_id))
+    user = result.scalar_one_or_none()
+    if user:
+        _user_cache[user_id] = _snapshot(user)
+    return user
+
+
+def get_s3(request: Request) -> S3Storage:
+    """Process-wide S3 storage opened in the app lifespan."""
+    return request.app.state.s3
+
 
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
@@ -39,8 +103,7 @@ async def get_current_user(
             detail="Token invalido",
         )
 
-    result = await db.execute(select(User).where(User.id == UUID(user_id)))
-    user = result.scalar_one_or_none()
+    user = await _load_user(UUID(user_id), db)
 
     if not user:
         raise HTTPException(
@@ -74,34 +137,38 @@ async def get_processo_with_access(
     current_user: User = Depends(get_current_user),
 ) -> Processo:
     """Get processo and verify user has access (owner or shared)."""
-    result = await db.execute(select(Processo).where(Processo.id == processo_id))
-    processo = result.scalar_one_or_none()
+    acl_key = (current_user.id, processo_id)
+    cached = _processo_cache.get(processo_id)
+    if cached is not None and acl_key in _acl_cache:
+        return await _restore(Processo, cached, db)
 
-    if not processo:
+    # Processo and shared-access flag in a single round trip
+    result = await db.execute(
+        select(
+            Processo,
+            exists().where(
+                ProcessoUser.processo_id == processo_id,
+                ProcessoUser.user_id == current_user.id,
+            ).label("is_shared"),
+        ).where(Processo.id == processo_id)
+    )
+    row = result.first()
+
+    if not row:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Processo nao encontrado",
         )
 
-    # Check if user is owner
-    if processo.owner_id == current_user.id:
-        return processo
-
-    # Check if user has shared access
-    shared_result = await db.execute(
-        select(ProcessoUser).where(
-            ProcessoUser.processo_id == processo_id,
-            ProcessoUser.user_id == current_user.id,
-        )
-    )
-    shared = shared_result.scalar_one_or_none()
-
-    if not shared:
+    processo, is_shared = row
+    if processo.owner_id != current_user.id and not is_shared:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Acesso negado a este processo",
         )
 
+    _acl_cache[acl_key] = True
+    _processo_cache[processo_id] = _snapshot(processo)
     return processo
 
 
@@ -111,33 +178,133 @@ async def get_processo_as_editor(
     current_user: User = Depends(get_current_user),
 ) -> Processo:
     """Get processo and verify user can edit (owner or editor role)."""
-    result = await db.execute(select(Processo).where(Processo.id == processo_id))
-    processo = result.scalar_one_or_none()
+    # Processo and editor-access flag in a single round trip
+    result = await db.execute(
+        select(
+            Processo,
+            exists().where(
+                ProcessoUser.processo_id == processo_id,
+                ProcessoUser.user_id == current_user.id,
+                ProcessoUser.role == "editor",
+            ).label("is_editor"),
+        ).where(Processo.id == processo_id)
+    )
+    row = result.first()
 
-    if not processo:
+    if not row:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Processo nao encontrado",
         )
 
     # Owner can always edit
-    if processo.owner_id == current_user.id:
-        return processo
-
-    # Check if user has editor access
-    shared_result = await db.execute(
-        select(ProcessoUser).where(
-            ProcessoUser.processo_id == processo_id,
-            ProcessoUser.user_id == current_user.id,
-            ProcessoUser.role == "editor",
+    processo, is_editor = row
+    if processo.owner_id != current_user.id and not is_editor:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Permissao de edicao negada",
+        )
+
+    return processo
+
+
+def _has_access(user_id: UUID):
+    """Owner-or-shared predicate on Processo, for use as a selected column."""
+    return or_(
+        Processo.owner_id == user_id,
+        exists().where(
+            ProcessoUser.processo_id == Processo.id,
+            ProcessoUser.user_id == user_id,
+        ),
+    ).label("has_access")
+
+
+def accessible_processo_ids(user_id: UUID):
+    """Subquery of processo ids the user owns or has been shared, for IN filters."""
+    return select(Processo.id).where(
+        or_(
+            Processo.owner_id == user_id,
+            Processo.id.in_(select(ProcessoUser.processo_id).where(ProcessoUser.user_id == user_id)),
         )
     )
-    shared = shared_result.scalar_one_or_none()
 
-    if not shared:
+
+async def get_document_with_access(
+    document_id: UUID,
+    db: AsyncSession,
+    current_user: User,
+) -> Document:
+    """Get document (with its processo loaded) and verify access in one query."""
+    result = await db.execute(
+        select(Document, _has_access(current_user.id))
+        .join(Document.processo)
+        .options(contains_eager(Document.processo))
+        .where(Document.id == document_id)
+    )
+    row = result.first()
+
+    if not row:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Documento nao encontrado",
+        )
+
+    document, has_access = row
+    if not has_access:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
-            detail="Permissao de edicao negada",
+            detail="Acesso negado a este processo",
         )
 
-    return processo
+    _acl_cache[(current_user.id, document.processo_id)] = True
+    return document
+
+
+async def get_transacao_with_access(
+    transacao_id: UUID,
+    db: AsyncSession,
+    current_user: User,
+) -> Transacao:
+    """Get transacao and verify access to its processo in one query."""
+    result = await db.execute(
+        select(Transacao, _has_access(current_user.id))
+        .join(Transacao.processo)
+        .options(contains_eager(Transacao.processo))
+        .where(Transacao.id == transacao_id)
+    )
+    row = result.first()
+
+    if not row:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Transacao nao encontrada",
+        )
+
+    transacao, has_access = row
+    if not has_access:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Acesso negado a este processo",
+        )
+
+    _acl_cache[(current_user.id, transacao.processo_id)] = True
+    return transacao
+
+
+async def check_processo_access(
+    processo_id: UUID,
+    db: AsyncSession,
+    current_user: User,
+    processo: Optional[Processo] = None,
+) -> None:
+    """Access check only (no Processo returned), cached for ACL_CACHE_TTL.
+
+    Pass an already loaded ``processo`` to resolve owner access without a query.
+    """
+    key = (current_user.id, processo_id)
+    if key in _acl_cache:
+        return
+
+    if processo is None or processo.owner_id != current_user.id:
+        await get_processo_with_access(processo_id, db, current_user)
+    _acl_cache[key] = True
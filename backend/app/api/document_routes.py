@@ -1,32 +1,92 @@
+import asyncio
+import json
 import os
 import re
+from datetime import datetime
 from uuid import UUID
-from typing import Optional
+from typing import Callable, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, BackgroundTasks
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi.responses import RedirectResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, func, update, delete, exists, or_, bindparam, text
+from sqlalchemy.dialects.postgresql import JSONB
 
-from app.core.database import get_db
+from app.core.database import get_db, AsyncSessionLocal
 from app.core.config import get_settings
-from app.models.models import User, Document, Processo
-from app.schemas.document import DocumentResponse, DocumentListResponse, DocumentSearchResponse, DocumentSearchResult, DocumentUpdate
-from app.api.deps import get_current_user, get_processo_with_access
+from app.models.models import User, Document, Chunk, Processo
+from app.schemas.document import (
+    DocumentResponse, DocumentListResponse, DocumentSearchResponse, DocumentSearchResult,
+    DocumentUpdate, DocumentBulkUpdateRequest, DocumentBulkUpdateResponse,
+)
+from app.api.deps import get_current_user, get_processo_with_access, get_document_with_access, get_s3
+from app.api.utils import scalar_in_new_session
+from app.services import semantic_cache
 from app.services.document_processor import process_document
-from app.services.s3_storage import S3Storage
+from app.services.job_queue import enqueue
+from app.services.s3_storage import S3Storage, PART_SIZE
 
 router = APIRouter(prefix="/documents", tags=["documents"])
 settings = get_settings()
 
+# Overlay keys on the metadata of every chunk of a document (metadata || patch).
+# Built once so the compiled statement and its prepared plan are reused.
+_patch_chunk_metadata = (
+    update(Chunk)
+    .where(Chunk.documento_id == bindparam("doc_id"))
+    .values(metadata_=Chunk.metadata_.op("||")(bindparam("patch", type_=JSONB)))
+    .execution_options(synchronize_session=False)
+)
+
+
+ALLOWED_MIMES: frozenset[str] = frozenset({
+    'application/pdf',
+    'image/png', 'image/jpeg', 'image/webp', 'image/bmp',
+    'text/plain', 'text/csv',
+    'audio/mpeg', 'audio/ogg', 'audio/wav', 'audio/m4a',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+})
+
+
+def _is_zip(head: bytes) -> bool:
+    return head.startswith(b"PK\x03\x04")
+
+
+# Magic bytes expected for each allowed type (text types have none)
+_MIME_SIGNATURES: dict[str, Callable[[bytes], bool]] = {
+    'application/pdf': lambda h: h.startswith(b"%PDF"),
+    'image/png': lambda h: h.startswith(b"\x89PNG\r\n\x1a\n"),
+    'image/jpeg': lambda h: h.startswith(b"\xff\xd8\xff"),
+    'image/webp': lambda h: h[:4] == b"RIFF" and h[8:12] == b"WEBP",
+    'image/bmp': lambda h: h.startswith(b"BM"),
+    'audio/mpeg': lambda h: h.startswith(b"ID3") or h[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"),
+    'audio/ogg': lambda h: h.startswith(b"OggS"),
+    'audio/wav': lambda h: h[:4] == b"RIFF" and h[8:12] == b"WAVE",
+    'audio/m4a': lambda h: h[4:8] == b"ftyp",
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': _is_zip,
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': _is_zip,
+}
+
+# Anything but alphanumerics, dots, hyphens and underscores, plus ".." (directory traversal)
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\-.]|\.\.')
+
+
+def _chunk_metadata_patch(update_data: dict) -> dict:
+    """Map updated document fields to the keys mirrored in chunk metadata."""
+    patch = {}
+    if "titulo" in update_data:
+        patch["doc_titulo"] = update_data["titulo"]
+    if "tipo" in update_data:
+        patch["doc_tipo"] = update_data["tipo"]
+    if "data_referencia" in update_data:
+        patch["data_referencia"] = str(update_data["data_referencia"])
+    return patch
+
 
 def sanitize_filename(filename: str) -> str:
     """Remove potentially dangerous characters from filename."""
-    # Keep only alphanumeric, dots, hyphens, underscores
-    name = re.sub(r'[^\w\-.]', '_', filename)
-    # Prevent directory traversal
-    name = name.replace('..', '_')
-    return name
+    return _UNSAFE_FILENAME_RE.sub('_', filename)
 
 
 @router.get("", response_model=DocumentListResponse)
@@ -42,30 +102,27 @@ async def list_documents(
     # Verify access to processo
     await get_processo_with_access(processo_id, db, current_user)
 
-    query = select(Document).where(Document.processo_id == processo_id)
-
+    filters = [Document.processo_id == processo_id]
     if tipo:
-        query = query.where(Document.tipo == tipo)
+        filters.append(Document.tipo == tipo)
     if status_filter:
-        query = query.where(Document.status == status_filter)
-
-    # Count
-    count_query = select(func.count()).select_from(query.subquery())
-    count_result = await db.execute(count_query)
-    total = count_result.scalar() or 0
-
-    # Get documents
-    result = await db.execute(
-        query.order_by(Document.created_at.desc()).offset(skip).limit(limit)
+        filters.append(Document.status == status_filter)
+
+    # Count (same filters, no subquery) and page, concurrently
+    total, result = await asyncio.gather(
+        scalar_in_new_session(select(func.count(Document.id)).where(*filters)),
+        db.execute(
+            select(Document).where(*filters)
+            .order_by(Document.created_at.desc()).offset(skip).limit(limit)
+        ),
     )
     documents = result.scalars().all()
 
-    return DocumentListResponse(documents=documents, total=total)
+    return DocumentListResponse(documents=documents, total=total or 0)
 
 
 @router.post("/upload", response_model=DocumentResponse, status_code=status.HTTP_201_CREATED)
 async def upload_document(
-    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     processo_id: UUID = Form(...),
     tipo: str = Form(...),
@@ -75,37 +132,45 @@ async def upload_document(
     data_referencia: Optional[str] = Form(None),
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
+    s3: S3Storage = Depends(get_s3),
 ):
     # Verify access to processo
     await get_processo_with_access(processo_id, db, current_user)
 
-    # Validate file size
-    content = await file.read()
-    if len(content) > settings.MAX_UPLOAD_SIZE:
+    # Validate mime type
+    if file.content_type and file.content_type not in ALLOWED_MIMES:
         raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            detail=f"Arquivo muito grande. Maximo: {settings.MAX_UPLOAD_SIZE // (1024*1024)}MB",
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Tipo de arquivo nao permitido: {file.content_type}",
         )
 
-    # Validate mime type
-    allowed_mimes = [
-        'application/pdf',
-        'image/png', 'image/jpeg', 'image/webp', 'image/bmp',
-        'text/plain', 'text/csv',
-        'audio/mpeg', 'audio/ogg', 'audio/wav', 'audio/m4a',
-        'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-    ]
-    if file.content_type and file.content_type not in allowed_mimes:
+    # Check the leading bytes against the declared type before sending anything to S3
+    first_chunk = await file.read(PART_SIZE)
+    signature = _MIME_SIGNATURES.get(file.content_type)
+    if signature and not signature(first_chunk[:16]):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Tipo de arquivo nao permitido: {file.content_type}",
+            detail=f"Conteudo do arquivo nao corresponde ao tipo: {file.content_type}",
         )
 
-    # Upload to S3
-    s3 = S3Storage()
+    # Stream to S3 in bounded chunks, validating size as data arrives
+    total_size = 0
+
+    async def file_chunks():
+        nonlocal total_size
+        chunk = first_chunk
+        while chunk:
+            total_size += len(chunk)
+            if total_size > settings.MAX_UPLOAD_SIZE:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail=f"Arquivo muito grande. Maximo: {settings.MAX_UPLOAD_SIZE // (1024*1024)}MB",
+                )
+            yield chunk
+            chunk = await file.read(PART_SIZE)
+
     safe_filename = sanitize_filename(file.filename or "document")
-    s3_key = await s3.upload_file(content, safe_filename, processo_id)
+    s3_key = await s3.upload_stream(file_chunks(), safe_filename, processo_id)
 
     # Parse participantes
     participantes_list = None
@@ -115,7 +180,6 @@ async def upload_document(
     # Parse data_referencia
     data_ref = None
     if data_referencia:
-        from datetime import datetime
         try:
             data_ref = datetime.strptime(data_referencia, "%Y-%m-%d").date()
         except ValueError:
@@ -133,22 +197,119 @@ async def upload_document(
         arquivo_original=s3_key,
         arquivo_nome=safe_filename,
         arquivo_mime=file.content_type,
-        arquivo_tamanho=len(content),
+        arquivo_tamanho=total_size,
         status="uploaded",
     )
     db.add(document)
     await db.commit()
-    await db.refresh(document)
 
-    # Process document in background
-    background_tasks.add_task(process_document_task, document.id)
+    # Process document on the background worker pool
+    enqueue(process_document_task, document.id)
 
     return document
 
 
+@router.post("/bulk-update", response_model=DocumentBulkUpdateResponse)
+async def bulk_update_documents(
+    request: DocumentBulkUpdateRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """Update titulo/tipo/data_referencia of many documents in one transaction."""
+    await get_processo_with_access(request.processo_id, db, current_user)
+
+    updates = {
+        item.document_id: item.model_dump(exclude_none=True, exclude={"document_id"})
+        for item in request.updates
+    }
+    updates = {doc_id: fields for doc_id, fields in updates.items() if fields}
+    if not updates:
+        return DocumentBulkUpdateResponse(updated=0)
+
+    result = await db.execute(
+        select(Document.id, Document.tipo, Document.status).where(
+            Document.id.in_(updates.keys()),
+            Document.processo_id == request.processo_id,
+        )
+    )
+    current = {row.id: row for row in result}
+    missing = updates.keys() - current.keys()
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Documento nao encontrado: {next(iter(missing))}",
+        )
+
+    # Documents: one executemany UPDATE by primary key
+    now = datetime.utcnow()
+    await db.execute(
+        update(Document),
+        [{"id": doc_id, **fields, "updated_at": now} for doc_id, fields in updates.items()],
+    )
+
+    # Chunks: COPY all patches into a temp table and apply them in one UPDATE
+    records = [
+        (doc_id, json.dumps(patch))
+        for doc_id, fields in updates.items()
+        if (patch := _chunk_metadata_patch(fields))
+    ]
+    if records:
+        await db.execute(text(
+            "CREATE TEMP TABLE tmp_chunk_patch (doc_id UUID, patch TEXT) ON COMMIT DROP"
+        ))
+        conn = await db.connection()
+        raw_conn = await conn.get_raw_connection()
+        await raw_conn.driver_connection.copy_records_to_table(
+            "tmp_chunk_patch", records=records, columns=["doc_id", "patch"]
+        )
+        await db.execute(text(
+            "UPDATE chunks c SET metadata = c.metadata || p.patch::jsonb "
+            "FROM tmp_chunk_patch p WHERE c.documento_id = p.doc_id"
+        ))
+
+    # Cached answers list doc_titulo/doc_tipo in their sources
+    if any("titulo" in fields or "tipo" in fields for fields in updates.values()):
+        await semantic_cache.invalidate(request.processo_id, db)
+    await db.commit()
+
+    # Documents that became financial get analysed in the background
+    financial_types = ("extrato_bancario", "comprovante")
+    for doc_id, fields in updates.items():
+        row = current[doc_id]
+        if (
+            fields.get("tipo") in financial_types
+            and row.tipo not in financial_types
+            and row.status == "processed"
+        ):
+            enqueue(financial_analysis_task, doc_id)
+
+    return DocumentBulkUpdateResponse(updated=len(updates))
+
+
+async def financial_analysis_task(document_id: UUID):
+    """Background task to run financial analysis on a processed document."""
+    from app.services.financial_analyzer import FinancialAnalyzer
+
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(Document.processo_id, Processo.contexto)
+            .join(Processo, Document.processo_id == Processo.id)
+            .where(Document.id == document_id)
+        )
+        row = result.first()
+        if not row:
+            return
+
+        analyzer = FinancialAnalyzer(db)
+        await analyzer.analyze_document(
+            documento_id=document_id,
+            processo_id=row.processo_id,
+            processo_contexto=row.contexto,
+        )
+
+
 async def process_document_task(document_id: UUID):
     """Background task to process document."""
-    from app.core.database import AsyncSessionLocal
     async with AsyncSessionLocal() as db:
         try:
             await process_document(document_id, db)
@@ -162,20 +323,63 @@ async def process_document_task(document_id: UUID):
                 await db.commit()
 
 
+@router.get("/search", response_model=DocumentSearchResponse)
+async def search_documents(
+    processo_id: UUID,
+    q: str,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    """Full-text search within the documents of a processo."""
+    # Verify access
+    await get_processo_with_access(processo_id, db, current_user)
+
+    # Full-text match on the indexed tsvector, best matches first; excerpts are
+    # built by Postgres so the full extracted text never leaves the database
+    ts_query = func.plainto_tsquery("portuguese", q)
+    rank = func.ts_rank(Document.texto_tsv, ts_query)
+    result = await db.execute(
+        select(
+            Document.id,
+            Document.titulo,
+            Document.tipo,
+            func.ts_headline(
+                "portuguese",
+                Document.texto_extraido,
+                ts_query,
+                "MaxWords=30, MinWords=10",
+            ).label("excerpt"),
+            rank.label("relevance"),
+        )
+        .where(
+            Document.processo_id == processo_id,
+            Document.texto_tsv.op("@@")(ts_query),
+        )
+        .order_by(rank.desc())
+        .limit(20)
+    )
+
+    results = [
+        DocumentSearchResult(
+            document_id=row.id,
+            titulo=row.titulo,
+            tipo=row.tipo,
+            excerpt=f"...{row.excerpt}...",
+            relevance=row.relevance,
+        )
+        for row in result
+    ]
+
+    return DocumentSearchResponse(results=results, query=q, total=len(results))
+
+
 @router.get("/{document_id}", response_model=DocumentResponse)
 async def get_document(
     document_id: UUID,
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    result = await db.execute(select(Document).where(Document.id == document_id))
-    document = result.scalar_one_or_none()
-
-    if not document:
-        raise HTTPException(status_code=404, detail="Documento nao encontrado")
-
-    # Verify access
-    await get_processo_with_access(document.processo_id, db, current_user)
+    document = await get_document_with_access(document_id, db, current_user)
 
     return document
 
@@ -187,14 +391,7 @@ async def update_document(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    result = await db.execute(select(Document).where(Document.id == document_id))
-    document = result.scalar_one_or_none()
-
-    if not document:
-        raise HTTPException(status_code=404, detail="Documento nao encontrado")
-
-    # Verify access
-    await get_processo_with_access(document.processo_id, db, current_user)
+    document = await get_document_with_access(document_id, db, current_user)
 
     # Track tipo change for financial analysis
     old_tipo = document.tipo
@@ -211,27 +408,17 @@ async def update_document(
     await db.flush()
 
     # Propagate changes to chunk metadata_
-    metadata_updates = {}
-    if payload.titulo is not None:
-        metadata_updates["doc_titulo"] = payload.titulo
-    if payload.tipo is not None:
-        metadata_updates["doc_tipo"] = payload.tipo
-    if payload.data_referencia is not None:
-        metadata_updates["data_referencia"] = str(payload.data_referencia)
-
+    metadata_updates = _chunk_metadata_patch(update_data)
     if metadata_updates:
-        import json
-        from sqlalchemy import text as sa_text
-        # Use metadata || jsonb overlay to update specific keys in one shot
         await db.execute(
-            sa_text(
-                "UPDATE chunks SET metadata = metadata || CAST(:patch AS jsonb) WHERE documento_id = :doc_id"
-            ),
-            {"patch": json.dumps(metadata_updates), "doc_id": str(document_id)},
+            _patch_chunk_metadata, {"patch": metadata_updates, "doc_id": document_id}
         )
 
+    # Cached answers list doc_titulo/doc_tipo in their sources
+    if "titulo" in update_data or "tipo" in update_data:
+        await semantic_cache.invalidate(document.processo_id, db)
+
     await db.commit()
-    await db.refresh(document)
 
     # Run financial analysis if tipo changed to a financial type
     financial_types = ("extrato_bancario", "comprovante")
@@ -265,23 +452,20 @@ async def update_document(
 @router.get("/{document_id}/download")
 async def download_document(
     document_id: UUID,
+    format: Optional[str] = None,
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
+    s3: S3Storage = Depends(get_s3),
 ):
-    result = await db.execute(select(Document).where(Document.id == document_id))
-    document = result.scalar_one_or_none()
-
-    if not document:
-        raise HTTPException(status_code=404, detail="Documento nao encontrado")
-
-    # Verify access
-    await get_processo_with_access(document.processo_id, db, current_user)
+    document = await get_document_with_access(document_id, db, current_user)
 
     # Generate presigned URL or stream file
-    s3 = S3Storage()
-    url = await s3.get_presigned_url(document.arquivo_original)
+    url = await s3.get_presigned_url(document.arquivo_original, filename=document.arquivo_nome)
 
-    return {"download_url": url, "filename": document.arquivo_nome}
+    # JS clients with bearer auth cannot follow a redirect into a download
+    if format == "json":
+        return {"download_url": url, "filename": document.arquivo_nome}
+    return RedirectResponse(url, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
 
 
 @router.delete("/{document_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -289,72 +473,35 @@ async def delete_document(
     document_id: UUID,
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
+    s3: S3Storage = Depends(get_s3),
 ):
-    result = await db.execute(select(Document).where(Document.id == document_id))
-    document = result.scalar_one_or_none()
-
-    if not document:
-        raise HTTPException(status_code=404, detail="Documento nao encontrado")
-
-    # Verify access (need to be owner or editor)
-    processo_result = await db.execute(select(Processo).where(Processo.id == document.processo_id))
-    processo = processo_result.scalar_one_or_none()
-
-    if processo.owner_id != current_user.id and document.user_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Sem permissao para excluir este documento")
-
-    # Delete from S3
-    s3 = S3Storage()
-    await s3.delete_file(document.arquivo_original)
-
-    # Delete from database (chunks will cascade)
-    await db.delete(document)
-    await db.commit()
-
-
-@router.get("/search", response_model=DocumentSearchResponse)
-async def search_documents(
-    processo_id: UUID,
-    q: str,
-    db: AsyncSession = Depends(get_db),
-    current_user: User = Depends(get_current_user),
-):
-    """Search for exact text within documents."""
-    # Verify access
-    await get_processo_with_access(processo_id, db, current_user)
-
-    # Search in texto_extraido
+    # Only the processo owner or the uploader can delete; chunks cascade in the database
     result = await db.execute(
-        select(Document)
+        delete(Document)
         .where(
-            Document.processo_id == processo_id,
-            Document.texto_extraido.ilike(f"%{q}%"),
+            Document.id == document_id,
+            or_(
+                Document.user_id == current_user.id,
+                Document.processo_id.in_(
+                    select(Processo.id).where(Processo.owner_id == current_user.id)
+                ),
+            ),
         )
-        .limit(20)
+        .returning(Document.arquivo_original, Document.processo_id)
     )
-    documents = result.scalars().all()
+    deleted = result.first()
 
-    results = []
-    for doc in documents:
-        # Find excerpt around match
-        text = doc.texto_extraido or ""
-        lower_text = text.lower()
-        lower_q = q.lower()
-        pos = lower_text.find(lower_q)
-
-        if pos >= 0:
-            start = max(0, pos - 100)
-            end = min(len(text), pos + len(q) + 100)
-            excerpt = "..." + text[start:end] + "..."
-        else:
-            excerpt = text[:200] + "..."
-
-        results.append(DocumentSearchResult(
-            document_id=doc.id,
-            titulo=doc.titulo,
-            tipo=doc.tipo,
-            excerpt=excerpt,
-            relevance=1.0,
-        ))
+    if deleted is None:
+        if await db.scalar(select(exists().where(Document.id == document_id))):
+            raise HTTPException(status_code=403, detail="Sem permissao para excluir este documento")
+        raise HTTPException(status_code=404, detail="Documento nao encontrado")
 
-    return DocumentSearchResponse(results=results, query=q, total=len(results))
+    await semantic_cache.invalidate(deleted.processo_id, db)
+
+    await db.commit()
+
+    # The row is gone; a leftover object only costs storage
+    try:
+        await s3.delete_file(deleted.arquivo_original)
+    except Exception as e:
+        print(f"Failed to delete S3 file for document {document_id}: {e}")
@@ -1,57 +1,85 @@
+import asyncio
 from uuid import UUID
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, or_
+from sqlalchemy import select, func, or_, delete, exists, union_all
+from sqlalchemy.dialects.postgresql import insert
 
 from app.core.database import get_db
-from app.models.models import User, Processo, ProcessoUser, Document
+from app.models.models import User, Processo, ProcessoUser, Document, Report
 from app.schemas.processo import (
     ProcessoCreate, ProcessoUpdate, ProcessoShareRequest,
     ProcessoResponse, ProcessoListResponse, SharedUserResponse
 )
-from app.api.deps import get_current_user, get_processo_with_access
+from app.api.deps import (
+    get_current_user, get_processo_with_access, get_s3,
+    invalidate_acl_cache, invalidate_processo_cache,
+)
+from app.api.utils import scalar_in_new_session
+from app.services.s3_storage import S3Storage
+from app.services.telegram_bot import forget_conversations as forget_telegram_conversations
 
 router = APIRouter(prefix="/processos", tags=["processos"])
 
 
-async def build_processo_response(processo: Processo, db: AsyncSession) -> ProcessoResponse:
-    # Count documents
-    doc_count = await db.execute(
-        select(func.count(Document.id)).where(Document.processo_id == processo.id)
+async def build_processo_responses(
+    processos: list[Processo], db: AsyncSession
+) -> list[ProcessoResponse]:
+    """Build responses for a page of processos with two bulk queries."""
+    if not processos:
+        return []
+    ids = [p.id for p in processos]
+
+    # Document counts per processo
+    count_result = await db.execute(
+        select(Document.processo_id, func.count())
+        .where(Document.processo_id.in_(ids))
+        .group_by(Document.processo_id)
     )
-    document_count = doc_count.scalar() or 0
+    document_counts = dict(count_result.all())
 
-    # Get shared users
+    # Shared users per processo
     shared_result = await db.execute(
-        select(ProcessoUser, User)
+        select(
+            ProcessoUser.processo_id, ProcessoUser.user_id, ProcessoUser.role,
+            ProcessoUser.created_at, User.name, User.email,
+        )
         .join(User, ProcessoUser.user_id == User.id)
-        .where(ProcessoUser.processo_id == processo.id)
+        .where(ProcessoUser.processo_id.in_(ids))
     )
-    shared_users = [
-        SharedUserResponse(
-            user_id=pu.user_id,
-            user_name=user.name,
-            user_email=user.email,
-            role=pu.role,
-            shared_at=pu.created_at,
+    shared_users: dict[UUID, list[SharedUserResponse]] = {}
+    for row in shared_result:
+        shared_users.setdefault(row.processo_id, []).append(
+            SharedUserResponse(
+                user_id=row.user_id,
+                user_name=row.name,
+                user_email=row.email,
+                role=row.role,
+                shared_at=row.created_at,
+            )
+        )
+
+    return [
+        ProcessoResponse(
+            id=processo.id,
+            owner_id=processo.owner_id,
+            numero=processo.numero,
+            titulo=processo.titulo,
+            descricao=processo.descricao,
+            contexto=processo.contexto,
+            status=processo.status,
+            created_at=processo.created_at,
+            updated_at=processo.updated_at,
+            document_count=document_counts.get(processo.id, 0),
+            shared_users=shared_users.get(processo.id, []),
         )
-        for pu, user in shared_result.all()
+        for processo in processos
     ]
 
-    return ProcessoResponse(
-        id=processo.id,
-        owner_id=processo.owner_id,
-        numero=processo.numero,
-        titulo=processo.titulo,
-        descricao=processo.descricao,
-        contexto=processo.contexto,
-        status=processo.status,
-        created_at=processo.created_at,
-        updated_at=processo.updated_at,
-        document_count=document_count,
-        shared_users=shared_users,
-    )
+
+async def build_processo_response(processo: Processo, db: AsyncSession) -> ProcessoResponse:
+    return (await build_processo_responses([processo], db))[0]
 
 
 @router.get("", response_model=ProcessoListResponse)
@@ -62,37 +90,32 @@ async def list_processos(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    # Get processos where user is owner or has shared access
-    query = (
-        select(Processo)
-        .outerjoin(ProcessoUser, Processo.id == ProcessoUser.processo_id)
-        .where(
-            or_(
-                Processo.owner_id == current_user.id,
-                ProcessoUser.user_id == current_user.id,
-            )
+    # Processos where user is owner or has shared access (no join, so no DISTINCT)
+    filters = [
+        or_(
+            Processo.owner_id == current_user.id,
+            Processo.id.in_(
+                select(ProcessoUser.processo_id).where(ProcessoUser.user_id == current_user.id)
+            ),
         )
-        .distinct()
-    )
-
+    ]
     if status_filter:
-        query = query.where(Processo.status == status_filter)
-
-    # Count total
-    count_query = select(func.count()).select_from(query.subquery())
-    count_result = await db.execute(count_query)
-    total = count_result.scalar() or 0
-
-    # Get processos
-    result = await db.execute(
-        query.order_by(Processo.updated_at.desc()).offset(skip).limit(limit)
+        filters.append(Processo.status == status_filter)
+
+    # Count total and page, concurrently
+    total, result = await asyncio.gather(
+        scalar_in_new_session(select(func.count(Processo.id)).where(*filters)),
+        db.execute(
+            select(Processo).where(*filters)
+            .order_by(Processo.updated_at.desc()).offset(skip).limit(limit)
+        ),
     )
     processos = result.scalars().all()
 
-    # Build responses
-    responses = [await build_processo_response(p, db) for p in processos]
+    # Build responses (counts and shares fetched in bulk for the page)
+    responses = await build_processo_responses(processos, db)
 
-    return ProcessoListResponse(processos=responses, total=total)
+    return ProcessoListResponse(processos=responses, total=total or 0)
 
 
 @router.post("", response_model=ProcessoResponse, status_code=status.HTTP_201_CREATED)
@@ -110,7 +133,6 @@ async def create_processo(
     )
     db.add(processo)
     await db.commit()
-    await db.refresh(processo)
 
     return await build_processo_response(processo, db)
 
@@ -152,7 +174,7 @@ async def update_processo(
         processo.status = request.status
 
     await db.commit()
-    await db.refresh(processo)
+    invalidate_processo_cache(processo_id)
 
     return await build_processo_response(processo, db)
 
@@ -162,18 +184,36 @@ async def delete_processo(
     processo_id: UUID,
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
+    s3: S3Storage = Depends(get_s3),
 ):
-    result = await db.execute(select(Processo).where(Processo.id == processo_id))
-    processo = result.scalar_one_or_none()
+    # Collect stored files before the rows cascade away
+    s3_keys = list(await db.scalars(union_all(
+        select(Document.arquivo_original).where(Document.processo_id == processo_id),
+        select(Report.arquivo_s3).where(
+            Report.processo_id == processo_id, Report.arquivo_s3.isnot(None)
+        ),
+    )))
+
+    # Only the owner can delete; dependent rows cascade in the database
+    deleted = await db.scalar(
+        delete(Processo)
+        .where(Processo.id == processo_id, Processo.owner_id == current_user.id)
+        .returning(Processo.id)
+    )
 
-    if not processo:
+    if deleted is None:
+        if await db.scalar(select(exists().where(Processo.id == processo_id))):
+            raise HTTPException(status_code=403, detail="Apenas o proprietario pode excluir")
         raise HTTPException(status_code=404, detail="Processo nao encontrado")
 
-    if processo.owner_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Apenas o proprietario pode excluir")
-
-    await db.delete(processo)
     await db.commit()
+    invalidate_acl_cache(processo_id)
+    forget_telegram_conversations(processo_id=processo_id)
+
+    try:
+        await s3.delete_files(s3_keys)
+    except Exception as e:
+        print(f"Failed to delete S3 files for processo {processo_id}: {e}")
 
 
 @router.post("/{processo_id}/share", response_model=SharedUserResponse)
@@ -203,25 +243,21 @@ async def share_processo(
     if target_user.id == current_user.id:
         raise HTTPException(status_code=400, detail="Nao e possivel compartilhar consigo mesmo")
 
-    # Check if already shared
-    existing = await db.execute(
-        select(ProcessoUser).where(
-            ProcessoUser.processo_id == processo_id,
-            ProcessoUser.user_id == request.user_id,
+    # Create share; an existing share makes the insert a no-op (no row returned)
+    result = await db.execute(
+        insert(ProcessoUser)
+        .values(
+            processo_id=processo_id,
+            user_id=request.user_id,
+            role=request.role,
         )
+        .on_conflict_do_nothing(index_elements=["processo_id", "user_id"])
+        .returning(ProcessoUser.role, ProcessoUser.created_at)
     )
-    if existing.scalar_one_or_none():
+    share = result.first()
+    if share is None:
         raise HTTPException(status_code=400, detail="Processo ja compartilhado com este usuario")
-
-    # Create share
-    share = ProcessoUser(
-        processo_id=processo_id,
-        user_id=request.user_id,
-        role=request.role,
-    )
-    db.add(share)
     await db.commit()
-    await db.refresh(share)
 
     return SharedUserResponse(
         user_id=target_user.id,
@@ -263,3 +299,4 @@ async def unshare_processo(
 
     await db.delete(share)
     await db.commit()
+    invalidate_acl_cache(processo_id, user_id)
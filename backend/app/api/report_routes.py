@@ -1,18 +1,23 @@
+import asyncio
+from datetime import datetime
 from uuid import UUID
+from typing import Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, status, Response
 from fastapi.responses import RedirectResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func
 
-from app.core.database import get_db
+from app.core.database import get_db, AsyncSessionLocal
 from app.models.models import User, Report
 from app.schemas.report import (
     ReportGenerateRequest, ReportResponse, ReportListResponse, ReportTemplateResponse
 )
-from app.api.deps import get_current_user, get_processo_with_access
+from app.api.deps import get_current_user, get_processo_with_access, check_processo_access, get_s3
+from app.api.utils import scalar_in_new_session
 from app.services.excel_generator import ExcelGenerator
-from app.services.s3_storage import S3Storage
+from app.services.job_queue import enqueue
+from app.services.s3_storage import S3Storage, storage as s3_storage
 
 router = APIRouter(prefix="/reports", tags=["reports"])
 
@@ -55,28 +60,68 @@ async def list_reports(
     # Verify access
     await get_processo_with_access(processo_id, db, current_user)
 
-    query = select(Report).where(Report.processo_id == processo_id)
-
-    # Count
-    count_query = select(func.count()).select_from(query.subquery())
-    count_result = await db.execute(count_query)
-    total = count_result.scalar() or 0
-
-    # Get reports
-    result = await db.execute(
-        query.order_by(Report.created_at.desc()).offset(skip).limit(limit)
+    # Count and page, concurrently
+    total, result = await asyncio.gather(
+        scalar_in_new_session(
+            select(func.count(Report.id)).where(Report.processo_id == processo_id)
+        ),
+        db.execute(
+            select(Report).where(Report.processo_id == processo_id)
+            .order_by(Report.created_at.desc()).offset(skip).limit(limit)
+        ),
     )
     reports = result.scalars().all()
 
-    return ReportListResponse(reports=reports, total=total)
+    return ReportListResponse(reports=reports, total=total or 0)
+
 
+async def _build_report(
+    request: ReportGenerateRequest, db: AsyncSession, s3: S3Storage
+) -> tuple[str, str]:
+    """Generate the Excel file, upload it and return (filename, s3_key)."""
+    generator = ExcelGenerator(db)
+    filename, content = await generator.generate(
+        processo_id=request.processo_id,
+        tipo=request.tipo,
+        data_inicio=request.data_inicio,
+        data_fim=request.data_fim,
+        categorias=request.categorias,
+        pagadores=request.pagadores,
+    )
 
-@router.post("/excel", response_model=ReportResponse, status_code=status.HTTP_201_CREATED)
+    s3_key = await s3.upload_file(content, filename, request.processo_id, folder="reports")
+    return filename, s3_key
+
+
+async def generate_report_task(report_id: UUID):
+    """Background task to generate a pending report."""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(Report).where(Report.id == report_id))
+        report = result.scalar_one_or_none()
+        if not report:
+            return
+
+        try:
+            request = ReportGenerateRequest(
+                processo_id=report.processo_id, tipo=report.tipo, **report.parametros
+            )
+            report.arquivo_nome, report.arquivo_s3 = await _build_report(request, db, s3_storage)
+            report.status = "ready"
+        except Exception as e:
+            await db.rollback()
+            report.status = "error"
+            report.error_message = str(e)
+        await db.commit()
+
+
+@router.post("/excel", response_model=ReportResponse, status_code=status.HTTP_202_ACCEPTED)
 async def generate_report(
     request: ReportGenerateRequest,
-    background_tasks: BackgroundTasks,
+    response: Response,
+    sync: bool = False,
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
+    s3: S3Storage = Depends(get_s3),
 ):
     # Verify access
     await get_processo_with_access(request.processo_id, db, current_user)
@@ -89,28 +134,12 @@ async def generate_report(
             detail=f"Tipo invalido. Opcoes: {', '.join(valid_tipos)}",
         )
 
-    # Generate report
-    generator = ExcelGenerator(db)
-    filename, content = await generator.generate(
-        processo_id=request.processo_id,
-        tipo=request.tipo,
-        data_inicio=request.data_inicio,
-        data_fim=request.data_fim,
-        categorias=request.categorias,
-        pagadores=request.pagadores,
-    )
-
-    # Upload to S3
-    s3 = S3Storage()
-    s3_key = await s3.upload_file(content, filename, request.processo_id, folder="reports")
-
-    # Create report record
     report = Report(
         processo_id=request.processo_id,
         user_id=current_user.id,
         tipo=request.tipo,
-        arquivo_s3=s3_key,
-        arquivo_nome=filename,
+        # Provisional name; replaced by the generator's filename when ready
+        arquivo_nome=f"{request.tipo}_{request.processo_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
         parametros={
             "data_inicio": str(request.data_inicio) if request.data_inicio else None,
             "data_fim": str(request.data_fim) if request.data_fim else None,
@@ -118,9 +147,39 @@ async def generate_report(
             "pagadores": request.pagadores,
         },
     )
+
+    if sync:
+        # Small reports: generate inline and return the finished record
+        report.arquivo_nome, report.arquivo_s3 = await _build_report(request, db, s3)
+        report.status = "ready"
+        db.add(report)
+        await db.commit()
+        response.status_code = status.HTTP_201_CREATED
+        return report
+
     db.add(report)
     await db.commit()
-    await db.refresh(report)
+
+    # Generate on the background worker pool; clients poll GET /reports/{id}
+    enqueue(generate_report_task, report.id)
+
+    return report
+
+
+@router.get("/{report_id}", response_model=ReportResponse)
+async def get_report(
+    report_id: UUID,
+    db: AsyncSession = Depends(get_db),
+    current_user: User = Depends(get_current_user),
+):
+    result = await db.execute(select(Report).where(Report.id == report_id))
+    report = result.scalar_one_or_none()
+
+    if not report:
+        raise HTTPException(status_code=404, detail="Relatorio nao encontrado")
+
+    # Verify access
+    await check_processo_access(report.processo_id, db, current_user)
 
     return report
 
@@ -128,8 +187,10 @@ async def generate_report(
 @router.get("/{report_id}/download")
 async def download_report(
     report_id: UUID,
+    format: Optional[str] = None,
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
+    s3: S3Storage = Depends(get_s3),
 ):
     result = await db.execute(select(Report).where(Report.id == report_id))
     report = result.scalar_one_or_none()
@@ -140,8 +201,13 @@ async def download_report(
     # Verify access
     await get_processo_with_access(report.processo_id, db, current_user)
 
+    if report.status != "ready":
+        raise HTTPException(status_code=409, detail="Relatorio ainda nao esta pronto")
+
     # Generate presigned URL
-    s3 = S3Storage()
-    url = await s3.get_presigned_url(report.arquivo_s3)
+    url = await s3.get_presigned_url(report.arquivo_s3, filename=report.arquivo_nome)
 
-    return {"download_url": url, "filename": report.arquivo_nome}
+    # JS clients with bearer auth cannot follow a redirect into a download
+    if format == "json":
+        return {"download_url": url, "filename": report.arquivo_nome}
+    return RedirectResponse(url, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
@@ -1,27 +1,41 @@
+import asyncio
 from uuid import UUID
 
+import orjson
 from fastapi import APIRouter, Depends, HTTPException, status, Request
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
 
-from app.core.database import get_db
+from app.core.database import get_db, AsyncSessionLocal
 from app.models.models import User
-from app.api.deps import get_current_user
-from app.services.telegram_bot import TelegramBot
+from app.api.deps import get_current_user, invalidate_user_cache
+from app.services.telegram_bot import TelegramBot, forget_chat_user
 
 router = APIRouter(prefix="/telegram", tags=["telegram"])
 
 
+# Strong references to in-flight update handlers (the loop only keeps weak ones)
+_update_tasks: set[asyncio.Task] = set()
+
+
+async def _handle_update(data: dict):
+    async with AsyncSessionLocal() as db:
+        try:
+            await TelegramBot(db).handle_update(data)
+        except Exception as e:
+            print(f"Telegram update failed: {e}")
+
+
 @router.post("/webhook")
-async def telegram_webhook(
-    request: Request,
-    db: AsyncSession = Depends(get_db),
-):
-    """Handle incoming Telegram updates."""
-    data = await request.json()
+async def telegram_webhook(request: Request):
+    """Acknowledge incoming Telegram updates and handle them in the background."""
+    data = orjson.loads(await request.body())
 
-    bot = TelegramBot(db)
-    await bot.handle_update(data)
+    # Telegram only needs a prompt 200; RAG/LLM work must not hold the webhook
+    task = asyncio.create_task(_handle_update(data))
+    _update_tasks.add(task)
+    task.add_done_callback(_update_tasks.discard)
 
     return {"ok": True}
 
@@ -42,18 +56,22 @@ async def link_telegram(
             detail="Codigo invalido ou expirado. Use /vincular no bot para gerar um novo.",
         )
 
-    # Check if chat_id already linked to another user
-    existing = await db.execute(
-        select(User).where(User.telegram_chat_id == chat_id, User.id != current_user.id)
-    )
-    if existing.scalar_one_or_none():
+    # Single UPDATE; the unique constraint rejects a chat_id linked to another user
+    try:
+        await db.execute(
+            update(User).where(User.id == current_user.id).values(telegram_chat_id=chat_id)
+        )
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
         raise HTTPException(
             status_code=400,
             detail="Este Telegram ja esta vinculado a outra conta",
         )
-
-    current_user.telegram_chat_id = chat_id
-    await db.commit()
+    invalidate_user_cache(current_user.id)
+    forget_chat_user(chat_id)
+    if current_user.telegram_chat_id is not None:
+        forget_chat_user(current_user.telegram_chat_id)  # previously linked chat
 
     return {"message": "Telegram vinculado com sucesso"}
 
@@ -70,8 +88,11 @@ async def unlink_telegram(
             detail="Nenhum Telegram vinculado",
         )
 
+    chat_id = current_user.telegram_chat_id
     current_user.telegram_chat_id = None
     await db.commit()
+    invalidate_user_cache(current_user.id)
+    forget_chat_user(chat_id)
 
     return {"message": "Telegram desvinculado com sucesso"}
 
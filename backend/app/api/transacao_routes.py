@@ -1,21 +1,44 @@
+import base64
+from datetime import date
 from uuid import UUID
 from typing import Optional
-from decimal import Decimal
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
+from sqlalchemy import select, update, exists, func, and_, or_, true, false, lambda_stmt
 
 from app.core.database import get_db
+from app.core.responses import AppJSONResponse
 from app.models.models import User, Transacao
 from app.schemas.transacao import (
-    TransacaoUpdate, TransacaoResponse, TransacaoListResponse,
-    TransacaoSummaryResponse, TransacaoSummaryItem
+    TransacaoUpdate, TransacaoResponse, TransacaoListResponse, TransacaoSummaryResponse
 )
-from app.api.deps import get_current_user, get_processo_with_access
+from app.api.deps import (
+    get_current_user,
+    get_processo_with_access,
+    get_transacao_with_access,
+    accessible_processo_ids,
+)
+from app.services import transacao_summary
 
 router = APIRouter(prefix="/transacoes", tags=["transacoes"])
 
+# Columns copied straight from ORM rows into list responses
+_RESPONSE_FIELDS = tuple(TransacaoResponse.model_fields)
+
+
+def _encode_cursor(transacao: Transacao) -> str:
+    data = transacao.data.isoformat() if transacao.data else ""
+    return base64.urlsafe_b64encode(f"{data}|{transacao.id}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[Optional[date], UUID]:
+    try:
+        data, transacao_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return (date.fromisoformat(data) if data else None), UUID(transacao_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor invalido")
+
 
 @router.get("", response_model=TransacaoListResponse)
 async def list_transacoes(
@@ -23,35 +46,70 @@ async def list_transacoes(
     categoria: Optional[str] = None,
     pagador: Optional[str] = None,
     revisado: Optional[bool] = None,
-    skip: int = 0,
-    limit: int = 100,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
     # Verify access
     await get_processo_with_access(processo_id, db, current_user)
 
-    query = select(Transacao).where(Transacao.processo_id == processo_id)
+    # lambda_stmt caches the built statement per combination of criteria, so
+    # repeated calls only extract the new parameter values
+    stmt = lambda_stmt(lambda: select(Transacao).where(Transacao.processo_id == processo_id))
 
     if categoria:
-        query = query.where(Transacao.categoria == categoria)
+        stmt += lambda s: s.where(Transacao.categoria == categoria)
     if pagador:
-        query = query.where(Transacao.pagador == pagador)
-    if revisado is not None:
-        query = query.where(Transacao.revisado_humano == revisado)
-
-    # Count
-    count_query = select(func.count()).select_from(query.subquery())
-    count_result = await db.execute(count_query)
-    total = count_result.scalar() or 0
-
-    # Get transacoes
-    result = await db.execute(
-        query.order_by(Transacao.data.desc().nullslast()).offset(skip).limit(limit)
-    )
-    transacoes = result.scalars().all()
-
-    return TransacaoListResponse(transacoes=transacoes, total=total)
+        stmt += lambda s: s.where(Transacao.pagador == pagador)
+    # Literals (not bound parameters) so prepared plans can use idx_transacoes_unreviewed
+    if revisado is True:
+        stmt += lambda s: s.where(Transacao.revisado_humano == true())
+    elif revisado is False:
+        stmt += lambda s: s.where(Transacao.revisado_humano == false())
+
+    if cursor:
+        # Later pages: rows after (data, id) in (data DESC NULLS LAST, id DESC)
+        # order; no total
+        cursor_data, cursor_id = _decode_cursor(cursor)
+        if cursor_data is None:
+            stmt += lambda s: s.where(Transacao.data.is_(None), Transacao.id < cursor_id)
+        else:
+            stmt += lambda s: s.where(or_(
+                Transacao.data < cursor_data,
+                and_(Transacao.data == cursor_data, Transacao.id < cursor_id),
+                Transacao.data.is_(None),
+            ))
+    else:
+        # First page and total in one query (window count over the filtered rows)
+        stmt += lambda s: s.add_columns(func.count().over().label("total"))
+
+    # Keyset pagination on idx_transacoes_processo_data_id; one extra row
+    # tells whether there is a next page
+    fetch = limit + 1
+    stmt += lambda s: s.order_by(Transacao.data.desc().nullslast(), Transacao.id.desc()).limit(fetch)
+
+    result = await db.execute(stmt)
+    if cursor:
+        transacoes = list(result.scalars().all())
+        total = None
+    else:
+        rows = result.all()
+        transacoes = [row.Transacao for row in rows]
+        total = rows[0].total if rows else 0
+
+    next_cursor = None
+    if len(transacoes) > limit:
+        transacoes = transacoes[:limit]
+        next_cursor = _encode_cursor(transacoes[-1])
+
+    # Rows are already typed by SQLAlchemy: serialize them directly instead of
+    # validating every field again (response_model is kept for the OpenAPI schema)
+    return AppJSONResponse({
+        "transacoes": [{f: getattr(t, f) for f in _RESPONSE_FIELDS} for t in transacoes],
+        "total": total,
+        "next_cursor": next_cursor,
+    })
 
 
 @router.get("/summary", response_model=TransacaoSummaryResponse)
@@ -63,62 +121,10 @@ async def get_summary(
     # Verify access
     await get_processo_with_access(processo_id, db, current_user)
 
-    # Summary by categoria
-    cat_result = await db.execute(
-        select(
-            Transacao.categoria,
-            func.sum(Transacao.valor).label("total"),
-            func.count(Transacao.id).label("count"),
-        )
-        .where(Transacao.processo_id == processo_id)
-        .group_by(Transacao.categoria)
-    )
-    by_categoria = [
-        TransacaoSummaryItem(
-            categoria=row.categoria,
-            pagador=None,
-            total=row.total or Decimal(0),
-            count=row.count,
-        )
-        for row in cat_result.all()
-    ]
-
-    # Summary by pagador
-    pag_result = await db.execute(
-        select(
-            Transacao.pagador,
-            func.sum(Transacao.valor).label("total"),
-            func.count(Transacao.id).label("count"),
-        )
-        .where(Transacao.processo_id == processo_id)
-        .group_by(Transacao.pagador)
-    )
-    by_pagador = [
-        TransacaoSummaryItem(
-            categoria=None,
-            pagador=row.pagador,
-            total=row.total or Decimal(0),
-            count=row.count,
-        )
-        for row in pag_result.all()
-    ]
-
-    # Total
-    total_result = await db.execute(
-        select(
-            func.sum(Transacao.valor).label("total"),
-            func.count(Transacao.id).label("count"),
-        )
-        .where(Transacao.processo_id == processo_id)
-    )
-    total_row = total_result.one()
-
-    return TransacaoSummaryResponse(
-        by_categoria=by_categoria,
-        by_pagador=by_pagador,
-        total_geral=total_row.total or Decimal(0),
-        total_transacoes=total_row.count,
-    )
+    # Pre-aggregated per (categoria, pagador) in transacao_summary_mv
+    summary = await transacao_summary.get_summary(processo_id, db)
+    # Built with model_construct from typed rows; skip response_model validation
+    return AppJSONResponse(summary.model_dump())
 
 
 @router.get("/{transacao_id}", response_model=TransacaoResponse)
@@ -127,14 +133,8 @@ async def get_transacao(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    result = await db.execute(select(Transacao).where(Transacao.id == transacao_id))
-    transacao = result.scalar_one_or_none()
-
-    if not transacao:
-        raise HTTPException(status_code=404, detail="Transacao nao encontrada")
-
-    # Verify access
-    await get_processo_with_access(transacao.processo_id, db, current_user)
+    # Transacao and access check in a single query
+    transacao = await get_transacao_with_access(transacao_id, db, current_user)
 
     return transacao
 
@@ -146,26 +146,32 @@ async def update_transacao(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    result = await db.execute(select(Transacao).where(Transacao.id == transacao_id))
+    values = {k: v for k, v in request.model_dump().items() if v is not None}
+    if not values:
+        return await get_transacao_with_access(transacao_id, db, current_user)
+
+    # Access check, write and read-back in one statement
+    result = await db.execute(
+        update(Transacao)
+        .where(
+            Transacao.id == transacao_id,
+            Transacao.processo_id.in_(accessible_processo_ids(current_user.id)),
+        )
+        .values(**values)
+        .returning(Transacao)
+        .execution_options(synchronize_session=False)
+    )
     transacao = result.scalar_one_or_none()
 
-    if not transacao:
+    if transacao is None:
+        if await db.scalar(select(exists().where(Transacao.id == transacao_id))):
+            raise HTTPException(status_code=403, detail="Acesso negado a este processo")
         raise HTTPException(status_code=404, detail="Transacao nao encontrada")
 
-    # Verify access
-    await get_processo_with_access(transacao.processo_id, db, current_user)
-
-    if request.data is not None:
-        transacao.data = request.data
-    if request.pagador is not None:
-        transacao.pagador = request.pagador
-    if request.beneficiario is not None:
-        transacao.beneficiario = request.beneficiario
-    if request.categoria is not None:
-        transacao.categoria = request.categoria
-
     await db.commit()
-    await db.refresh(transacao)
+    # categoria/pagador move the row between summary groups
+    if "categoria" in values or "pagador" in values:
+        transacao_summary.schedule_refresh(transacao.processo_id)
 
     return transacao
 
@@ -176,14 +182,8 @@ async def confirm_transacao(
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user),
 ):
-    result = await db.execute(select(Transacao).where(Transacao.id == transacao_id))
-    transacao = result.scalar_one_or_none()
-
-    if not transacao:
-        raise HTTPException(status_code=404, detail="Transacao nao encontrada")
-
-    # Verify access
-    await get_processo_with_access(transacao.processo_id, db, current_user)
+    # Transacao and access check in a single query
+    transacao = await get_transacao_with_access(transacao_id, db, current_user)
 
     transacao.revisado_humano = True
     transacao.revisado_por = current_user.id
@@ -0,0 +1,22 @@
+from sqlalchemy import Select, select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.database import AsyncSessionLocal
+
+
+async def get_query_count(stmt: Select, db: AsyncSession) -> int:
+    """Count the rows a list query would return (ORDER BY/LIMIT stripped)."""
+    count_stmt = select(func.count()).select_from(
+        stmt.order_by(None).limit(None).offset(None).subquery()
+    )
+    return await db.scalar(count_stmt) or 0
+
+
+async def scalar_in_new_session(stmt: Select):
+    """Run a scalar query on its own pooled connection.
+
+    An AsyncSession cannot run statements concurrently, so use this for the
+    side query when gathering it with work on the request session.
+    """
+    async with AsyncSessionLocal() as db:
+        return await db.scalar(stmt)
@@ -1,3 +1,7 @@
+import asyncio
+
+from pgvector.asyncpg import register_vector
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 
@@ -5,13 +9,34 @@ from app.core.config import get_settings
 
 settings = get_settings()
 
+# asyncpg driver; the async engine uses AsyncAdaptedQueuePool by default
 engine = create_async_engine(
     settings.DATABASE_URL,
     echo=False,
-    pool_size=5,
-    max_overflow=10,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_pre_ping=True,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    # Keep one compiled form per statement shape (lambda_stmt variants included)
+    # so the SQL text, and with it asyncpg's prepared statement, stays stable
+    query_cache_size=settings.DB_QUERY_CACHE_SIZE,
+    # Reuse server-side prepared statements for repeated SQL
+    connect_args={
+        "server_settings": {"jit": "on" if settings.DB_JIT else "off"},
+        "statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE,
+        "prepared_statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE,
+    },
 )
 
+
+@event.listens_for(engine.sync_engine, "connect")
+def _register_vector_codecs(dbapi_connection, connection_record):
+    # vector/halfvec parameters and results use pgvector's binary format:
+    # query embeddings are bound as plain lists (no text round trip)
+    dbapi_connection.run_async(register_vector)
+
+
 AsyncSessionLocal = async_sessionmaker(
     engine,
     class_=AsyncSession,
@@ -21,6 +46,19 @@ AsyncSessionLocal = async_sessionmaker(
 Base = declarative_base()
 
 
+async def warm_pool():
+    """Open pool_size connections at startup so first requests skip connect/auth."""
+    # Connections must be held concurrently, otherwise the pool reuses one
+    conns = await asyncio.gather(
+        *(engine.connect() for _ in range(settings.DB_POOL_SIZE)),
+        return_exceptions=True,
+    )
+    await asyncio.gather(*(c.close() for c in conns if not isinstance(c, BaseException)))
+    for c in conns:
+        if isinstance(c, BaseException):
+            raise c
+
+
 async def get_db():
     async with AsyncSessionLocal() as session:
         try:
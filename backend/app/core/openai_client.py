@@ -0,0 +1,20 @@
+import httpx
+from openai import AsyncOpenAI
+
+from app.core.config import get_settings
+
+settings = get_settings()
+
+# Single client (and HTTP connection pool) shared by the whole app, so calls
+# reuse keep-alive connections to the OpenAI API. Closed on app shutdown.
+openai_client = AsyncOpenAI(
+    api_key=settings.OPENAI_API_KEY,
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=httpx.Timeout(600.0, connect=5.0),
+    ),
+)
+
+
+async def close_openai_client():
+    await openai_client.close()
@@ -0,0 +1,27 @@
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from fastapi.responses import ORJSONResponse
+
+
+def _default(obj: Any) -> Any:
+    # Same representation pydantic uses for Decimal in JSON mode
+    if isinstance(obj, Decimal):
+        return str(obj)
+    raise TypeError
+
+
+class AppJSONResponse(ORJSONResponse):
+    """orjson response that also serializes Decimal (e.g. raw dicts without a response_model).
+
+    UUIDs and datetimes are handled natively by orjson; naive datetimes keep the
+    pydantic format (no "Z" suffix) so every endpoint emits the same timestamps.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            default=_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        )
@@ -1,7 +1,17 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.core.config import get_settings
+from app.core.database import engine, warm_pool
+from app.core.responses import AppJSONResponse
+from app.core.openai_client import close_openai_client
+from app.services.job_queue import start_workers, stop_workers
+from app.services.pdf_pages import shutdown_pool as shutdown_pdf_pool
+from app.services import embedding_batch, embedding_batcher
+from app.services.s3_storage import storage as s3_storage
+from app.services.telegram_bot import close_session as close_telegram_session
 from app.api.auth_routes import router as auth_router
 from app.api.admin_routes import router as admin_router
 from app.api.processo_routes import router as processo_router
@@ -13,25 +23,52 @@ from app.api.telegram_routes import router as telegram_router
 
 settings = get_settings()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        await warm_pool()
+    except Exception as e:
+        print(f"Database pool warm-up failed: {e}")
+    await s3_storage.open()
+    app.state.s3 = s3_storage
+    start_workers(settings.DOCUMENT_WORKERS)
+    try:
+        await embedding_batch.resume_pending()
+    except Exception as e:
+        print(f"Resuming embedding batches failed: {e}")
+    yield
+    await embedding_batch.stop()
+    await embedding_batcher.stop()
+    await stop_workers()
+    shutdown_pdf_pool()
+    await s3_storage.close()
+    await close_telegram_session()
+    await close_openai_client()
+    await engine.dispose()
+
+
 app = FastAPI(
     title="Apoio Processual",
     description="Assistente juridico com RAG para apoio em processos judiciais",
     version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=AppJSONResponse,
 )
 
-# CORS
-origins = [
+# CORS (explicit lists so preflight responses are precomputed; dict dedupes FRONTEND_URL)
+origins = list(dict.fromkeys([
     "http://localhost:3000",
     "http://localhost:5173",
     settings.FRONTEND_URL,
-]
+]))
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
+    allow_headers=["Authorization", "Content-Type"],
 )
 
 # Include routers
@@ -5,9 +5,9 @@ from typing import Optional, List
 
 from sqlalchemy import (
     String, Text, Boolean, Integer, Float, Date, DateTime,
-    ForeignKey, ARRAY, Numeric, BigInteger, Enum as SAEnum
+    ForeignKey, ARRAY, Numeric, BigInteger, Computed, Enum as SAEnum
 )
-from sqlalchemy.dialects.postgresql import UUID, JSONB, ENUM
+from sqlalchemy.dialects.postgresql import UUID, JSONB, ENUM, TSVECTOR
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from pgvector.sqlalchemy import Vector
 
@@ -27,6 +27,15 @@ DocStatusEnum = ENUM(
 )
 
 
+class NativeVector(Vector):
+    """pgvector column bound as is: the asyncpg codec registered in database.py
+    encodes lists/arrays in binary (no text formatting and parsing)."""
+    cache_ok = True
+
+    def bind_processor(self, dialect):
+        return None
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -103,7 +112,13 @@ class Document(Base):
     status: Mapped[str] = mapped_column(DocStatusEnum, default="uploaded")
     metadata_: Mapped[dict] = mapped_column("metadata", JSONB, default=dict)
     texto_extraido: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    texto_tsv: Mapped[Optional[str]] = mapped_column(
+        TSVECTOR,
+        Computed("to_tsvector('portuguese'::regconfig, COALESCE(texto_extraido, ''))", persisted=True),
+        deferred=True,
+    )
     error_message: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    embedding_batch_id: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -118,10 +133,12 @@ class Chunk(Base):
 
     id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     documento_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("documents.id", ondelete="CASCADE"), nullable=False)
+    # Copy of the document's processo_id, so vector search filters chunks directly
+    processo_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("processos.id", ondelete="CASCADE"), nullable=False)
     conteudo: Mapped[str] = mapped_column(Text, nullable=False)
     posicao: Mapped[int] = mapped_column(Integer, nullable=False)
     token_count: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
-    embedding = mapped_column(Vector(1536), nullable=True)
+    embedding = mapped_column(NativeVector(1536), nullable=True)
     metadata_: Mapped[dict] = mapped_column("metadata", JSONB, default=dict)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
@@ -162,13 +179,14 @@ class Conversation(Base):
     user_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
     canal: Mapped[str] = mapped_column(String(20), default="web")
     titulo: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    message_count: Mapped[int] = mapped_column(Integer, default=0)  # maintained by trigger on messages
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     # Relationships
     processo: Mapped["Processo"] = relationship("Processo", back_populates="conversations")
     user: Mapped["User"] = relationship("User", back_populates="conversations")
-    messages: Mapped[List["Message"]] = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
+    messages: Mapped[List["Message"]] = relationship("Message", back_populates="conversation", cascade="all, delete-orphan", order_by="Message.created_at")
 
 
 class Message(Base):
@@ -189,6 +207,25 @@ class Message(Base):
     conversation: Mapped["Conversation"] = relationship("Conversation", back_populates="messages")
 
 
+class ChatCache(Base):
+    __tablename__ = "chat_cache"
+
+    id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    processo_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("processos.id", ondelete="CASCADE"), nullable=False)
+    query_norm: Mapped[str] = mapped_column(Text, nullable=False)
+    embedding = mapped_column(NativeVector(1536), nullable=False)
+    response: Mapped[dict] = mapped_column(JSONB, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class ChunkEmbeddingCache(Base):
+    __tablename__ = "chunk_embedding_cache"
+
+    content_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    embedding = mapped_column(NativeVector(1536), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
 class Evento(Base):
     __tablename__ = "eventos"
 
@@ -217,9 +254,11 @@ class Report(Base):
     processo_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("processos.id", ondelete="CASCADE"), nullable=False)
     user_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
     tipo: Mapped[str] = mapped_column(String(50), nullable=False)
-    arquivo_s3: Mapped[str] = mapped_column(Text, nullable=False)
+    status: Mapped[str] = mapped_column(String(20), default="pending")  # pending, ready, error
+    arquivo_s3: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     arquivo_nome: Mapped[str] = mapped_column(Text, nullable=False)
     parametros: Mapped[dict] = mapped_column(JSONB, default=dict)
+    error_message: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
     # Relationships
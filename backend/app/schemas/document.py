@@ -20,6 +20,19 @@ class DocumentUpdate(BaseModel):
     data_referencia: Optional[date] = None
 
 
+class DocumentBulkUpdateItem(DocumentUpdate):
+    document_id: UUID
+
+
+class DocumentBulkUpdateRequest(BaseModel):
+    processo_id: UUID
+    updates: List[DocumentBulkUpdateItem]
+
+
+class DocumentBulkUpdateResponse(BaseModel):
+    updated: int
+
+
 class DocumentResponse(BaseModel):
     id: UUID
     processo_id: UUID
@@ -18,7 +18,9 @@ class ReportResponse(BaseModel):
     id: UUID
     processo_id: UUID
     tipo: str
+    status: str
     arquivo_nome: str
+    error_message: Optional[str] = None
     created_at: datetime
 
     class Config:
@@ -33,7 +33,8 @@ class TransacaoResponse(BaseModel):
 
 class TransacaoListResponse(BaseModel):
     transacoes: List[TransacaoResponse]
-    total: int
+    total: Optional[int] = None  # only on the first page (no cursor)
+    next_cursor: Optional[str] = None
 
 
 class TransacaoSummaryItem(BaseModel):
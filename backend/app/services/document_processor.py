@@ -1,24 +1,31 @@
+import asyncio
+import io
 import os
 import re
 import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain, islice
 from uuid import UUID
-from typing import Optional
+from typing import BinaryIO, Iterator, Optional, Union
 
 import tiktoken
-import pdfplumber
 import pytesseract
 from PIL import Image
-from openai import AsyncOpenAI
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, insert, update
 
 from app.core.config import get_settings
+from app.core.openai_client import openai_client
 from app.models.models import Document, Chunk, Processo
-from app.services.s3_storage import S3Storage
+from app.services import semantic_cache, embedding_batch, embedding_cache
+from app.services.pdf_pages import extract_pdf_text_parts
+from app.services.s3_storage import storage as s3_storage
 
 settings = get_settings()
-openai_client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
 tokenizer = tiktoken.encoding_for_model("gpt-4o-mini")
+_TOKENIZER_THREADS = os.cpu_count() or 1
 
 
 # ============================================
@@ -26,27 +33,41 @@ tokenizer = tiktoken.encoding_for_model("gpt-4o-mini")
 # ============================================
 
 def extract_text_from_pdf(filepath: str) -> str:
-    text_parts = []
-    with pdfplumber.open(filepath) as pdf:
-        for page in pdf.pages:
-            text = page.extract_text()
-            if text and text.strip():
-                text_parts.append(text)
+    # Page ranges are extracted in a process pool (see pdf_pages)
+    text_parts = extract_pdf_text_parts(filepath, settings.PDF_WORKERS)
 
     # Se pdfplumber não extraiu texto, tentar OCR (PDF escaneado)
     if not text_parts:
-        from pdf2image import convert_from_path
-        images = convert_from_path(filepath, dpi=300)
-        for image in images:
-            ocr_text = pytesseract.image_to_string(image, lang="por")
-            if ocr_text and ocr_text.strip():
-                text_parts.append(ocr_text)
+        text_parts = ocr_pdf(filepath)
 
     return "\n\n".join(text_parts)
 
 
-def extract_text_from_image(filepath: str) -> str:
-    image = Image.open(filepath)
+def ocr_pdf(filepath: str) -> list[str]:
+    """OCR every page of a scanned PDF, several pages at a time.
+
+    Pages are rendered to JPEG files and tesseract reads them by path; each
+    call runs the tesseract binary in a subprocess, so threads are enough.
+    """
+    from pdf2image import convert_from_path
+
+    workers = settings.PDF_WORKERS or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pages = convert_from_path(
+            filepath,
+            dpi=settings.OCR_DPI,
+            output_folder=tmpdir,
+            fmt="jpeg",
+            paths_only=True,
+            thread_count=workers,
+        )
+        with ThreadPoolExecutor(max_workers=min(len(pages), workers) or 1) as executor:
+            texts = executor.map(partial(pytesseract.image_to_string, lang="por"), pages)
+            return [text for text in texts if text and text.strip()]
+
+
+def extract_text_from_image(source: Union[str, BinaryIO]) -> str:
+    image = Image.open(source)
     return pytesseract.image_to_string(image, lang="por")
 
 
@@ -61,130 +82,368 @@ def parse_whatsapp_export(filepath: str) -> str:
         return f.read()
 
 
-async def transcribe_audio(filepath: str) -> str:
-    """Transcribe audio using OpenAI Whisper API."""
-    with open(filepath, "rb") as audio_file:
-        response = await openai_client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_file,
-            language="pt",
-        )
+AUDIO_EXTENSIONS = (".ogg", ".mp3", ".m4a", ".wav")
+
+
+async def transcribe_audio(content: bytes, filename: str) -> str:
+    """Transcribe audio using OpenAI Whisper API (uploaded from memory)."""
+    response = await openai_client.audio.transcriptions.create(
+        model="whisper-1",
+        # The API detects the format from the file name's extension
+        file=(filename, content),
+        language="pt",
+    )
     return response.text
 
 
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_DOCX_RUN_TEXT = {_W + "t", _W + "tab", _W + "br", _W + "cr"}
+
+
+def _docx_paragraph_text(paragraph) -> str:
+    """Text of a <w:p> read from the XML directly (no python-docx Paragraph/Run objects)."""
+    parts = []
+    for el in paragraph.iter(*_DOCX_RUN_TEXT):
+        if el.tag == _W + "t":
+            parts.append(el.text or "")
+        elif el.tag == _W + "tab":
+            parts.append("\t")
+        else:
+            parts.append("\n")
+    return "".join(parts)
+
+
+def _spreadsheet_row_text(row: tuple) -> str:
+    """Cells joined with " | "; empty for rows without any value."""
+    cells = ["" if cell is None else str(cell) for cell in row]
+    # Blank rows would still have the separators: test the cells
+    return " | ".join(cells) if any(c.strip() for c in cells) else ""
+
+
+def _extract_docx(source: Union[str, BinaryIO]) -> str:
+    import docx
+    doc = docx.Document(source)
+    return "\n".join(
+        _docx_paragraph_text(p) for p in doc.element.body.iterchildren(_W + "p")
+    )
+
+
+def _extract_xlsx(source: Union[str, BinaryIO]) -> str:
+    import openpyxl
+    # Streamed rows, cached cell values (not formulas)
+    wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = chain.from_iterable(
+            sheet.iter_rows(values_only=True) for sheet in wb.worksheets
+        )
+        return "\n".join(filter(None, map(_spreadsheet_row_text, rows)))
+    finally:
+        wb.close()
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+
+# Extractors that need a file on disk (pdfplumber workers, pdf2image);
+# everything else is parsed from memory
+PATH_EXTENSIONS = frozenset({".pdf"})
+
+
 def extract_text(filepath: str, mime_type: str, doc_type: str) -> str:
     """Route to appropriate extractor based on file type."""
     ext = os.path.splitext(filepath)[1].lower()
 
     if ext == ".pdf":
         return extract_text_from_pdf(filepath)
-    elif ext in (".png", ".jpg", ".jpeg", ".webp", ".bmp"):
+    elif ext in IMAGE_EXTENSIONS:
         return extract_text_from_image(filepath)
     elif ext in (".txt", ".csv"):
         return extract_text_from_txt(filepath)
     elif ext in (".doc", ".docx"):
-        import docx
-        doc = docx.Document(filepath)
-        return "\n".join([p.text for p in doc.paragraphs])
+        return _extract_docx(filepath)
     elif ext in (".xlsx", ".xls"):
-        import openpyxl
-        wb = openpyxl.load_workbook(filepath)
-        text_parts = []
-        for sheet in wb.worksheets:
-            for row in sheet.iter_rows(values_only=True):
-                row_text = " | ".join(str(cell) if cell else "" for cell in row)
-                if row_text.strip():
-                    text_parts.append(row_text)
-        return "\n".join(text_parts)
+        return _extract_xlsx(filepath)
     else:
         return extract_text_from_txt(filepath)
 
 
+def extract_text_from_bytes(content: bytes, ext: str) -> str:
+    """Extract formats outside PATH_EXTENSIONS straight from the downloaded bytes."""
+    ext = ext.lower()
+    if ext in IMAGE_EXTENSIONS:
+        # PIL decodes from the buffer; tesseract gets the image without a temp file
+        return extract_text_from_image(io.BytesIO(content))
+    elif ext in (".doc", ".docx"):
+        return _extract_docx(io.BytesIO(content))
+    elif ext in (".xlsx", ".xls"):
+        return _extract_xlsx(io.BytesIO(content))
+    # Text: same newline handling as reading the file in text mode
+    text = content.decode("utf-8", errors="ignore")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
 # ============================================
 # CHUNKING
 # ============================================
 
-def count_tokens(text: str) -> int:
-    return len(tokenizer.encode(text))
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?\n])\s+')
 
+# Sentences tokenized per batched (multi-threaded) tokenizer call
+_TOKENIZE_BATCH = 1024
 
-def chunk_text(
-    text: str,
-    chunk_size: int = settings.CHUNK_SIZE,
-    overlap: int = settings.CHUNK_OVERLAP,
-) -> list[dict]:
-    """Split text into overlapping chunks by token count."""
-    sentences = re.split(r'(?<=[.!?\n])\s+', text)
-    chunks = []
-    current_chunk = []
-    current_tokens = 0
 
-    for sentence in sentences:
-        sentence = sentence.strip()
-        if not sentence:
+_INLINE_SPACE_RE = re.compile(r'[^\S\n]+')
+_BLANK_LINES_RE = re.compile(r'\n\s*\n')
+_PAGE_NUMBER_RE = re.compile(r'(p[aá]g(ina)?\.?\s*\d+(\s*(de|/)\s*\d+)?|\d+\s+de\s+\d+)', re.IGNORECASE)
+
+# Short lines repeated more often than this are running headers/footers
+_BOILERPLATE_MAX_REPEATS = 5
+_BOILERPLATE_MAX_LEN = 40
+# Shorter paragraphs may legitimately repeat (e.g. chat replies)
+_DEDUPE_MIN_BLOCK_LEN = 80
+
+# Documents whose transacoes are extracted from the chunks: identical lines
+# there are separate entries (seven "PIX RECEBIDO 500,00" are seven transfers)
+FINANCIAL_TIPOS = ("extrato_bancario", "comprovante")
+
+
+def _strip_boilerplate(text: str, dedupe: bool = True) -> str:
+    """Drop text that only costs tokens: whitespace runs, page numbers,
+    running headers/footers and repeated paragraphs (e.g. the same
+    disclaimer on every scanned page). Line breaks are kept, since they end
+    sentences for the chunker.
+
+    With ``dedupe=False`` (financial documents) repeated lines and paragraphs
+    are kept; only whitespace and page numbers are cleaned up.
+    """
+    lines = [_INLINE_SPACE_RE.sub(" ", line).strip() for line in text.split("\n")]
+    counts = Counter(line for line in lines if line)
+
+    kept = []
+    for line in lines:
+        if line and (
+            _PAGE_NUMBER_RE.fullmatch(line)
+            or (dedupe and counts[line] > _BOILERPLATE_MAX_REPEATS and len(line) < _BOILERPLATE_MAX_LEN)
+        ):
             continue
+        kept.append(line)
 
-        sent_tokens = count_tokens(sentence)
+    seen = set()
+    blocks = []
+    for block in _BLANK_LINES_RE.split("\n".join(kept)):
+        block = block.strip()
+        if not block:
+            continue
+        if dedupe and len(block) >= _DEDUPE_MIN_BLOCK_LEN:
+            key = hash(block)
+            if key in seen:
+                continue
+            seen.add(key)
+        blocks.append(block)
+    return "\n\n".join(blocks)
+
+
+def _iter_sentences(text: str) -> Iterator[str]:
+    """Stripped, non-empty sentences, sliced lazily from the text."""
+    start = 0
+    for match in _SENTENCE_END_RE.finditer(text):
+        sentence = text[start:match.start()].strip()
+        if sentence:
+            yield sentence
+        start = match.end()
+    sentence = text[start:].strip()
+    if sentence:
+        yield sentence
+
+
+def _counted_sentences(text: str) -> Iterator[tuple[str, int]]:
+    """(sentence, token count) pairs, tokenized in batches of _TOKENIZE_BATCH."""
+    sentences = _iter_sentences(text)
+    while batch := list(islice(sentences, _TOKENIZE_BATCH)):
+        token_lists = tokenizer.encode_ordinary_batch(batch, num_threads=_TOKENIZER_THREADS)
+        yield from zip(batch, map(len, token_lists))
+
+
+def _iter_chunk_texts(text: str, chunk_size: int, overlap: int, dedupe: bool = True) -> Iterator[str]:
+    """Overlapping chunk texts of about chunk_size tokens, produced lazily."""
+    text = _strip_boilerplate(text, dedupe)
+    # (sentence, token count) pairs, so overlap backtracking never re-encodes
+    current_chunk: list[tuple[str, int]] = []
+    current_tokens = 0
 
+    for sentence, sent_tokens in _counted_sentences(text):
         if current_tokens + sent_tokens > chunk_size and current_chunk:
-            chunk_text_content = " ".join(current_chunk)
-            chunks.append({
-                "conteudo": chunk_text_content,
-                "token_count": count_tokens(chunk_text_content),
-            })
+            yield " ".join(s for s, _ in current_chunk)
 
-            # Keep last sentences for overlap
+            # Keep last sentences for overlap: walk back from the end with the
+            # stored counts, then slice once
             overlap_tokens = 0
-            overlap_sentences = []
-            for s in reversed(current_chunk):
-                t = count_tokens(s)
-                if overlap_tokens + t > overlap:
-                    break
-                overlap_sentences.insert(0, s)
-                overlap_tokens += t
-
-            current_chunk = overlap_sentences
+            start = len(current_chunk)
+            while start > 0 and overlap_tokens + current_chunk[start - 1][1] <= overlap:
+                start -= 1
+                overlap_tokens += current_chunk[start][1]
+
+            current_chunk = current_chunk[start:]
             current_tokens = overlap_tokens
 
-        current_chunk.append(sentence)
+        current_chunk.append((sentence, sent_tokens))
         current_tokens += sent_tokens
 
     # Last chunk
     if current_chunk:
-        chunk_text_content = " ".join(current_chunk)
-        chunks.append({
-            "conteudo": chunk_text_content,
-            "token_count": count_tokens(chunk_text_content),
-        })
+        yield " ".join(s for s, _ in current_chunk)
 
-    return chunks
+
+def iter_chunk_batches(
+    text: str,
+    batch_size: int,
+    chunk_size: int = settings.CHUNK_SIZE,
+    overlap: int = settings.CHUNK_OVERLAP,
+    dedupe: bool = True,
+) -> Iterator[list[dict]]:
+    """Chunks in lists of up to batch_size, each produced only when requested."""
+    chunk_texts = _iter_chunk_texts(text, chunk_size, overlap, dedupe)
+    while batch := list(islice(chunk_texts, batch_size)):
+        # Exact token counts of the joined chunks, in one batched call
+        token_lists = tokenizer.encode_ordinary_batch(batch, num_threads=_TOKENIZER_THREADS)
+        yield [
+            {"conteudo": content, "token_count": len(ids)}
+            for content, ids in zip(batch, token_lists)
+        ]
+
+
+def chunk_text(
+    text: str,
+    chunk_size: int = settings.CHUNK_SIZE,
+    overlap: int = settings.CHUNK_OVERLAP,
+    dedupe: bool = True,
+) -> list[dict]:
+    """Split text into overlapping chunks by token count."""
+    return list(chain.from_iterable(
+        iter_chunk_batches(text, _TOKENIZE_BATCH, chunk_size, overlap, dedupe)
+    ))
 
 
 # ============================================
 # EMBEDDINGS
 # ============================================
 
+# Embedding requests in flight across all document ingestions (OpenAI rate
+# limits); single-batch calls such as chat queries don't wait behind them
+_embedding_semaphore = asyncio.Semaphore(8)
+
+
+def _create_embeddings(batch: list[str]):
+    return openai_client.embeddings.create(
+        model=settings.EMBEDDING_MODEL,
+        input=batch,
+        dimensions=settings.EMBEDDING_DIMENSIONS,
+    )
+
+
+async def _embed_batch(batch: list[str]):
+    async with _embedding_semaphore:
+        return await _create_embeddings(batch)
+
+
 async def generate_embeddings(texts: list[str]) -> list[list[float]]:
-    """Generate embeddings in batches."""
+    """Generate embeddings in batches, sent concurrently (order preserved)."""
     batch_size = 100
-    all_embeddings = []
-
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i + batch_size]
-        response = await openai_client.embeddings.create(
-            model=settings.EMBEDDING_MODEL,
-            input=batch,
-            dimensions=settings.EMBEDDING_DIMENSIONS,
-        )
-        all_embeddings.extend([item.embedding for item in response.data])
+    if len(texts) <= batch_size:
+        response = await _create_embeddings(texts)
+        return [item.embedding for item in response.data]
 
-    return all_embeddings
+    responses = await asyncio.gather(*(
+        _embed_batch(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)
+    ))
+    return [item.embedding for response in responses for item in response.data]
 
 
 # ============================================
 # FULL PIPELINE
 # ============================================
 
+async def run_financial_analysis(doc: Document, db: AsyncSession):
+    """Extract transacoes from a processed financial document (errors are logged)."""
+    if doc.tipo not in FINANCIAL_TIPOS:
+        return
+    try:
+        from app.services.financial_analyzer import FinancialAnalyzer
+
+        # Fetch processo contexto
+        proc_result = await db.execute(
+            select(Processo).where(Processo.id == doc.processo_id)
+        )
+        processo = proc_result.scalar_one_or_none()
+        processo_contexto = processo.contexto if processo else None
+
+        analyzer = FinancialAnalyzer(db)
+        await analyzer.analyze_document(
+            documento_id=doc.id,
+            processo_id=doc.processo_id,
+            processo_contexto=processo_contexto,
+        )
+    except Exception as e:
+        print(f"Financial analysis failed for document {doc.id}: {e}")
+
+
+# Chunks per pipeline step: enough to keep every concurrent embedding request
+# busy (_embedding_semaphore x 100 texts) while the next batch is chunked
+_PIPELINE_BATCH = 800
+
+
+def _chunk_rows(doc: Document, chunks: list[dict], embeddings: list, first_posicao: int) -> list[dict]:
+    """Parameters for a bulk insert(Chunk) (one multi-row INSERT, no ORM objects)."""
+    metadata = {
+        "doc_tipo": doc.tipo,
+        "doc_titulo": doc.titulo,
+        "participantes": doc.participantes or [],
+        "data_referencia": str(doc.data_referencia) if doc.data_referencia else None,
+    }
+    return [
+        {
+            "documento_id": doc.id,
+            "processo_id": doc.processo_id,
+            "conteudo": chunk_data["conteudo"],
+            "posicao": first_posicao + i,
+            "token_count": chunk_data["token_count"],
+            "embedding": embedding,
+            "metadata_": metadata,
+        }
+        for i, (chunk_data, embedding) in enumerate(zip(chunks, embeddings))
+    ]
+
+
+async def _embed_and_store_chunks(doc: Document, batches: Iterator[list[dict]], db: AsyncSession) -> int:
+    """Embed and insert chunk batches while the next batch is chunked in a thread.
+
+    Only this coroutine touches the session. Returns the number of chunks stored.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+
+    async def produce():
+        try:
+            while batch := await asyncio.to_thread(next, batches, None):
+                await queue.put(batch)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    stored = 0
+    try:
+        while (batch := await queue.get()) is not None:
+            if isinstance(batch, Exception):
+                raise batch
+            # Repeated chunk texts reuse cached embeddings
+            embeddings = await embedding_cache.embed([c["conteudo"] for c in batch], db)
+            await db.execute(insert(Chunk), _chunk_rows(doc, batch, embeddings, stored))
+            stored += len(batch)
+    finally:
+        producer.cancel()
+    return stored
+
+
 async def process_document(document_id: UUID, db: AsyncSession):
     """Full pipeline: download from S3 → extract → chunk → embed → store."""
     result = await db.execute(select(Document).where(Document.id == document_id))
@@ -198,85 +457,84 @@ async def process_document(document_id: UUID, db: AsyncSession):
         await db.commit()
 
         # Download from S3
-        s3 = S3Storage()
-        content = await s3.download_file(doc.arquivo_original)
+        content = await s3_storage.download_file_or_none(doc.arquivo_original)
+        if content is None:
+            raise FileNotFoundError("Arquivo nao encontrado no armazenamento")
 
-        # Save to temp file for processing
         ext = os.path.splitext(doc.arquivo_nome)[1]
-        with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
-            tmp.write(content)
-            tmp_path = tmp.name
+        tmp_path = None
 
         try:
             # 1. Extract text
-            if doc.tipo in ("whatsapp_audio", "audio") and ext.lower() in (
-                ".ogg", ".mp3", ".m4a", ".wav"
-            ):
-                text = await transcribe_audio(tmp_path)
+            if doc.tipo in ("whatsapp_audio", "audio") and ext.lower() in AUDIO_EXTENSIONS:
+                text = await transcribe_audio(content, f"audio{ext.lower()}")
+            elif ext.lower() not in PATH_EXTENSIONS:
+                # Parsed from memory: no temp file round trip
+                text = await asyncio.to_thread(extract_text_from_bytes, content, ext)
             else:
-                text = extract_text(tmp_path, doc.arquivo_mime, doc.tipo)
+                # Save to temp file for processing
+                with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
+                    tmp.write(content)
+                    tmp_path = tmp.name
+
+                # OCR/parsing is CPU-bound; keep it off the event loop
+                text = await asyncio.to_thread(
+                    extract_text, tmp_path, doc.arquivo_mime, doc.tipo
+                )
 
             doc.texto_extraido = text
 
-            # 2. Chunk
-            chunks_data = chunk_text(text)
-            if not chunks_data:
-                doc.status = "processed"
-                await db.commit()
-                return
-
-            # 3. Generate embeddings
-            chunk_texts = [c["conteudo"] for c in chunks_data]
-            embeddings = await generate_embeddings(chunk_texts)
-
-            # 4. Store chunks
-            for i, (chunk_data, embedding) in enumerate(zip(chunks_data, embeddings)):
-                chunk = Chunk(
-                    documento_id=doc.id,
-                    conteudo=chunk_data["conteudo"],
-                    posicao=i,
-                    token_count=chunk_data["token_count"],
-                    embedding=embedding,
-                    metadata_={
-                        "doc_tipo": doc.tipo,
-                        "doc_titulo": doc.titulo,
-                        "participantes": doc.participantes or [],
-                        "data_referencia": str(doc.data_referencia) if doc.data_referencia else None,
-                    },
+            # 2-4. Chunk, embed and store
+            dedupe = doc.tipo not in FINANCIAL_TIPOS
+            if settings.BATCH_API_THRESHOLD > 0:
+                # The chunk count picks the embedding path, so chunk everything first
+                chunks_data = await asyncio.to_thread(chunk_text, text, dedupe=dedupe)
+                if len(chunks_data) > settings.BATCH_API_THRESHOLD:
+                    # Large document: OpenAI Batch API; chunks are stored without
+                    # embeddings and the document stays 'processing' until
+                    # embedding_batch fills them in
+                    await db.execute(
+                        insert(Chunk), _chunk_rows(doc, chunks_data, [None] * len(chunks_data), 0)
+                    )
+                    doc.embedding_batch_id = await embedding_batch.submit(
+                        [c["conteudo"] for c in chunks_data]
+                    )
+                    await db.commit()
+                    embedding_batch.watch(doc.id, doc.embedding_batch_id)
+                    return
+                batches = (
+                    chunks_data[i:i + _PIPELINE_BATCH]
+                    for i in range(0, len(chunks_data), _PIPELINE_BATCH)
                 )
-                db.add(chunk)
+            else:
+                batches = iter_chunk_batches(text, _PIPELINE_BATCH, dedupe=dedupe)
+
+            stored = await _embed_and_store_chunks(doc, batches, db)
 
             doc.status = "processed"
-            await db.commit()
+            if not stored:
+                await db.commit()
+                return
 
-            # Run financial analysis for financial documents
-            if doc.tipo in ("extrato_bancario", "comprovante"):
-                try:
-                    from app.services.financial_analyzer import FinancialAnalyzer
+            # New evidence may change cached answers for this processo
+            await semantic_cache.invalidate(doc.processo_id, db)
+            await db.commit()
 
-                    # Fetch processo contexto
-                    proc_result = await db.execute(
-                        select(Processo).where(Processo.id == doc.processo_id)
-                    )
-                    processo = proc_result.scalar_one_or_none()
-                    processo_contexto = processo.contexto if processo else None
-
-                    analyzer = FinancialAnalyzer(db)
-                    await analyzer.analyze_document(
-                        documento_id=doc.id,
-                        processo_id=doc.processo_id,
-                        processo_contexto=processo_contexto,
-                    )
-                except Exception as e:
-                    print(f"Financial analysis failed for document {doc.id}: {e}")
+            await run_financial_analysis(doc, db)
 
         finally:
             # Clean up temp file
-            if os.path.exists(tmp_path):
+            if tmp_path and os.path.exists(tmp_path):
                 os.unlink(tmp_path)
 
     except Exception as e:
-        doc.status = "error"
-        doc.error_message = str(e)
+        # Discard chunk batches inserted before the failure, then record the
+        # error in its own transaction (the rollback expired doc)
+        await db.rollback()
+        await db.execute(
+            update(Document)
+            .where(Document.id == document_id)
+            .values(status="error", error_message=str(e))
+        )
         await db.commit()
         raise
@@ -0,0 +1,173 @@
+"""OpenAI Batch API embeddings for large documents.
+
+Documents with more than BATCH_API_THRESHOLD chunks store their chunks without
+embeddings and submit a single batch job (half the price of synchronous calls
+and outside the per-minute rate limits, at minutes-to-hours latency). The
+document stays 'processing' with ``embedding_batch_id`` set until a poller
+fills the embeddings in. Pending batches are resumed on startup.
+"""
+import asyncio
+from uuid import UUID
+
+import orjson
+from sqlalchemy import select, update, delete
+
+from app.core.config import get_settings
+from app.core.database import AsyncSessionLocal
+from app.core.openai_client import openai_client
+from app.models.models import Document, Chunk
+from app.services import semantic_cache
+
+settings = get_settings()
+
+# Texts per /v1/embeddings request line (same batching as generate_embeddings)
+LINE_SIZE = 100
+
+_PENDING_STATUSES = ("validating", "in_progress", "finalizing")
+
+_poll_tasks: dict[UUID, asyncio.Task] = {}
+
+
+class BatchOutputError(Exception):
+    """A request inside the batch failed; the document cannot be embedded."""
+
+
+async def submit(texts: list[str]) -> str:
+    """Upload the embedding requests and start a batch job; returns the batch id.
+
+    Each JSONL line embeds LINE_SIZE texts; its custom_id is the position of
+    the first one, so results map back to chunk positions.
+    """
+    lines = [
+        orjson.dumps({
+            "custom_id": str(start),
+            "method": "POST",
+            "url": "/v1/embeddings",
+            "body": {
+                "model": settings.EMBEDDING_MODEL,
+                "input": texts[start:start + LINE_SIZE],
+                "dimensions": settings.EMBEDDING_DIMENSIONS,
+            },
+        })
+        for start in range(0, len(texts), LINE_SIZE)
+    ]
+    batch_file = await openai_client.files.create(
+        file=("embeddings.jsonl", b"\n".join(lines)),
+        purpose="batch",
+    )
+    batch = await openai_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/embeddings",
+        completion_window="24h",
+    )
+    return batch.id
+
+
+def watch(document_id: UUID, batch_id: str) -> None:
+    """Poll the batch in the background and store its embeddings when done."""
+    task = _poll_tasks.get(document_id)
+    if task is None or task.done():
+        _poll_tasks[document_id] = asyncio.create_task(_poll(document_id, batch_id))
+
+
+async def resume_pending() -> None:
+    """Watch batches submitted before the last restart."""
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            select(Document.id, Document.embedding_batch_id).where(
+                Document.embedding_batch_id.is_not(None)
+            )
+        )
+        for document_id, batch_id in result:
+            watch(document_id, batch_id)
+
+
+async def stop() -> None:
+    for task in _poll_tasks.values():
+        task.cancel()
+    await asyncio.gather(*_poll_tasks.values(), return_exceptions=True)
+    _poll_tasks.clear()
+
+
+def _parse_output(content: bytes) -> dict[int, list[float]]:
+    embeddings = {}
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        record = orjson.loads(line)
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            raise BatchOutputError(f"Falha no lote {record.get('custom_id')}: {record.get('error')}")
+        start = int(record["custom_id"])
+        for item in response["body"]["data"]:
+            embeddings[start + item["index"]] = item["embedding"]
+    return embeddings
+
+
+async def _poll(document_id: UUID, batch_id: str) -> None:
+    try:
+        while True:
+            await asyncio.sleep(settings.BATCH_POLL_INTERVAL)
+            try:
+                batch = await openai_client.batches.retrieve(batch_id)
+                if batch.status in _PENDING_STATUSES:
+                    continue
+                if batch.status == "completed" and batch.output_file_id:
+                    output = await openai_client.files.content(batch.output_file_id)
+                    await _store(document_id, batch_id, _parse_output(output.content))
+                else:
+                    await _fail(document_id, batch_id, f"Batch de embeddings {batch.status}")
+                return
+            except BatchOutputError as e:
+                await _fail(document_id, batch_id, str(e))
+                return
+            except Exception as e:
+                # Transient API/database errors: try again on the next tick
+                print(f"Embedding batch {batch_id} poll failed: {e}")
+    finally:
+        _poll_tasks.pop(document_id, None)
+
+
+async def _store(document_id: UUID, batch_id: str, embeddings: dict[int, list[float]]) -> None:
+    from app.services.document_processor import run_financial_analysis
+
+    async with AsyncSessionLocal() as db:
+        doc = await db.get(Document, document_id)
+        if doc is None or doc.embedding_batch_id != batch_id:
+            return  # deleted or resubmitted meanwhile
+
+        result = await db.execute(
+            select(Chunk.id, Chunk.posicao).where(Chunk.documento_id == document_id)
+        )
+        # ORM bulk UPDATE by primary key (executemany)
+        params = [
+            {"id": chunk_id, "embedding": embeddings[posicao]}
+            for chunk_id, posicao in result
+            if posicao in embeddings
+        ]
+        if params:
+            await db.execute(update(Chunk), params)
+
+        doc.status = "processed"
+        doc.embedding_batch_id = None
+        # New evidence may change cached answers for this processo
+        await semantic_cache.invalidate(doc.processo_id, db)
+        await db.commit()
+
+        await run_financial_analysis(doc, db)
+
+
+async def _fail(document_id: UUID, batch_id: str, message: str) -> None:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            update(Document)
+            .where(Document.id == document_id, Document.embedding_batch_id == batch_id)
+            .values(status="error", error_message=message, embedding_batch_id=None)
+            .returning(Document.id)
+        )
+        if result.scalar_one_or_none() is not None:
+            # The chunks stored for this batch will never get embeddings
+            await db.execute(
+                delete(Chunk).where(Chunk.documento_id == document_id, Chunk.embedding.is_(None))
+            )
+        await db.commit()
@@ -0,0 +1,79 @@
+"""Micro-batching of single-text embedding requests.
+
+Chat queries are embedded one at a time. Under concurrent load, requests
+arriving within WINDOW_SECONDS of each other are sent as one embeddings call
+(up to MAX_BATCH texts), so the per-request API round trip is shared.
+"""
+import asyncio
+from typing import Optional
+
+from app.core.config import get_settings
+from app.core.openai_client import openai_client
+
+settings = get_settings()
+
+WINDOW_SECONDS = 0.02
+MAX_BATCH = 64
+
+_queue: Optional[asyncio.Queue] = None
+_collector: Optional[asyncio.Task] = None
+_flush_tasks: set[asyncio.Task] = set()
+
+
+async def embed(text: str) -> list[float]:
+    """Embedding of ``text``, sent together with other texts waiting at the same time."""
+    global _queue, _collector
+    if _collector is None or _collector.done():
+        _queue = asyncio.Queue()
+        _collector = asyncio.create_task(_collect())
+    future = asyncio.get_running_loop().create_future()
+    _queue.put_nowait((text, future))
+    return await future
+
+
+async def stop() -> None:
+    global _collector
+    tasks = list(_flush_tasks)
+    if _collector is not None:
+        tasks.append(_collector)
+        _collector = None
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _collect() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await _queue.get()]
+        deadline = loop.time() + WINDOW_SECONDS
+        while len(items) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Send without blocking the next window
+        task = asyncio.create_task(_flush(items))
+        _flush_tasks.add(task)
+        task.add_done_callback(_flush_tasks.discard)
+
+
+async def _flush(items: list[tuple[str, asyncio.Future]]) -> None:
+    try:
+        response = await openai_client.embeddings.create(
+            model=settings.EMBEDDING_MODEL,
+            input=[text for text, _ in items],
+            dimensions=settings.EMBEDDING_DIMENSIONS,
+        )
+    except Exception as e:
+        for _, future in items:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for item in response.data:
+        future = items[item.index][1]
+        if not future.done():  # caller may have been cancelled
+            future.set_result(item.embedding)
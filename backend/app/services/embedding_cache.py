@@ -0,0 +1,53 @@
+"""Embedding cache keyed by chunk content.
+
+Chunks repeated within or across documents (re-uploads, boilerplate, forwarded
+WhatsApp messages) reuse a stored embedding instead of paying for another
+OpenAI call. The key hashes the embedding model and dimensions with the text,
+so changing either setting never returns stale vectors.
+"""
+import hashlib
+
+from sqlalchemy import any_, bindparam, select
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.types import Text
+
+from app.core.config import get_settings
+from app.models.models import ChunkEmbeddingCache
+
+settings = get_settings()
+
+
+def content_hash(text: str) -> str:
+    key = f"{settings.EMBEDDING_MODEL}:{settings.EMBEDDING_DIMENSIONS}:{text}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+async def embed(texts: list[str], db: AsyncSession) -> list:
+    """Embeddings for ``texts`` (in order), computing only the uncached ones.
+
+    New embeddings are upserted in the caller's transaction.
+    """
+    from app.services.document_processor import generate_embeddings
+
+    hashes = [content_hash(t) for t in texts]
+    result = await db.execute(
+        select(ChunkEmbeddingCache.content_hash, ChunkEmbeddingCache.embedding).where(
+            ChunkEmbeddingCache.content_hash == any_(bindparam("hashes", type_=ARRAY(Text)))
+        ),
+        {"hashes": list(set(hashes))},
+    )
+    cached = dict(result.all())
+
+    # Each distinct missing text is embedded once
+    missing = {h: t for h, t in zip(hashes, texts) if h not in cached}
+    if missing:
+        embeddings = await generate_embeddings(list(missing.values()))
+        computed = dict(zip(missing.keys(), embeddings))
+        await db.execute(
+            insert(ChunkEmbeddingCache).on_conflict_do_nothing(index_elements=["content_hash"]),
+            [{"content_hash": h, "embedding": e} for h, e in computed.items()],
+        )
+        cached.update(computed)
+
+    return [cached[h] for h in hashes]
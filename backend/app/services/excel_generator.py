@@ -1,9 +1,10 @@
 import io
 from uuid import UUID
 from datetime import date, datetime
-from typing import Optional, List
+from typing import Any, Optional, List
 
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -38,39 +39,57 @@ class ExcelGenerator:
         else:
             raise ValueError(f"Tipo de relatorio invalido: {tipo}")
 
-    def _create_workbook(self, title: str) -> Workbook:
-        """Create a styled workbook."""
-        wb = Workbook()
-        ws = wb.active
-        ws.title = title[:31]  # Excel limit
-
-        return wb
-
-    def _style_header(self, ws, row: int, columns: List[str]):
-        """Style header row."""
+    def _create_workbook(self, title: str) -> tuple[Workbook, Any]:
+        """Create a write-only workbook (rows are streamed, not kept as cells)."""
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(title[:31])  # Excel limit
+        return wb, ws
+
+    def _cell(self, ws, value, font: Optional[Font] = None) -> WriteOnlyCell:
+        cell = WriteOnlyCell(ws, value=value)
+        if font is not None:
+            cell.font = font
+        return cell
+
+    def _title_row(self, ws, title: str, span: str) -> list[WriteOnlyCell]:
+        """Bold, centered title merged over ``span`` (e.g. "A1:H1")."""
+        cell = self._cell(ws, title, Font(bold=True, size=14))
+        cell.alignment = Alignment(horizontal="center")
+        ws.merged_cells.add(span)
+        return [cell]
+
+    def _header_row(self, ws, columns: List[str]) -> list[WriteOnlyCell]:
+        """Styled header cells."""
         header_font = Font(bold=True, color="FFFFFF")
         header_fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
         header_alignment = Alignment(horizontal="center", vertical="center")
 
-        for col, value in enumerate(columns, 1):
-            cell = ws.cell(row=row, column=col, value=value)
-            cell.font = header_font
+        cells = []
+        for value in columns:
+            cell = self._cell(ws, value, header_font)
             cell.fill = header_fill
             cell.alignment = header_alignment
-
-    def _auto_width(self, ws):
-        """Auto-adjust column widths."""
-        for column in ws.columns:
-            max_length = 0
-            column_letter = get_column_letter(column[0].column)
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws.column_dimensions[column_letter].width = adjusted_width
+            cells.append(cell)
+        return cells
+
+    def _set_widths(self, ws, columns: List[str], rows: List[list]):
+        """Column widths from the longest header/value, capped at 50.
+
+        Write-only sheets emit column widths before the first row, so this
+        runs over the prepared rows before anything is appended.
+        """
+        widths = [len(c) for c in columns]
+        for row in rows:
+            for i, value in enumerate(row):
+                if value is not None:
+                    widths[i] = max(widths[i], len(str(value)))
+        for i, width in enumerate(widths, 1):
+            ws.column_dimensions[get_column_letter(i)].width = min(width + 2, 50)
+
+    def _save(self, wb: Workbook) -> bytes:
+        output = io.BytesIO()
+        wb.save(output)
+        return output.getvalue()
 
     async def _generate_transacoes(
         self,
@@ -104,51 +123,47 @@ class ExcelGenerator:
         result = await self.db.execute(query)
         transacoes = result.scalars().all()
 
-        # Create workbook
-        wb = self._create_workbook("Transacoes")
-        ws = wb.active
-
-        # Title
-        ws.merge_cells("A1:H1")
-        ws["A1"] = f"Relatorio de Transacoes - {processo.titulo}"
-        ws["A1"].font = Font(bold=True, size=14)
-        ws["A1"].alignment = Alignment(horizontal="center")
-
-        # Metadata
-        ws["A2"] = f"Gerado em: {datetime.now().strftime('%d/%m/%Y %H:%M')}"
-        ws["A3"] = f"Periodo: {data_inicio or 'Inicio'} a {data_fim or 'Fim'}"
-
-        # Headers
         columns = ["Data", "Descricao", "Valor", "Pagador", "Beneficiario", "Categoria", "Confianca", "Revisado"]
-        self._style_header(ws, 5, columns)
-
-        # Data
-        for row, trans in enumerate(transacoes, 6):
-            ws.cell(row=row, column=1, value=str(trans.data) if trans.data else "")
-            ws.cell(row=row, column=2, value=trans.descricao)
-            ws.cell(row=row, column=3, value=float(trans.valor) if trans.valor else 0)
-            ws.cell(row=row, column=4, value=trans.pagador or "")
-            ws.cell(row=row, column=5, value=trans.beneficiario or "")
-            ws.cell(row=row, column=6, value=trans.categoria or "")
-            ws.cell(row=row, column=7, value=f"{trans.confianca:.0%}" if trans.confianca else "")
-            ws.cell(row=row, column=8, value="Sim" if trans.revisado_humano else "Nao")
+        rows = [
+            [
+                str(trans.data) if trans.data else "",
+                trans.descricao,
+                float(trans.valor) if trans.valor else 0,
+                trans.pagador or "",
+                trans.beneficiario or "",
+                trans.categoria or "",
+                f"{trans.confianca:.0%}" if trans.confianca else "",
+                "Sim" if trans.revisado_humano else "Nao",
+            ]
+            for trans in transacoes
+        ]
 
-        # Summary row
-        summary_row = len(transacoes) + 7
-        ws.cell(row=summary_row, column=1, value="TOTAL")
-        ws.cell(row=summary_row, column=1).font = Font(bold=True)
-        ws.cell(row=summary_row, column=3, value=sum(float(t.valor or 0) for t in transacoes))
-        ws.cell(row=summary_row, column=3).font = Font(bold=True)
+        # Create workbook
+        wb, ws = self._create_workbook("Transacoes")
+        self._set_widths(ws, columns, rows)
+
+        # Title and metadata
+        ws.append(self._title_row(ws, f"Relatorio de Transacoes - {processo.titulo}", "A1:H1"))
+        ws.append([f"Gerado em: {datetime.now().strftime('%d/%m/%Y %H:%M')}"])
+        ws.append([f"Periodo: {data_inicio or 'Inicio'} a {data_fim or 'Fim'}"])
+        ws.append([])
+
+        # Headers and data (total accumulated while streaming the rows)
+        ws.append(self._header_row(ws, columns))
+        total = 0.0
+        for row in rows:
+            ws.append(row)
+            total += row[2]
 
-        self._auto_width(ws)
+        # Summary row
+        bold = Font(bold=True)
+        ws.append([])
+        ws.append([self._cell(ws, "TOTAL", bold), None, self._cell(ws, total, bold)])
 
-        # Save to bytes
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
+        content = self._save(wb)
 
         filename = f"transacoes_{processo_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        return filename, output.getvalue()
+        return filename, content
 
     async def _generate_timeline(
         self,
@@ -176,37 +191,36 @@ class ExcelGenerator:
         result = await self.db.execute(query)
         eventos = result.scalars().all()
 
+        columns = ["Data", "Tipo", "Descricao", "Importancia", "Evidencia", "Confianca"]
+        rows = [
+            [
+                str(evento.data),
+                evento.tipo or "",
+                evento.descricao,
+                evento.importancia,
+                (evento.trecho_evidencia or "")[:100],
+                f"{evento.confianca:.0%}" if evento.confianca else "",
+            ]
+            for evento in eventos
+        ]
+
         # Create workbook
-        wb = self._create_workbook("Timeline")
-        ws = wb.active
+        wb, ws = self._create_workbook("Timeline")
+        self._set_widths(ws, columns, rows)
 
         # Title
-        ws.merge_cells("A1:F1")
-        ws["A1"] = f"Timeline de Eventos - {processo.titulo}"
-        ws["A1"].font = Font(bold=True, size=14)
-        ws["A1"].alignment = Alignment(horizontal="center")
-
-        # Headers
-        columns = ["Data", "Tipo", "Descricao", "Importancia", "Evidencia", "Confianca"]
-        self._style_header(ws, 3, columns)
+        ws.append(self._title_row(ws, f"Timeline de Eventos - {processo.titulo}", "A1:F1"))
+        ws.append([])
 
-        # Data
-        for row, evento in enumerate(eventos, 4):
-            ws.cell(row=row, column=1, value=str(evento.data))
-            ws.cell(row=row, column=2, value=evento.tipo or "")
-            ws.cell(row=row, column=3, value=evento.descricao)
-            ws.cell(row=row, column=4, value=evento.importancia)
-            ws.cell(row=row, column=5, value=(evento.trecho_evidencia or "")[:100])
-            ws.cell(row=row, column=6, value=f"{evento.confianca:.0%}" if evento.confianca else "")
+        # Headers and data
+        ws.append(self._header_row(ws, columns))
+        for row in rows:
+            ws.append(row)
 
-        self._auto_width(ws)
-
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
+        content = self._save(wb)
 
         filename = f"timeline_{processo_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        return filename, output.getvalue()
+        return filename, content
 
     async def _generate_evidencias(
         self,
@@ -234,35 +248,34 @@ class ExcelGenerator:
         result = await self.db.execute(query)
         documents = result.scalars().all()
 
+        columns = ["Data Ref", "Tipo", "Titulo", "Descricao", "Participantes", "Arquivo", "Texto Extraido (resumo)"]
+        rows = [
+            [
+                str(doc.data_referencia) if doc.data_referencia else "",
+                doc.tipo,
+                doc.titulo,
+                doc.descricao or "",
+                ", ".join(doc.participantes) if doc.participantes else "",
+                doc.arquivo_nome,
+                (doc.texto_extraido or "")[:200] + "..." if doc.texto_extraido and len(doc.texto_extraido) > 200 else doc.texto_extraido or "",
+            ]
+            for doc in documents
+        ]
+
         # Create workbook
-        wb = self._create_workbook("Evidencias")
-        ws = wb.active
+        wb, ws = self._create_workbook("Evidencias")
+        self._set_widths(ws, columns, rows)
 
         # Title
-        ws.merge_cells("A1:G1")
-        ws["A1"] = f"Relatorio de Evidencias - {processo.titulo}"
-        ws["A1"].font = Font(bold=True, size=14)
-        ws["A1"].alignment = Alignment(horizontal="center")
-
-        # Headers
-        columns = ["Data Ref", "Tipo", "Titulo", "Descricao", "Participantes", "Arquivo", "Texto Extraido (resumo)"]
-        self._style_header(ws, 3, columns)
+        ws.append(self._title_row(ws, f"Relatorio de Evidencias - {processo.titulo}", "A1:G1"))
+        ws.append([])
 
-        # Data
-        for row, doc in enumerate(documents, 4):
-            ws.cell(row=row, column=1, value=str(doc.data_referencia) if doc.data_referencia else "")
-            ws.cell(row=row, column=2, value=doc.tipo)
-            ws.cell(row=row, column=3, value=doc.titulo)
-            ws.cell(row=row, column=4, value=doc.descricao or "")
-            ws.cell(row=row, column=5, value=", ".join(doc.participantes) if doc.participantes else "")
-            ws.cell(row=row, column=6, value=doc.arquivo_nome)
-            ws.cell(row=row, column=7, value=(doc.texto_extraido or "")[:200] + "..." if doc.texto_extraido and len(doc.texto_extraido) > 200 else doc.texto_extraido or "")
+        # Headers and data
+        ws.append(self._header_row(ws, columns))
+        for row in rows:
+            ws.append(row)
 
-        self._auto_width(ws)
-
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
+        content = self._save(wb)
 
         filename = f"evidencias_{processo_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        return filename, output.getvalue()
+        return filename, content
@@ -1,17 +1,19 @@
+import asyncio
 import re
+from itertools import chain
 from uuid import UUID
 from datetime import date
 from decimal import Decimal
 from typing import Optional, List
 
-from openai import AsyncOpenAI
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.config import get_settings
+from app.core.openai_client import openai_client
 from app.models.models import Transacao, Chunk
+from app.services import transacao_summary
 
 settings = get_settings()
-openai_client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
 
 
 def extract_message_content(message) -> str:
@@ -157,16 +159,24 @@ class FinancialAnalyzer:
         )
         chunks = result.scalars().all()
 
-        all_transacoes = []
-        for chunk in chunks:
-            transacoes = await self.extract_transactions_from_chunk(chunk, processo_id, processo_contexto=processo_contexto)
-            all_transacoes.extend(transacoes)
+        # Chunks are independent: extract them concurrently, bounded to stay
+        # under the API rate limits (results keep chunk order)
+        semaphore = asyncio.Semaphore(settings.LLM_CONCURRENCY or 5)
 
-        # Save to database
+        async def _one(chunk: Chunk) -> List[Transacao]:
+            async with semaphore:
+                return await self.extract_transactions_from_chunk(chunk, processo_id, processo_contexto=processo_contexto)
+
+        results = await asyncio.gather(*(_one(c) for c in chunks))
+        all_transacoes = list(chain.from_iterable(results))
+
+        # Save to database (session is only touched here, after all calls finish)
         for t in all_transacoes:
             self.db.add(t)
 
         await self.db.commit()
+        if all_transacoes:
+            transacao_summary.schedule_refresh()
 
         return all_transacoes
 
@@ -210,6 +220,7 @@ Responda com um JSON no formato:
             transacao.confianca = float(result.get("confianca", 0.5))
 
             await self.db.commit()
+            transacao_summary.schedule_refresh()
 
         except Exception as e:
             print(f"Error categorizing transaction: {e}")
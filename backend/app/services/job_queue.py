@@ -0,0 +1,39 @@
+"""In-process background job queue.
+
+Jobs run on a fixed pool of worker tasks started with the application, so
+heavy document processing is bounded and runs apart from request handling.
+CPU-bound steps inside jobs should still use ``asyncio.to_thread``.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable
+
+_queue: asyncio.Queue = asyncio.Queue()
+_workers: list[asyncio.Task] = []
+
+
+async def _worker() -> None:
+    while True:
+        func, args = await _queue.get()
+        try:
+            await func(*args)
+        except Exception as e:
+            print(f"Background job {func.__name__} failed: {e}")
+        finally:
+            _queue.task_done()
+
+
+def enqueue(func: Callable[..., Awaitable[Any]], *args: Any) -> None:
+    """Schedule ``func(*args)`` on the worker pool."""
+    _queue.put_nowait((func, args))
+
+
+def start_workers(count: int) -> None:
+    for _ in range(count - len(_workers)):
+        _workers.append(asyncio.create_task(_worker()))
+
+
+async def stop_workers() -> None:
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
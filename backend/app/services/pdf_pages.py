@@ -0,0 +1,70 @@
+"""PDF text extraction by page range, fanned out over worker processes.
+
+pdfplumber layout analysis is pure-Python and CPU-bound, so pages are split
+into ranges and extracted in a process pool. This module avoids app imports:
+spawned workers only need pdfplumber.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import pdfplumber
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def extract_pages(filepath: str, start: int, end: int) -> list[str]:
+    """Non-empty page texts for pages [start, end), in order."""
+    text_parts = []
+    with pdfplumber.open(filepath) as pdf:
+        for page in pdf.pages[start:end]:
+            text = page.extract_text()
+            if text and text.strip():
+                text_parts.append(text)
+    return text_parts
+
+
+def batch_size(page_count: int, workers: int) -> int:
+    """Pages per task: small batches for short PDFs, one range per worker for long ones."""
+    if page_count <= 10:
+        return 5
+    if page_count <= 50:
+        return 10
+    return min(200, -(-page_count // workers))
+
+
+def get_pool(max_workers: int) -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: don't fork the event loop and its threads into the workers
+        _pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+
+def shutdown_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def extract_pdf_text_parts(filepath: str, max_workers: int = 0) -> list[str]:
+    """Page texts of the whole PDF, extracted in parallel when it has several batches."""
+    workers = max_workers or os.cpu_count() or 1
+    with pdfplumber.open(filepath) as pdf:
+        page_count = len(pdf.pages)
+
+    step = batch_size(page_count, workers)
+    if page_count <= step or workers == 1:
+        return extract_pages(filepath, 0, page_count)
+
+    pool = get_pool(workers)
+    futures = [
+        pool.submit(extract_pages, filepath, start, start + step)
+        for start in range(0, page_count, step)
+    ]
+    return [text for future in futures for text in future.result()]
@@ -1,16 +1,34 @@
-import json
+import time
+from itertools import islice
 from uuid import UUID
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional
 
-from openai import AsyncOpenAI
+from cachetools import LRUCache, TTLCache
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import JSONB
 
 from app.core.config import get_settings
-from app.services.document_processor import generate_embeddings
+from app.core.openai_client import openai_client
+from app.services import embedding_batcher
 
 settings = get_settings()
-openai_client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+
+# Previous messages of the conversation sent to the LLM
+HISTORY_MESSAGES = 10
+
+# Streamed tokens are sent in batches of up to this long / this many characters
+TOKEN_FLUSH_SECONDS = 0.05
+TOKEN_FLUSH_CHARS = 64
+
+# Candidates fetched from the halfvec index per result, before the exact rerank
+RERANK_FACTOR = 10
+
+# Recent query embeddings (same question asked again, retries)
+_query_embedding_cache: LRUCache = LRUCache(maxsize=1024)
+
+# Planner estimate of the chunk count, refreshed every few minutes
+_vector_count_cache: TTLCache = TTLCache(maxsize=1, ttl=600)
 
 SYSTEM_PROMPT = """Voce e um assistente juridico especializado em direito de familia brasileiro.
 Seu papel e ajudar a analisar documentos, conversas e evidencias relacionadas a processos judiciais.
@@ -44,95 +62,134 @@ Ao responder, use o formato:
 [Fonte: nome do documento, data] para cada citacao."""
 
 
-def _format_sse(event: str, data: dict) -> str:
-    """Format a Server-Sent Event."""
-    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+# Per transaction: search width, and iterative scans (pgvector >= 0.8) so an
+# HNSW scan filtered to one processo keeps going until it has enough rows;
+# relaxed order is fine since the candidates are reranked exactly
+_SQL_SET_EF_SEARCH = text(
+    "SELECT set_config('hnsw.ef_search', :ef_search, true), "
+    "set_config('hnsw.iterative_scan', 'relaxed_order', true)"
+)
+
+# reltuples is -1 until the table is first analyzed
+_SQL_CHUNK_COUNT = text("SELECT reltuples::bigint FROM pg_class WHERE oid = 'chunks'::regclass")
+
+# Stage 1 takes the candidates from the half-precision HNSW index; stage 2
+# reranks them by exact fp32 cosine distance and applies the similarity
+# threshold. Result dicts are built by Postgres as a single JSON array, decoded
+# once (no per-row mapping in Python). Built once at import: the SQL text, and
+# with it asyncpg's prepared statement, is the same on every call.
+_SEARCH_SQL = """
+    WITH candidates AS (
+        SELECT c.id
+        FROM chunks c
+        JOIN documents d ON c.documento_id = d.id
+        WHERE d.status = 'processed'
+          {processo_filter}
+        ORDER BY c.embedding::halfvec(1536) <=> CAST(CAST(:embedding AS vector) AS halfvec(1536))
+        LIMIT :candidates
+    ),
+    ranked AS (
+        SELECT
+            c.id,
+            c.conteudo,
+            c.documento_id,
+            d.titulo as doc_titulo,
+            d.tipo as doc_tipo,
+            d.participantes,
+            d.data_referencia,
+            1 - (c.embedding <=> CAST(:embedding AS vector)) as similarity
+        FROM candidates
+        JOIN chunks c ON c.id = candidates.id
+        JOIN documents d ON c.documento_id = d.id
+        WHERE 1 - (c.embedding <=> CAST(:embedding AS vector)) >= :threshold
+        ORDER BY c.embedding <=> CAST(:embedding AS vector)
+        LIMIT :top_k
+    )
+    SELECT COALESCE(jsonb_agg(jsonb_build_object(
+        'id', id::text,
+        'conteudo', conteudo,
+        'documento_id', documento_id::text,
+        'doc_titulo', doc_titulo,
+        'doc_tipo', doc_tipo,
+        'participantes', participantes,
+        'data_referencia', data_referencia::text,
+        'similarity', similarity
+    ) ORDER BY similarity DESC), '[]'::jsonb) AS chunks
+    FROM ranked
+"""
+
+_SQL_SEARCH_WITH_PROCESSO = text(
+    _SEARCH_SQL.format(processo_filter="AND c.processo_id = :processo_id")
+).columns(chunks=JSONB)
+_SQL_SEARCH_ALL = text(_SEARCH_SQL.format(processo_filter="")).columns(chunks=JSONB)
+
+
+def configure_hnsw_params(vector_count: int) -> int:
+    """hnsw.ef_search for the chunks index: larger graphs need a wider search to keep recall."""
+    if vector_count < 100_000:
+        return 40
+    if vector_count < 1_000_000:
+        return 100
+    return 200
+
+
+async def _chunk_vector_count(db: AsyncSession) -> int:
+    count = _vector_count_cache.get("chunks")
+    if count is None:
+        count = max(await db.scalar(_SQL_CHUNK_COUNT) or 0, 0)
+        _vector_count_cache["chunks"] = count
+    return count
+
+
+async def embed_query(query: str) -> list[float]:
+    """Embedding of a user query; exact repeats are served from memory."""
+    embedding = _query_embedding_cache.get(query)
+    if embedding is None:
+        # Concurrent queries share one embeddings call
+        embedding = await embedding_batcher.embed(query)
+        _query_embedding_cache[query] = embedding
+    return embedding
 
 
 async def search_similar_chunks(
-    query: str,
+    query_embedding: list[float],
     db: AsyncSession,
     processo_id: UUID = None,
     top_k: int = settings.SIMILARITY_TOP_K,
 ) -> list[dict]:
     """Search for similar chunks using pgvector cosine similarity."""
-    # Generate query embedding
-    embeddings = await generate_embeddings([query])
-    query_embedding = embeddings[0]
-
-    # Set probes for better IVFFlat accuracy (ignored if using HNSW)
-    await db.execute(text("SET ivfflat.probes = 10"))
-
-    # Build query with similarity threshold filter
+    # Stage 1 takes RERANK_FACTOR x top_k candidates from the half-precision
+    # HNSW index; the graph can only return up to ef_search of them
+    candidates = top_k * RERANK_FACTOR
+    ef_search = max(configure_hnsw_params(await _chunk_vector_count(db)), candidates)
+    # HNSW search width for this transaction only (same transaction as the SELECT)
+    await db.execute(_SQL_SET_EF_SEARCH, {"ef_search": str(ef_search)})
+
+    sql = _SQL_SEARCH_WITH_PROCESSO if processo_id else _SQL_SEARCH_ALL
+    params = {
+        # Bound as a binary vector (codec in database.py); halfvec is cast in SQL
+        "embedding": query_embedding,
+        "candidates": candidates,
+        "top_k": top_k,
+        "threshold": settings.SIMILARITY_THRESHOLD,
+    }
     if processo_id:
-        sql = text("""
-            SELECT
-                c.id,
-                c.conteudo,
-                c.posicao,
-                c.metadata,
-                c.documento_id,
-                d.titulo as doc_titulo,
-                d.tipo as doc_tipo,
-                d.participantes,
-                d.data_referencia,
-                1 - (c.embedding <=> CAST(:embedding AS vector)) as similarity
-            FROM chunks c
-            JOIN documents d ON c.documento_id = d.id
-            WHERE d.status = 'processed'
-              AND d.processo_id = :processo_id
-              AND 1 - (c.embedding <=> CAST(:embedding AS vector)) >= :threshold
-            ORDER BY c.embedding <=> CAST(:embedding AS vector)
-            LIMIT :top_k
-        """)
-        params = {
-            "embedding": str(query_embedding),
-            "processo_id": str(processo_id),
-            "top_k": top_k,
-            "threshold": settings.SIMILARITY_THRESHOLD,
-        }
-    else:
-        sql = text("""
-            SELECT
-                c.id,
-                c.conteudo,
-                c.posicao,
-                c.metadata,
-                c.documento_id,
-                d.titulo as doc_titulo,
-                d.tipo as doc_tipo,
-                d.participantes,
-                d.data_referencia,
-                1 - (c.embedding <=> CAST(:embedding AS vector)) as similarity
-            FROM chunks c
-            JOIN documents d ON c.documento_id = d.id
-            WHERE d.status = 'processed'
-              AND 1 - (c.embedding <=> CAST(:embedding AS vector)) >= :threshold
-            ORDER BY c.embedding <=> CAST(:embedding AS vector)
-            LIMIT :top_k
-        """)
-        params = {
-            "embedding": str(query_embedding),
-            "top_k": top_k,
-            "threshold": settings.SIMILARITY_THRESHOLD,
-        }
+        params["processo_id"] = str(processo_id)
 
-    result = await db.execute(sql, params)
+    return await db.scalar(sql, params)
 
-    chunks = []
-    for row in result.mappings():
-        chunks.append({
-            "id": str(row["id"]),
-            "conteudo": row["conteudo"],
-            "documento_id": str(row["documento_id"]),
-            "doc_titulo": row["doc_titulo"],
-            "doc_tipo": row["doc_tipo"],
-            "participantes": row["participantes"],
-            "data_referencia": str(row["data_referencia"]) if row["data_referencia"] else None,
-            "similarity": float(row["similarity"]),
-        })
 
-    return chunks
+def _source_block(i: int, chunk: dict) -> str:
+    """One "--- Fonte i ---" block of the context."""
+    source = f"[{chunk['doc_tipo']}] {chunk['doc_titulo']}"
+    if chunk["data_referencia"]:
+        source += f" ({chunk['data_referencia']})"
+    if chunk["participantes"]:
+        source += f" - Participantes: {', '.join(chunk['participantes'])}"
+    return (
+        f"--- Fonte {i} (relevancia: {chunk['similarity']:.2f}): {source} ---\n"
+        f"{chunk['conteudo']}\n"
+    )
 
 
 def build_context(chunks: list[dict]) -> str:
@@ -140,20 +197,20 @@ def build_context(chunks: list[dict]) -> str:
     if not chunks:
         return "Nenhum documento relevante encontrado."
 
-    context_parts = []
-    for i, chunk in enumerate(chunks, 1):
-        source = f"[{chunk['doc_tipo']}] {chunk['doc_titulo']}"
-        if chunk["data_referencia"]:
-            source += f" ({chunk['data_referencia']})"
-        if chunk["participantes"]:
-            source += f" - Participantes: {', '.join(chunk['participantes'])}"
-
-        context_parts.append(
-            f"--- Fonte {i} (relevancia: {chunk['similarity']:.2f}): {source} ---\n"
-            f"{chunk['conteudo']}\n"
-        )
+    return "\n".join(_source_block(i, c) for i, c in enumerate(chunks, 1))
 
-    return "\n".join(context_parts)
+
+def _sources(chunks: list[dict]) -> list[dict]:
+    """Source references shown with an answer."""
+    return [
+        {
+            "doc_titulo": c["doc_titulo"],
+            "doc_tipo": c["doc_tipo"],
+            "similarity": c["similarity"],
+            "documento_id": c["documento_id"],
+        }
+        for c in chunks
+    ]
 
 
 def _build_messages(
@@ -162,36 +219,49 @@ def _build_messages(
     context: str,
     processo_contexto: str = None,
 ) -> list[dict]:
-    """Build the messages list for the LLM call."""
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    """Build the messages list for the LLM call.
 
-    # Add conversation history (last 10 messages)
-    for msg in conversation_history[-10:]:
-        messages.append({"role": msg["role"], "content": msg["content"]})
+    Stable content comes first so consecutive turns share a byte-identical
+    prefix (OpenAI prompt caching); per-query retrieval goes last.
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if processo_contexto:
+        messages.append({"role": "system", "content": f"Contexto do processo:\n{processo_contexto.strip()}"})
+
+    # Add conversation history (last HISTORY_MESSAGES messages; callers
+    # normally load only those)
+    start = max(len(conversation_history) - HISTORY_MESSAGES, 0)
+    messages.extend(
+        {"role": msg["role"], "content": msg["content"]}
+        for msg in islice(conversation_history, start, None)
+    )
 
     # Add current query with context
-    parts = []
-    if processo_contexto:
-        parts.append(f"Contexto do processo:\n{processo_contexto}")
-    parts.append(f"Contexto dos documentos:\n{context}")
-    parts.append(f"Pergunta do usuario: {query}")
-    user_message = "\n\n".join(parts)
+    user_message = f"Contexto dos documentos:\n{context.strip()}\n\nPergunta do usuario: {query}"
     messages.append({"role": "user", "content": user_message})
 
     return messages
 
 
+def _prompt_cache_body(processo_id: UUID = None) -> Optional[dict]:
+    """Route requests of the same processo to the same prompt cache."""
+    return {"prompt_cache_key": str(processo_id)} if processo_id else None
+
+
 async def chat(
     query: str,
     conversation_history: list[dict],
     db: AsyncSession,
     processo_id: UUID = None,
     processo_contexto: str = None,
+    query_embedding: list[float] = None,
 ) -> dict:
     """RAG chat: search relevant chunks, build context, generate response (non-streaming)."""
 
-    # 1. Search similar chunks
-    chunks = await search_similar_chunks(query, db, processo_id=processo_id)
+    # 1. Search similar chunks (one embedding call, unless the caller already has it)
+    if query_embedding is None:
+        query_embedding = await embed_query(query)
+    chunks = await search_similar_chunks(query_embedding, db, processo_id=processo_id)
 
     # 2. Build context and messages
     context = build_context(chunks)
@@ -203,6 +273,7 @@ async def chat(
         messages=messages,
         temperature=1,
         max_completion_tokens=4000,
+        extra_body=_prompt_cache_body(processo_id),
     )
 
     choice = response.choices[0]
@@ -224,18 +295,12 @@ async def chat(
         usage.completion_tokens * 0.60 / 1_000_000
     )
 
+    # chunks_used stays as id strings (JSON-safe for the semantic cache);
+    # asyncpg encodes them into messages.chunks_usados (uuid[]) directly
     return {
         "answer": answer,
         "chunks_used": [c["id"] for c in chunks],
-        "sources": [
-            {
-                "doc_titulo": c["doc_titulo"],
-                "doc_tipo": c["doc_tipo"],
-                "similarity": c["similarity"],
-                "documento_id": c["documento_id"],
-            }
-            for c in chunks
-        ],
+        "sources": _sources(chunks),
         "tokens_input": usage.prompt_tokens,
         "tokens_output": usage.completion_tokens,
         "cost_usd": round(cost, 6),
@@ -248,21 +313,27 @@ async def chat_stream(
     db: AsyncSession,
     processo_id: UUID = None,
     processo_contexto: str = None,
-) -> AsyncGenerator[str, None]:
-    """RAG chat with SSE streaming: yields Server-Sent Events as strings."""
+    query_embedding: list[float] = None,
+) -> AsyncGenerator[tuple[str, dict], None]:
+    """RAG chat streaming: yields (event, payload) pairs; the caller formats SSE."""
 
     # Phase 1: Searching
-    yield _format_sse("status", {"phase": "searching"})
+    yield "status", {"phase": "searching"}
 
-    chunks = await search_similar_chunks(query, db, processo_id=processo_id)
+    if query_embedding is None:
+        query_embedding = await embed_query(query)
+    chunks = await search_similar_chunks(query_embedding, db, processo_id=processo_id)
     context = build_context(chunks)
     messages = _build_messages(query, conversation_history, context, processo_contexto)
+    # Built before streaming: nothing left to assemble after the last token
+    sources = _sources(chunks)
+    chunks_used = [c["id"] for c in chunks]
 
     # Phase 2: Generating
-    yield _format_sse("status", {"phase": "generating"})
+    yield "status", {"phase": "generating"}
 
     # Stream from LLM
-    full_answer = ""
+    answer_parts = []
     total_prompt_tokens = 0
     total_completion_tokens = 0
 
@@ -273,8 +344,15 @@ async def chat_stream(
         max_completion_tokens=4000,
         stream=True,
         stream_options={"include_usage": True},
+        extra_body=_prompt_cache_body(processo_id),
     )
 
+    # Tokens are coalesced into one event per TOKEN_FLUSH_SECONDS or
+    # TOKEN_FLUSH_CHARS, whichever comes first (fewer SSE frames and writes)
+    pending = []
+    pending_chars = 0
+    last_flush = time.monotonic()
+
     async for chunk in stream:
         # Extract usage from the final chunk
         if chunk.usage:
@@ -283,34 +361,41 @@ async def chat_stream(
 
         if chunk.choices and chunk.choices[0].delta.content:
             token = chunk.choices[0].delta.content
-            full_answer += token
-            yield _format_sse("token", {"content": token})
+            answer_parts.append(token)
+            pending.append(token)
+            pending_chars += len(token)
+            now = time.monotonic()
+            if pending_chars >= TOKEN_FLUSH_CHARS or now - last_flush >= TOKEN_FLUSH_SECONDS:
+                yield "token", {"content": "".join(pending)}
+                pending.clear()
+                pending_chars = 0
+                last_flush = now
+
+    if pending:
+        yield "token", {"content": "".join(pending)}
 
     # Calculate cost
     cost = (total_prompt_tokens * 0.15 / 1_000_000) + (
         total_completion_tokens * 0.60 / 1_000_000
     )
 
-    # Build sources
-    sources = [
-        {
-            "doc_titulo": c["doc_titulo"],
-            "doc_tipo": c["doc_tipo"],
-            "similarity": c["similarity"],
-            "documento_id": c["documento_id"],
-        }
-        for c in chunks
-    ]
-
     # Yield final metadata
-    yield _format_sse("sources", {"sources": sources})
+    yield "sources", {"sources": sources}
 
     # Yield done with result data for saving
-    yield _format_sse("done", {
-        "answer": full_answer,
-        "chunks_used": [c["id"] for c in chunks],
+    yield "done", {
+        "answer": "".join(answer_parts),
+        "chunks_used": chunks_used,
         "sources": sources,
         "tokens_input": total_prompt_tokens,
         "tokens_output": total_completion_tokens,
         "cost_usd": round(cost, 6),
-    })
+    }
+
+
+async def replay_stream(rag_result: dict) -> AsyncGenerator[tuple[str, dict], None]:
+    """Stream a stored RAG result (semantic cache hit) with the chat_stream events."""
+    yield "status", {"phase": "generating"}
+    yield "token", {"content": rag_result["answer"]}
+    yield "sources", {"sources": rag_result["sources"]}
+    yield "done", rag_result
@@ -1,14 +1,56 @@
+import asyncio
 import os
 from uuid import UUID
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime
+from typing import AsyncIterator, Optional
+from urllib.parse import quote
 
 import aioboto3
-from botocore.config import Config
+from aiobotocore.config import AioConfig
+from botocore.exceptions import ClientError
+from cachetools import TLRUCache
 
 from app.core.config import get_settings
 
 settings = get_settings()
 
+# Multipart part size (S3 requires >= 5 MiB for every part but the last)
+PART_SIZE = 8 * 1024 * 1024
+
+# Parts uploaded concurrently per multipart upload
+MAX_CONCURRENT_PARTS = 8
+
+# Presigned URLs keyed by (key, expiration, filename), reused for 80% of their lifetime
+_presigned_url_cache: TLRUCache = TLRUCache(
+    maxsize=4096, ttu=lambda k, _url, now: now + k[1] * 0.8
+)
+
+# Error codes S3 uses for a missing object (HEAD responses carry no error body)
+_NOT_FOUND_CODES = ("404", "NoSuchKey", "NotFound")
+
+# delete_objects accepts at most 1000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+# Shared by all requests and concurrent multipart parts. Idle pooled
+# connections are kept for a minute (aiohttp default: 12s) so sporadic calls
+# skip the TLS handshake; adaptive retries back off on S3 throttling.
+_CLIENT_CONFIG = AioConfig(
+    signature_version="s3v4",
+    max_pool_connections=50,
+    retries={"mode": "adaptive"},
+    connector_args={"keepalive_timeout": 60},
+)
+
+
+def _forget_presigned_urls(keys: set[str]) -> None:
+    for cache_key in [k for k in list(_presigned_url_cache.keys()) if k[0] in keys]:
+        _presigned_url_cache.pop(cache_key, None)
+
+
+def _is_not_found(error: ClientError) -> bool:
+    return error.response.get("Error", {}).get("Code") in _NOT_FOUND_CODES
+
 
 class S3Storage:
     def __init__(self):
@@ -19,63 +61,241 @@ class S3Storage:
             aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY or None,
             region_name=self.region,
         )
+        self._client = None
+        self._client_stack: Optional[AsyncExitStack] = None
+
+    async def open(self) -> None:
+        """Open a client shared by all calls (one connection pool to S3)."""
+        if self._client is not None:
+            return
+        stack = AsyncExitStack()
+        self._client = await stack.enter_async_context(
+            self.session.client("s3", config=_CLIENT_CONFIG)
+        )
+        self._client_stack = stack
+
+    async def __aenter__(self) -> "S3Storage":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self._client_stack is not None:
+            await self._client_stack.aclose()
+        self._client = None
+        self._client_stack = None
+
+    @asynccontextmanager
+    async def _s3(self):
+        # Shared client when open, otherwise a client for this call only
+        if self._client is not None:
+            yield self._client
+            return
+        async with self.session.client("s3", config=_CLIENT_CONFIG) as s3:
+            yield s3
 
     def _get_key(self, filename: str, processo_id: UUID, folder: str = "documents") -> str:
         """Generate S3 key with organized structure."""
         date_prefix = datetime.utcnow().strftime("%Y/%m")
         return f"{folder}/{processo_id}/{date_prefix}/{filename}"
 
-    async def upload_file(
-        self,
-        content: bytes,
-        filename: str,
-        processo_id: UUID,
-        folder: str = "documents",
-    ) -> str:
-        """Upload file to S3 and return the key."""
+    def _get_unique_key(self, filename: str, processo_id: UUID, folder: str) -> str:
         # Add timestamp to prevent overwrites
         timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
         name, ext = os.path.splitext(filename)
         unique_filename = f"{name}_{timestamp}{ext}"
+        return self._get_key(unique_filename, processo_id, folder)
 
-        key = self._get_key(unique_filename, processo_id, folder)
-
-        async with self.session.client("s3", config=Config(signature_version="s3v4")) as s3:
-            await s3.put_object(
+    async def _upload_part(
+        self,
+        s3,
+        key: str,
+        upload_id: str,
+        part_number: int,
+        data: bytes,
+        sem: asyncio.Semaphore,
+    ) -> dict:
+        # The caller acquires the semaphore before buffering the part
+        try:
+            resp = await s3.upload_part(
                 Bucket=self.bucket,
                 Key=key,
-                Body=content,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data,
             )
+            return {"PartNumber": part_number, "ETag": resp["ETag"]}
+        finally:
+            sem.release()
+
+    async def upload_stream(
+        self,
+        chunks: AsyncIterator[bytes],
+        filename: str,
+        processo_id: UUID,
+        folder: str = "documents",
+    ) -> str:
+        """Upload a stream of bytes to S3 and return the key.
+
+        Data is buffered up to PART_SIZE at a time: small files go in a single
+        put_object, larger ones through a multipart upload with up to
+        MAX_CONCURRENT_PARTS parts in flight (aborted on error, including
+        errors raised by the chunk iterator itself).
+        """
+        key = self._get_unique_key(filename, processo_id, folder)
+
+        async with self._s3() as s3:
+            buffer = bytearray()
+            upload_id = None
+            tasks: list[asyncio.Task] = []
+            sem = asyncio.Semaphore(MAX_CONCURRENT_PARTS)
+
+            async def submit_part(data: bytes) -> None:
+                nonlocal upload_id
+                if upload_id is None:
+                    mpu = await s3.create_multipart_upload(Bucket=self.bucket, Key=key)
+                    upload_id = mpu["UploadId"]
+                await sem.acquire()
+                tasks.append(asyncio.create_task(
+                    self._upload_part(s3, key, upload_id, len(tasks) + 1, data, sem)
+                ))
+
+            try:
+                async for chunk in chunks:
+                    if not buffer and len(chunk) == PART_SIZE:
+                        # Part-sized chunks (upload_file slices, UploadFile reads)
+                        # are sent as they are: one copy instead of three
+                        await submit_part(bytes(chunk))
+                        continue
+                    buffer.extend(chunk)
+                    while len(buffer) >= PART_SIZE:
+                        await submit_part(bytes(buffer[:PART_SIZE]))
+                        del buffer[:PART_SIZE]
+
+                if upload_id is None:
+                    await s3.put_object(Bucket=self.bucket, Key=key, Body=bytes(buffer))
+                    return key
+
+                if buffer:
+                    await submit_part(bytes(buffer))
+
+                parts = await asyncio.gather(*tasks)
+                await s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    MultipartUpload={"Parts": sorted(parts, key=lambda p: p["PartNumber"])},
+                )
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                if upload_id is not None:
+                    await s3.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+                raise
 
         return key
 
+    async def upload_file(
+        self,
+        content: bytes,
+        filename: str,
+        processo_id: UUID,
+        folder: str = "documents",
+    ) -> str:
+        """Upload file to S3 and return the key."""
+
+        async def parts():
+            view = memoryview(content)
+            for offset in range(0, len(content), PART_SIZE):
+                yield view[offset:offset + PART_SIZE]
+
+        return await self.upload_stream(parts(), filename, processo_id, folder)
+
     async def download_file(self, key: str) -> bytes:
         """Download file from S3."""
-        async with self.session.client("s3") as s3:
+        async with self._s3() as s3:
             response = await s3.get_object(Bucket=self.bucket, Key=key)
             content = await response["Body"].read()
             return content
 
-    async def get_presigned_url(self, key: str, expiration: int = 3600) -> str:
-        """Generate presigned URL for download."""
-        async with self.session.client("s3", config=Config(signature_version="s3v4")) as s3:
+    async def download_file_or_none(self, key: str) -> Optional[bytes]:
+        """Download file from S3; None if the object does not exist.
+
+        Checks existence with the GET itself instead of a HEAD beforehand.
+        """
+        try:
+            return await self.download_file(key)
+        except ClientError as e:
+            if _is_not_found(e):
+                return None
+            raise
+
+    async def get_presigned_url(
+        self, key: str, expiration: int = 3600, filename: Optional[str] = None
+    ) -> str:
+        """Generate presigned URL for download (cached while still fresh).
+
+        With ``filename``, S3 serves the object as an attachment with that name.
+        """
+        cache_key = (key, expiration, filename)
+        cached = _presigned_url_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        params = {"Bucket": self.bucket, "Key": key}
+        if filename:
+            params["ResponseContentDisposition"] = f"attachment; filename*=UTF-8''{quote(filename)}"
+
+        async with self._s3() as s3:
             url = await s3.generate_presigned_url(
                 "get_object",
-                Params={"Bucket": self.bucket, "Key": key},
+                Params=params,
                 ExpiresIn=expiration,
             )
-            return url
+        _presigned_url_cache[cache_key] = url
+        return url
 
     async def delete_file(self, key: str) -> None:
-        """Delete file from S3."""
-        async with self.session.client("s3") as s3:
-            await s3.delete_object(Bucket=self.bucket, Key=key)
+        """Delete file from S3 (a missing object counts as deleted)."""
+        try:
+            async with self._s3() as s3:
+                await s3.delete_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if not _is_not_found(e):
+                raise
+        _forget_presigned_urls({key})
+
+    async def delete_files(self, keys: list[str]) -> None:
+        """Delete many files with batched delete_objects calls."""
+        if not keys:
+            return
+        async with self._s3() as s3:
+            await asyncio.gather(*(
+                s3.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={
+                        "Objects": [{"Key": k} for k in keys[i:i + DELETE_BATCH_SIZE]],
+                        "Quiet": True,
+                    },
+                )
+                for i in range(0, len(keys), DELETE_BATCH_SIZE)
+            ))
+        _forget_presigned_urls(set(keys))
 
     async def file_exists(self, key: str) -> bool:
-        """Check if file exists in S3."""
+        """Check if file exists in S3 (credential/network errors are raised)."""
         try:
-            async with self.session.client("s3") as s3:
+            async with self._s3() as s3:
                 await s3.head_object(Bucket=self.bucket, Key=key)
                 return True
-        except Exception:
-            return False
+        except ClientError as e:
+            if _is_not_found(e):
+                return False
+            raise
+
+
+# Process-wide instance; its client is opened in the app lifespan
+storage = S3Storage()
@@ -0,0 +1,113 @@
+"""Semantic cache for RAG answers.
+
+Answers are stored per processo together with the query embedding. A new
+question whose embedding is close enough to a cached one reuses the stored
+answer instead of running vector search and the LLM again. Only questions
+without conversation history are cached, since follow-ups depend on context.
+
+A hit needs two checks: cosine similarity of at least
+SEMANTIC_CACHE_THRESHOLD (0.97), and the same numbers in both questions
+(values, dates, years). Questions that differ only in an amount or a date
+embed almost identically and must not share an answer.
+"""
+import re
+from datetime import datetime, timedelta
+from typing import Optional
+from uuid import UUID
+
+from sqlalchemy import delete, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import get_settings
+from app.models.models import ChatCache
+
+settings = get_settings()
+
+
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def _numbers(query_norm: str) -> list[str]:
+    return sorted(_NUMBER_RE.findall(query_norm))
+
+
+async def lookup(
+    query: str,
+    query_embedding: list[float],
+    processo_id: UUID,
+    db: AsyncSession,
+) -> Optional[dict]:
+    """Return a cached RAG result for a similar question, or None."""
+    result = await db.execute(
+        text("""
+            SELECT response, query_norm, 1 - (embedding <=> CAST(:embedding AS vector)) as similarity
+            FROM chat_cache
+            WHERE processo_id = :processo_id
+              AND created_at >= :min_created
+            ORDER BY embedding <=> CAST(:embedding AS vector)
+            LIMIT 1
+        """),
+        {
+            "embedding": query_embedding,
+            "processo_id": str(processo_id),
+            "min_created": datetime.utcnow() - timedelta(hours=settings.SEMANTIC_CACHE_TTL_HOURS),
+        },
+    )
+    row = result.first()
+    if not row or row.similarity < settings.SEMANTIC_CACHE_THRESHOLD:
+        return None
+    # Verification step: a near-identical question about another amount or
+    # date is a different question
+    if _numbers(row.query_norm) != _numbers(normalize_query(query)):
+        return None
+
+    response = row.response
+    return {
+        "answer": response["answer"],
+        "chunks_used": response["chunks_used"],
+        "sources": response["sources"],
+        "tokens_input": 0,
+        "tokens_output": 0,
+        "cost_usd": 0,
+    }
+
+
+async def store(
+    query: str,
+    query_embedding: list[float],
+    processo_id: UUID,
+    rag_result: dict,
+    db: AsyncSession,
+) -> None:
+    """Cache a RAG result (not committed; joins the caller's transaction)."""
+    response = {
+        "answer": rag_result["answer"],
+        "chunks_used": rag_result["chunks_used"],
+        "sources": rag_result["sources"],
+    }
+    stmt = insert(ChatCache).values(
+        processo_id=processo_id,
+        query_norm=normalize_query(query),
+        embedding=query_embedding,
+        response=response,
+        created_at=datetime.utcnow(),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ChatCache.processo_id, ChatCache.query_norm],
+        set_={
+            "embedding": stmt.excluded.embedding,
+            "response": stmt.excluded.response,
+            "created_at": stmt.excluded.created_at,
+        },
+    )
+    await db.execute(stmt)
+
+
+async def invalidate(processo_id: UUID, db: AsyncSession) -> None:
+    """Drop cached answers of a processo (its documents changed)."""
+    await db.execute(delete(ChatCache).where(ChatCache.processo_id == processo_id))
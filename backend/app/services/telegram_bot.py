@@ -1,38 +1,207 @@
+"""Telegram bot: command dispatch and RAG answers over the Bot API.
+
+Handling an update is I/O-bound (Telegram HTTP calls and Postgres round
+trips); the Python work per update is negligible, so compiling it with
+numba/Cython would gain nothing. Optimize round-trip counts, connection reuse
+and statement caching instead.
+"""
 import secrets
 import asyncio
-from datetime import datetime, timedelta
-from typing import Optional
+from typing import NamedTuple, Optional
 from uuid import UUID
 
+import aiohttp
+from cachetools import LRUCache, TTLCache
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
+from sqlalchemy import select, and_, bindparam
 
 from app.core.config import get_settings
 from app.models.models import User, Processo, Conversation, Message
-from app.services.rag_engine import chat as rag_chat
+from app.services.rag_engine import chat as rag_chat, HISTORY_MESSAGES
 
 settings = get_settings()
 
-# In-memory store for verification codes (in production, use Redis)
-verification_codes: dict[str, tuple[int, datetime]] = {}
+# Fixed bot replies (templates take the name / code with %)
+_LINK_PROMPT = (
+    "Voce precisa vincular sua conta primeiro.\n"
+    "Use /vincular para gerar um codigo de vinculacao."
+)
+_WELCOME_USER = (
+    "Ola %s! Bem-vindo ao Apoio Processual.\n\n"
+    "Use /processos para ver seus processos.\n"
+    "Use /selecionar [numero] para selecionar um processo.\n"
+    "Use /ajuda para ver todos os comandos."
+)
+_WELCOME_ANON = (
+    "Bem-vindo ao Apoio Processual!\n\n"
+    "Para comecar, voce precisa vincular sua conta.\n"
+    "Use /vincular para gerar um codigo de vinculacao."
+)
+_LINK_CODE = (
+    "Seu codigo de vinculacao e: <code>%s</code>\n\n"
+    "Use este codigo no painel web para vincular sua conta.\n"
+    "O codigo expira em 10 minutos."
+)
+_NO_PROCESSO_PROMPT = (
+    "Selecione um processo primeiro.\n"
+    "Use /processos para ver seus processos."
+)
+_ERROR_TEXT = (
+    "Desculpe, ocorreu um erro ao processar sua mensagem. "
+    "Tente novamente mais tarde."
+)
+_TIMEOUT_TEXT = (
+    "Desculpe, a resposta demorou demais. "
+    "Tente novamente em instantes."
+)
+_BUSY_TEXT = "Aguarde, ainda estou respondendo sua mensagem anterior."
+_HELP_TEXT = (
+    "<b>Comandos disponiveis:</b>\n\n"
+    "/start - Iniciar o bot\n"
+    "/vincular - Gerar codigo para vincular conta\n"
+    "/processos - Listar seus processos\n"
+    "/selecionar [n] - Selecionar processo por numero\n"
+    "/ajuda - Mostrar esta ajuda\n\n"
+    "Apos selecionar um processo, basta enviar sua pergunta!"
+)
+
+# In-memory store for verification codes -> chat_id (in production, use
+# Redis). Codes expire after 10 minutes; expired entries are dropped on every
+# insert and the oldest are evicted if the cache fills up.
+verification_codes: TTLCache = TTLCache(maxsize=10_000, ttl=600)
+
+# Processo ids last listed by /processos, per user, so /selecionar [n] refers
+# to the same numbering without listing them again
+_processo_list_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
+# Last HISTORY_MESSAGES messages per telegram conversation (oldest first).
+# The bot appends each new message here instead of reading the history again
+# on every turn; the web chat routes call forget_history() when they write.
+_history_cache: LRUCache = LRUCache(maxsize=1000)
+
+
+def forget_history(conversation_id: UUID) -> None:
+    """Drop the cached history after messages are written outside the bot."""
+    _history_cache.pop(conversation_id, None)
+
+
+class TelegramUser(NamedTuple):
+    """The linked user's fields the bot needs (no ORM instance to attach)."""
+    id: UUID
+    name: str
+
+
+# Linked user per chat_id (None for chats not linked to an account), so
+# updates skip the users lookup; link/unlink call forget_chat_user()
+_chat_user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+
+
+# Chats with an answer being generated (see _handle_message)
+_inflight_chats: set[int] = set()
+
+# Conversation selected per chat_id as (conversation_id, processo_id): set by
+# /selecionar, or the user's latest telegram conversation on first use
+_active_conversations: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+
+def forget_chat_user(chat_id: int) -> None:
+    """Drop the cached user of a chat; call after linking or unlinking it."""
+    _chat_user_cache.pop(chat_id, None)
+    _active_conversations.pop(chat_id, None)
+
+
+def forget_conversations(
+    conversation_id: Optional[UUID] = None, processo_id: Optional[UUID] = None
+) -> None:
+    """Unselect a deleted conversation, or every conversation of a deleted processo."""
+    for chat_id, (conv_id, proc_id) in list(_active_conversations.items()):
+        if conv_id == conversation_id or proc_id == processo_id:
+            _active_conversations.pop(chat_id, None)
+
+
+# Shared session (keep-alive connections to api.telegram.org), created on
+# first use and closed on app shutdown
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=75)
+        )
+    return _SESSION
+
+
+async def close_session() -> None:
+    global _SESSION
+    if _SESSION is not None:
+        await _SESSION.close()
+        _SESSION = None
+
+
+# Statements built once so the compiled SQL (and its prepared plan) is
+# reused; values are passed as bound parameters at execute time
+_user_by_chat_id = select(User.id, User.name).where(User.telegram_chat_id == bindparam("chat_id"))
+
+_active_processos = (
+    select(Processo)
+    .where(Processo.owner_id == bindparam("user_id"), Processo.status == "ativo")
+    .order_by(Processo.updated_at.desc())
+    .limit(10)
+)
+
+_active_processo_ids = _active_processos.with_only_columns(Processo.id)
+
+# Processo and its latest telegram conversation of the user (if any)
+_processo_with_conversation = (
+    select(Processo, Conversation)
+    .outerjoin(Conversation, and_(
+        Conversation.processo_id == Processo.id,
+        Conversation.user_id == bindparam("user_id"),
+        Conversation.canal == "telegram",
+    ))
+    .where(
+        Processo.id == bindparam("processo_id"),
+        Processo.owner_id == bindparam("user_id"),
+        Processo.status == "ativo",
+    )
+    .order_by(Conversation.updated_at.desc().nullslast())
+    .limit(1)
+)
+
+_latest_telegram_conversation = (
+    select(Conversation)
+    .where(Conversation.user_id == bindparam("user_id"), Conversation.canal == "telegram")
+    .order_by(Conversation.updated_at.desc())
+    .limit(1)
+)
+
+# Most recent messages first; callers reverse them
+_recent_messages = (
+    select(Message.role, Message.content)
+    .where(Message.conversation_id == bindparam("conversation_id"))
+    .order_by(Message.created_at.desc())
+    .limit(HISTORY_MESSAGES)
+)
 
 
 class TelegramBot:
     def __init__(self, db: AsyncSession):
         self.db = db
         self.token = settings.TELEGRAM_BOT_TOKEN
+        self._send_url = f"https://api.telegram.org/bot{self.token}/sendMessage"
+        self._action_url = f"https://api.telegram.org/bot{self.token}/sendChatAction"
 
     async def send_message(self, chat_id: int, text: str, parse_mode: str = "HTML"):
         """Send a message to a Telegram chat."""
-        import aiohttp
-
-        url = f"https://api.telegram.org/bot{self.token}/sendMessage"
-        async with aiohttp.ClientSession() as session:
-            await session.post(url, json={
-                "chat_id": chat_id,
-                "text": text,
-                "parse_mode": parse_mode,
-            })
+        session = await get_session()
+        async with session.post(self._send_url, json={
+            "chat_id": chat_id,
+            "text": text,
+            "parse_mode": parse_mode,
+        }):
+            pass
 
     async def handle_update(self, update: dict):
         """Handle incoming Telegram update."""
@@ -44,89 +213,53 @@ class TelegramBot:
         text = message.get("text", "")
 
         # Get user by telegram_chat_id
-        result = await self.db.execute(
-            select(User).where(User.telegram_chat_id == chat_id)
-        )
-        user = result.scalar_one_or_none()
-
-        # Handle commands
-        if text.startswith("/start"):
-            await self._handle_start(chat_id, user)
-        elif text.startswith("/vincular"):
-            await self._handle_vincular(chat_id)
-        elif text.startswith("/processos"):
-            await self._handle_processos(chat_id, user)
-        elif text.startswith("/selecionar"):
-            await self._handle_selecionar(chat_id, user, text)
-        elif text.startswith("/ajuda") or text.startswith("/help"):
-            await self._handle_help(chat_id)
+        try:
+            user = _chat_user_cache[chat_id]
+        except KeyError:
+            result = await self.db.execute(_user_by_chat_id, {"chat_id": chat_id})
+            row = result.first()
+            user = TelegramUser(*row) if row else None
+            _chat_user_cache[chat_id] = user
+
+        # Handle commands (first word, without a "@botname" suffix)
+        command = text.partition(" ")[0].partition("@")[0]
+        handler = self._COMMANDS.get(command)
+        if handler:
+            await handler(self, chat_id, user, text)
         elif user:
             # Regular message - send to RAG
             await self._handle_message(chat_id, user, text)
         else:
-            await self.send_message(
-                chat_id,
-                "Voce precisa vincular sua conta primeiro.\n"
-                "Use /vincular para gerar um codigo de vinculacao."
-            )
+            await self.send_message(chat_id, _LINK_PROMPT)
 
-    async def _handle_start(self, chat_id: int, user: Optional[User]):
+    async def _handle_start(self, chat_id: int, user: Optional[TelegramUser], text: str):
         """Handle /start command."""
         if user:
-            await self.send_message(
-                chat_id,
-                f"Ola {user.name}! Bem-vindo ao Apoio Processual.\n\n"
-                "Use /processos para ver seus processos.\n"
-                "Use /selecionar [numero] para selecionar um processo.\n"
-                "Use /ajuda para ver todos os comandos."
-            )
+            await self.send_message(chat_id, _WELCOME_USER % user.name)
         else:
-            await self.send_message(
-                chat_id,
-                "Bem-vindo ao Apoio Processual!\n\n"
-                "Para comecar, voce precisa vincular sua conta.\n"
-                "Use /vincular para gerar um codigo de vinculacao."
-            )
+            await self.send_message(chat_id, _WELCOME_ANON)
 
-    async def _handle_vincular(self, chat_id: int):
+    async def _handle_vincular(self, chat_id: int, user: Optional[TelegramUser], text: str):
         """Handle /vincular command - generate verification code."""
         code = secrets.token_hex(4).upper()  # 8 character code
-        verification_codes[code] = (chat_id, datetime.utcnow() + timedelta(minutes=10))
+        verification_codes[code] = chat_id
 
-        await self.send_message(
-            chat_id,
-            f"Seu codigo de vinculacao e: <code>{code}</code>\n\n"
-            "Use este codigo no painel web para vincular sua conta.\n"
-            "O codigo expira em 10 minutos."
-        )
+        await self.send_message(chat_id, _LINK_CODE % code)
 
     async def verify_code(self, code: str) -> Optional[int]:
         """Verify a code and return the chat_id if valid."""
-        code = code.upper()
-        if code not in verification_codes:
-            return None
+        # Single use: expired codes are no longer in the cache
+        return verification_codes.pop(code.upper(), None)
 
-        chat_id, expires_at = verification_codes[code]
-        if datetime.utcnow() > expires_at:
-            del verification_codes[code]
-            return None
-
-        del verification_codes[code]
-        return chat_id
-
-    async def _handle_processos(self, chat_id: int, user: Optional[User]):
+    async def _handle_processos(self, chat_id: int, user: Optional[TelegramUser], text: str):
         """Handle /processos command - list user's processes."""
         if not user:
             await self.send_message(chat_id, "Voce precisa vincular sua conta primeiro.")
             return
 
-        result = await self.db.execute(
-            select(Processo)
-            .where(Processo.owner_id == user.id, Processo.status == "ativo")
-            .order_by(Processo.updated_at.desc())
-            .limit(10)
-        )
+        result = await self.db.execute(_active_processos, {"user_id": user.id})
         processos = result.scalars().all()
+        _processo_list_cache[user.id] = [p.id for p in processos]
 
         if not processos:
             await self.send_message(chat_id, "Voce nao tem processos ativos.")
@@ -142,7 +275,7 @@ class TelegramBot:
         text += "\nUse /selecionar [numero] para selecionar um processo."
         await self.send_message(chat_id, text)
 
-    async def _handle_selecionar(self, chat_id: int, user: Optional[User], text: str):
+    async def _handle_selecionar(self, chat_id: int, user: Optional[TelegramUser], text: str):
         """Handle /selecionar command - select a process for chat."""
         if not user:
             await self.send_message(chat_id, "Voce precisa vincular sua conta primeiro.")
@@ -163,34 +296,33 @@ class TelegramBot:
             await self.send_message(chat_id, "Numero invalido.")
             return
 
-        # Get processos
+        # Processo ids in /processos order (cached from the last listing)
+        processo_ids = _processo_list_cache.get(user.id)
+        if processo_ids is None:
+            result = await self.db.execute(_active_processo_ids, {"user_id": user.id})
+            processo_ids = list(result.scalars().all())
+            _processo_list_cache[user.id] = processo_ids
+
+        if idx < 0 or idx >= len(processo_ids):
+            await self.send_message(chat_id, "Numero de processo invalido.")
+            return
+
+        # Processo and its latest telegram conversation in one query; the
+        # owner/status filters also guard against a stale cached list
         result = await self.db.execute(
-            select(Processo)
-            .where(Processo.owner_id == user.id, Processo.status == "ativo")
-            .order_by(Processo.updated_at.desc())
-            .limit(10)
+            _processo_with_conversation,
+            {"processo_id": processo_ids[idx], "user_id": user.id},
         )
-        processos = list(result.scalars().all())
+        row = result.first()
 
-        if idx < 0 or idx >= len(processos):
+        if row is None:
+            _processo_list_cache.pop(user.id, None)
             await self.send_message(chat_id, "Numero de processo invalido.")
             return
 
-        processo = processos[idx]
-
-        # Create or get conversation for this processo
-        conv_result = await self.db.execute(
-            select(Conversation)
-            .where(
-                Conversation.processo_id == processo.id,
-                Conversation.user_id == user.id,
-                Conversation.canal == "telegram",
-            )
-            .order_by(Conversation.updated_at.desc())
-            .limit(1)
-        )
-        conversation = conv_result.scalar_one_or_none()
+        processo, conversation = row
 
+        # Create the conversation if there is none yet
         if not conversation:
             conversation = Conversation(
                 processo_id=processo.id,
@@ -199,115 +331,141 @@ class TelegramBot:
                 titulo=f"Telegram - {processo.titulo}",
             )
             self.db.add(conversation)
+            # id and timestamps are client-side defaults and the session does
+            # not expire on commit: no refresh needed
             await self.db.commit()
-            await self.db.refresh(conversation)
 
-        # Store active processo in user metadata (simple approach)
-        # In production, use a separate table or Redis
+        # Later messages from this chat go to the selected conversation
+        _active_conversations[chat_id] = (conversation.id, processo.id)
         await self.send_message(
             chat_id,
             f"Processo selecionado: <b>{processo.titulo}</b>\n\n"
             "Agora voce pode enviar perguntas sobre este processo."
         )
 
-    async def _handle_message(self, chat_id: int, user: User, text: str):
+    async def _handle_message(self, chat_id: int, user: TelegramUser, text: str):
         """Handle regular message - send to RAG."""
-        # Get user's most recent telegram conversation
-        conv_result = await self.db.execute(
-            select(Conversation)
-            .where(
-                Conversation.user_id == user.id,
-                Conversation.canal == "telegram",
-            )
-            .order_by(Conversation.updated_at.desc())
-            .limit(1)
-        )
-        conversation = conv_result.scalar_one_or_none()
-
-        if not conversation:
-            await self.send_message(
-                chat_id,
-                "Selecione um processo primeiro.\n"
-                "Use /processos para ver seus processos."
-            )
+        # One answer at a time per chat: a message sent while the previous one
+        # is still being answered would hold another DB session and LLM call
+        if chat_id in _inflight_chats:
+            await self.send_message(chat_id, _BUSY_TEXT)
             return
-
-        # Get conversation history
-        history_result = await self.db.execute(
-            select(Message)
-            .where(Message.conversation_id == conversation.id)
-            .order_by(Message.created_at)
-            .limit(20)
+        _inflight_chats.add(chat_id)
+        try:
+            await self._answer_message(chat_id, user, text)
+        finally:
+            _inflight_chats.discard(chat_id)
+
+    async def _answer_message(self, chat_id: int, user: TelegramUser, text: str):
+        active = _active_conversations.get(chat_id)
+        if active is None:
+            # Nothing selected in this process yet: user's most recent
+            # telegram conversation (LIMIT 1; scalar() returns it or None)
+            conversation = await self.db.scalar(
+                _latest_telegram_conversation, {"user_id": user.id}
+            )
+            if not conversation:
+                await self.send_message(chat_id, _NO_PROCESSO_PROMPT)
+                return
+            active = (conversation.id, conversation.processo_id)
+            _active_conversations[chat_id] = active
+        conversation_id, processo_id = active
+
+        # History (cached or queried) while the "typing" indicator is sent
+        cached, _ = await asyncio.gather(
+            self._cached_history(conversation_id),
+            self._send_typing(chat_id),
         )
-        history = [
-            {"role": m.role, "content": m.content}
-            for m in history_result.scalars().all()
-        ]
+        history = cached[:]
 
-        # Save user message
+        # User message, added to the session together with the answer so the
+        # RAG queries don't autoflush it mid-request
         user_message = Message(
-            conversation_id=conversation.id,
+            conversation_id=conversation_id,
             role="user",
             content=text,
         )
-        self.db.add(user_message)
-        await self.db.commit()
-
-        # Send "typing" indicator
-        await self._send_typing(chat_id)
 
-        # Get RAG response
+        # Get RAG response (bounded, so a stuck LLM call frees the session)
         try:
-            rag_result = await rag_chat(
-                query=text,
-                conversation_history=history,
-                db=self.db,
-                processo_id=conversation.processo_id,
+            rag_result = await asyncio.wait_for(
+                rag_chat(
+                    query=text,
+                    conversation_history=history,
+                    db=self.db,
+                    processo_id=processo_id,
+                ),
+                timeout=settings.TELEGRAM_RAG_TIMEOUT,
             )
-
-            # Save assistant message
-            assistant_message = Message(
-                conversation_id=conversation.id,
-                role="assistant",
-                content=rag_result["answer"],
-                chunks_usados=[UUID(c) for c in rag_result["chunks_used"]],
-                tokens_input=rag_result["tokens_input"],
-                tokens_output=rag_result["tokens_output"],
-                custo_estimado=rag_result["cost_usd"],
-            )
-            self.db.add(assistant_message)
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                reply = _TIMEOUT_TEXT
+            else:
+                print(f"Telegram RAG answer failed for chat {chat_id}: {e}")
+                reply = _ERROR_TEXT
+            # Still keep the user's question
+            await self.db.rollback()
+            self.db.add(user_message)
             await self.db.commit()
+            cached.append({"role": "user", "content": text})
+            del cached[:-HISTORY_MESSAGES]
+            await self.send_message(chat_id, reply)
+            return
 
-            # Send response
-            await self.send_message(chat_id, rag_result["answer"])
+        # Save assistant message
+        assistant_message = Message(
+            conversation_id=conversation_id,
+            role="assistant",
+            content=rag_result["answer"],
+            chunks_usados=rag_result["chunks_used"],
+            tokens_input=rag_result["tokens_input"],
+            tokens_output=rag_result["tokens_output"],
+            custo_estimado=rag_result["cost_usd"],
+        )
+        self.db.add_all([user_message, assistant_message])
 
-        except Exception as e:
-            await self.send_message(
-                chat_id,
-                "Desculpe, ocorreu um erro ao processar sua mensagem. "
-                "Tente novamente mais tarde."
+        # Single commit for both messages, overlapped with sending the answer
+        await asyncio.gather(
+            self.db.commit(),
+            self.send_message(chat_id, rag_result["answer"]),
+        )
+        cached.append({"role": "user", "content": text})
+        cached.append({"role": "assistant", "content": rag_result["answer"]})
+        del cached[:-HISTORY_MESSAGES]
+
+    async def _cached_history(self, conversation_id: UUID) -> list[dict]:
+        """Most recent messages, oldest first (the cached list itself)."""
+        cached = _history_cache.get(conversation_id)
+        if cached is None:
+            result = await self.db.execute(
+                _recent_messages, {"conversation_id": conversation_id}
             )
+            cached = [
+                {"role": role, "content": content}
+                for role, content in reversed(result.all())
+            ]
+            _history_cache[conversation_id] = cached
+        return cached
 
     async def _send_typing(self, chat_id: int):
         """Send typing indicator."""
-        import aiohttp
-
-        url = f"https://api.telegram.org/bot{self.token}/sendChatAction"
-        async with aiohttp.ClientSession() as session:
-            await session.post(url, json={
-                "chat_id": chat_id,
-                "action": "typing",
-            })
-
-    async def _handle_help(self, chat_id: int):
+        session = await get_session()
+        async with session.post(self._action_url, json={
+            "chat_id": chat_id,
+            "action": "typing",
+        }):
+            pass
+
+    async def _handle_help(self, chat_id: int, user: Optional[TelegramUser], text: str):
         """Handle /ajuda command."""
-        await self.send_message(
-            chat_id,
-            "<b>Comandos disponiveis:</b>\n\n"
-            "/start - Iniciar o bot\n"
-            "/vincular - Gerar codigo para vincular conta\n"
-            "/processos - Listar seus processos\n"
-            "/selecionar [n] - Selecionar processo por numero\n"
-            "/ajuda - Mostrar esta ajuda\n\n"
-            "Apos selecionar um processo, basta enviar sua pergunta!"
-        )
+        await self.send_message(chat_id, _HELP_TEXT)
+
+    # Command handlers, all called as handler(self, chat_id, user, text)
+    _COMMANDS = {
+        "/start": _handle_start,
+        "/vincular": _handle_vincular,
+        "/processos": _handle_processos,
+        "/selecionar": _handle_selecionar,
+        "/ajuda": _handle_help,
+        "/help": _handle_help,
+    }
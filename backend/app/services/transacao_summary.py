@@ -0,0 +1,103 @@
+"""Per-processo transacao rollups backed by the transacao_summary_mv view.
+
+Writes to transacoes call ``schedule_refresh()``. Refreshes run in the
+background and are coalesced, so a burst of writes costs at most one running
+refresh plus one follow-up.
+
+Consistency window: a user edit passes its processo_id to
+``schedule_refresh()``. Until a refresh that started after the edit
+finishes, ``get_summary`` aggregates that processo live from transacoes,
+so the client's refetch right after the update already sees the edit. The
+set of processos to read live is kept per API process. Bulk writes from
+financial analysis, and edits served by another worker, lag by up to one
+refresh.
+"""
+import asyncio
+from decimal import Decimal
+from typing import Optional
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.database import AsyncSessionLocal
+from app.schemas.transacao import TransacaoSummaryItem, TransacaoSummaryResponse
+
+_refresh_task: Optional[asyncio.Task] = None
+_refresh_pending = False
+
+# Refreshes started so far, and per edited processo the count at edit time:
+# the edit is in the view once a refresh numbered above that count finishes
+_refresh_epoch = 0
+_live_processos: dict[UUID, int] = {}
+
+# Rollups per categoria, per pagador and overall; COALESCE keeps totals
+# non-null, so rows map onto the schema as they are
+_SUMMARY_SQL = (
+    "SELECT categoria, pagador, "
+    "GROUPING(categoria) AS all_categorias, GROUPING(pagador) AS all_pagadores, "
+    "COALESCE(SUM({total}), 0) AS total, COALESCE({count}, 0)::bigint AS cnt "
+    "FROM {source} WHERE processo_id = :processo_id "
+    "GROUP BY GROUPING SETS ((categoria), (pagador), ())"
+)
+_SQL_SUMMARY_MV = text(_SUMMARY_SQL.format(total="total", count="SUM(cnt)", source="transacao_summary_mv"))
+_SQL_SUMMARY_LIVE = text(_SUMMARY_SQL.format(total="valor", count="COUNT(*)", source="transacoes"))
+
+
+async def _refresh_loop() -> None:
+    global _refresh_pending, _refresh_epoch
+    while _refresh_pending:
+        _refresh_pending = False
+        _refresh_epoch += 1
+        epoch = _refresh_epoch
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY transacao_summary_mv"))
+                await db.commit()
+        except Exception as e:
+            print(f"transacao_summary_mv refresh failed: {e}")
+            continue
+        for processo_id, edited_at in list(_live_processos.items()):
+            if edited_at < epoch:
+                _live_processos.pop(processo_id, None)
+
+
+def schedule_refresh(processo_id: Optional[UUID] = None) -> None:
+    """Refresh the rollups in the background (call after committing transacao writes).
+
+    With ``processo_id``, that processo's summary is computed live until the
+    refresh has picked the write up.
+    """
+    global _refresh_task, _refresh_pending
+    if processo_id is not None:
+        _live_processos[processo_id] = _refresh_epoch
+    _refresh_pending = True
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.create_task(_refresh_loop())
+
+
+async def get_summary(processo_id: UUID, db: AsyncSession) -> TransacaoSummaryResponse:
+    """Summary by categoria, by pagador and in total from the pre-aggregated rows."""
+    # Recently edited processos are read from transacoes until the view catches up
+    stmt = _SQL_SUMMARY_LIVE if processo_id in _live_processos else _SQL_SUMMARY_MV
+    result = await db.execute(stmt, {"processo_id": processo_id})
+
+    by_categoria = []
+    by_pagador = []
+    total_geral = Decimal(0)
+    total_transacoes = 0
+    for row in result:
+        if row.all_categorias and row.all_pagadores:
+            total_geral, total_transacoes = row.total, row.cnt
+            continue
+        item = TransacaoSummaryItem.model_construct(
+            categoria=row.categoria, pagador=row.pagador, total=row.total, count=row.cnt
+        )
+        (by_pagador if row.all_categorias else by_categoria).append(item)
+
+    return TransacaoSummaryResponse.model_construct(
+        by_categoria=by_categoria,
+        by_pagador=by_pagador,
+        total_geral=total_geral,
+        total_transacoes=total_transacoes,
+    )
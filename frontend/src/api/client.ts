@@ -110,7 +110,8 @@ export const documentsApi = {
   get: (id: string) => api.get(`/documents/${id}`),
   update: (id: string, data: { titulo?: string; tipo?: string; data_referencia?: string }) =>
     api.patch(`/documents/${id}`, data),
-  download: (id: string) => api.get(`/documents/${id}/download`),
+  download: (id: string) =>
+    api.get(`/documents/${id}/download`, { params: { format: 'json' } }),
   delete: (id: string) => api.delete(`/documents/${id}`),
   search: (processoId: string, query: string) =>
     api.get('/documents/search', { params: { processo_id: processoId, q: query } }),
@@ -238,7 +239,8 @@ export const reportsApi = {
   list: (processoId: string) =>
     api.get('/reports', { params: { processo_id: processoId } }),
   generate: (data: Record<string, unknown>) => api.post('/reports/excel', data),
-  download: (id: string) => api.get(`/reports/${id}/download`),
+  download: (id: string) =>
+    api.get(`/reports/${id}/download`, { params: { format: 'json' } }),
   templates: () => api.get('/reports/templates'),
 }
 
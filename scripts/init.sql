@@ -92,7 +92,11 @@ CREATE TABLE documents (
     status doc_status DEFAULT 'uploaded',
     metadata JSONB DEFAULT '{}',
     texto_extraido TEXT,
+    texto_tsv TSVECTOR GENERATED ALWAYS AS (
+        to_tsvector('portuguese'::regconfig, COALESCE(texto_extraido, ''))
+    ) STORED,                                -- busca textual (GIN)
     error_message TEXT,
+    embedding_batch_id TEXT,                 -- lote da Batch API da OpenAI com embeddings pendentes
     created_at TIMESTAMP DEFAULT NOW(),
     updated_at TIMESTAMP DEFAULT NOW()
 );
@@ -101,6 +105,7 @@ CREATE INDEX idx_documents_processo ON documents(processo_id);
 CREATE INDEX idx_documents_tipo ON documents(tipo);
 CREATE INDEX idx_documents_status ON documents(status);
 CREATE INDEX idx_documents_data ON documents(data_referencia);
+CREATE INDEX idx_documents_texto_tsv ON documents USING GIN (texto_tsv);
 
 -- ============================================
 -- CHUNKS (pedacos do documento para RAG)
@@ -108,6 +113,8 @@ CREATE INDEX idx_documents_data ON documents(data_referencia);
 CREATE TABLE chunks (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
     documento_id UUID REFERENCES documents(id) ON DELETE CASCADE NOT NULL,
+    -- Copia de documents.processo_id: filtro direto na busca vetorial
+    processo_id UUID REFERENCES processos(id) ON DELETE CASCADE NOT NULL,
     conteudo TEXT NOT NULL,
     posicao INT NOT NULL,
     token_count INT,
@@ -117,8 +124,12 @@ CREATE TABLE chunks (
 );
 
 CREATE INDEX idx_chunks_documento ON chunks(documento_id);
-CREATE INDEX idx_chunks_embedding ON chunks
-    USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+CREATE INDEX idx_chunks_processo ON chunks(processo_id);
+-- Indice em meia precisao (halfvec): metade da memoria; a busca reordena os
+-- candidatos pela distancia exata em fp32.
+-- m=24/ef_construction=128: melhor recall; hnsw.ef_search e definido por consulta
+CREATE INDEX idx_chunks_embedding_halfvec ON chunks
+    USING hnsw ((embedding::halfvec(1536)) halfvec_cosine_ops) WITH (m = 24, ef_construction = 128);
 
 -- ============================================
 -- TRANSACOES FINANCEIRAS
@@ -143,11 +154,29 @@ CREATE TABLE transacoes (
     updated_at TIMESTAMP DEFAULT NOW()
 );
 
-CREATE INDEX idx_transacoes_processo ON transacoes(processo_id);
+-- Paginacao por cursor (keyset) em (data DESC NULLS LAST, id DESC)
+CREATE INDEX idx_transacoes_processo_data_id
+    ON transacoes (processo_id, data DESC NULLS LAST, id DESC);
+-- Ordem fisica por processo (reaplicar com CLUSTER transacoes;)
+ALTER TABLE transacoes CLUSTER ON idx_transacoes_processo_data_id;
+-- Fila de revisao (revisado_humano = false), mesma ordenacao
+CREATE INDEX idx_transacoes_unreviewed
+    ON transacoes (processo_id, data DESC NULLS LAST, id DESC)
+    WHERE revisado_humano = FALSE;
 CREATE INDEX idx_transacoes_pagador ON transacoes(pagador);
 CREATE INDEX idx_transacoes_categoria ON transacoes(categoria);
 CREATE INDEX idx_transacoes_data ON transacoes(data);
 
+-- Resumo pre-agregado por (processo, categoria, pagador); atualizado pela API
+-- com REFRESH MATERIALIZED VIEW CONCURRENTLY apos escritas em transacoes
+CREATE MATERIALIZED VIEW transacao_summary_mv AS
+    SELECT processo_id, categoria, pagador, SUM(valor) AS total, COUNT(*) AS cnt
+    FROM transacoes
+    GROUP BY processo_id, categoria, pagador;
+
+CREATE UNIQUE INDEX idx_transacao_summary_mv
+    ON transacao_summary_mv (processo_id, categoria, pagador) NULLS NOT DISTINCT;
+
 -- ============================================
 -- CONVERSAS (sempre associadas a um processo)
 -- ============================================
@@ -157,6 +186,7 @@ CREATE TABLE conversations (
     user_id UUID REFERENCES users(id) NOT NULL,
     canal VARCHAR(20) DEFAULT 'web',         -- 'web', 'telegram'
     titulo TEXT,
+    message_count INT NOT NULL DEFAULT 0,    -- mantido pelo trigger trg_messages_count
     created_at TIMESTAMP DEFAULT NOW(),
     updated_at TIMESTAMP DEFAULT NOW()
 );
@@ -182,6 +212,47 @@ CREATE TABLE messages (
 
 CREATE INDEX idx_messages_conversation ON messages(conversation_id);
 
+-- Contador denormalizado de mensagens por conversa
+CREATE OR REPLACE FUNCTION update_conversation_message_count() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE conversations SET message_count = message_count + 1 WHERE id = NEW.conversation_id;
+    ELSE
+        UPDATE conversations SET message_count = message_count - 1 WHERE id = OLD.conversation_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_messages_count
+    AFTER INSERT OR DELETE ON messages
+    FOR EACH ROW EXECUTE FUNCTION update_conversation_message_count();
+
+-- ============================================
+-- CACHE SEMANTICO DE RESPOSTAS (RAG)
+-- ============================================
+CREATE TABLE chat_cache (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    processo_id UUID REFERENCES processos(id) ON DELETE CASCADE NOT NULL,
+    query_norm TEXT NOT NULL,                -- pergunta normalizada (minusculas, espacos colapsados)
+    embedding VECTOR(1536) NOT NULL,
+    response JSONB NOT NULL,                 -- answer, sources, chunks_used
+    created_at TIMESTAMP DEFAULT NOW(),
+    UNIQUE(processo_id, query_norm)
+);
+
+CREATE INDEX idx_chat_cache_embedding ON chat_cache
+    USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+-- ============================================
+-- CACHE DE EMBEDDINGS POR CONTEUDO DE CHUNK
+-- ============================================
+CREATE TABLE chunk_embedding_cache (
+    content_hash VARCHAR(64) PRIMARY KEY,    -- sha256 de modelo + dimensoes + texto
+    embedding VECTOR(1536) NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
 -- ============================================
 -- EVENTOS / TIMELINE
 -- ============================================
@@ -213,9 +284,11 @@ CREATE TABLE reports (
     processo_id UUID REFERENCES processos(id) ON DELETE CASCADE NOT NULL,
     user_id UUID REFERENCES users(id) NOT NULL,
     tipo VARCHAR(50) NOT NULL,               -- 'transacoes', 'timeline', 'evidencias'
-    arquivo_s3 TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending', -- 'pending', 'ready', 'error'
+    arquivo_s3 TEXT,                         -- preenchido quando status = 'ready'
     arquivo_nome TEXT NOT NULL,
     parametros JSONB DEFAULT '{}',
+    error_message TEXT,
     created_at TIMESTAMP DEFAULT NOW()
 );
 
@@ -0,0 +1,18 @@
+-- Migration: Add semantic cache table for RAG answers
+-- Stores answers to first questions of a conversation keyed by processo + query embedding,
+-- so near-identical questions skip vector search and the LLM call.
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_chat_cache.sql
+
+CREATE TABLE IF NOT EXISTS chat_cache (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    processo_id UUID REFERENCES processos(id) ON DELETE CASCADE NOT NULL,
+    query_norm TEXT NOT NULL,
+    embedding VECTOR(1536) NOT NULL,
+    response JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW(),
+    UNIQUE(processo_id, query_norm)
+);
+
+CREATE INDEX IF NOT EXISTS idx_chat_cache_embedding ON chat_cache
+    USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
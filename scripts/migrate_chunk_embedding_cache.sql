@@ -0,0 +1,11 @@
+-- Migration: Cache chunk embeddings by content hash
+-- Chunks whose text was already embedded (re-uploads, boilerplate, forwarded
+-- messages) reuse the stored vector instead of calling the embeddings API again.
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_chunk_embedding_cache.sql
+
+CREATE TABLE IF NOT EXISTS chunk_embedding_cache (
+    content_hash VARCHAR(64) PRIMARY KEY,
+    embedding VECTOR(1536) NOT NULL,
+    created_at TIMESTAMP DEFAULT NOW()
+);
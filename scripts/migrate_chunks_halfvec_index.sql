@@ -0,0 +1,24 @@
+-- Migration: Half-precision HNSW index for chunk search
+-- The index stores embedding::halfvec(1536) (2 bytes per dimension instead of 4),
+-- halving index size and memory traffic per distance computation. No column is
+-- added: search_similar_chunks orders by the same expression to use the index,
+-- then reranks the candidates by exact fp32 distance on chunks.embedding.
+-- Requires pgvector >= 0.8 (halfvec needs 0.7; chunk search also sets
+-- hnsw.iterative_scan, added in 0.8). Built CONCURRENTLY before the fp32 index is dropped,
+-- so searches keep using an index during the build (do not wrap this script in
+-- a transaction).
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_chunks_halfvec_index.sql
+
+-- Faster build (session settings only)
+SET max_parallel_maintenance_workers = 7;
+SET maintenance_work_mem = '2GB';
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_chunks_embedding_halfvec ON chunks
+    USING hnsw ((embedding::halfvec(1536)) halfvec_cosine_ops) WITH (m = 24, ef_construction = 128);
+
+-- The fp32 index is no longer used by searches
+DROP INDEX CONCURRENTLY IF EXISTS idx_chunks_embedding;
+
+-- Verify the index was created
+SELECT indexname, indexdef FROM pg_indexes WHERE tablename = 'chunks' AND indexname = 'idx_chunks_embedding_halfvec';
@@ -0,0 +1,27 @@
+-- Migration: Denormalize processo_id into chunks
+-- Chunk search is almost always scoped to one processo. With processo_id on the
+-- chunk itself (instead of only through documents), the planner can estimate the
+-- processo's share of the table and pick, per query, between the global HNSW
+-- index (large processos) and idx_chunks_processo plus an exact sort (small
+-- ones), which avoids walking the whole graph to find a handful of tenant rows.
+-- Documents never change processo, so the copy cannot go stale.
+-- Requires pgvector >= 0.8: filtered searches rely on hnsw.iterative_scan
+-- (docker-compose pins pgvector/pgvector:0.8.0-pg16; after upgrading the
+-- image, the extension itself is updated below).
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_chunks_processo.sql
+
+ALTER EXTENSION vector UPDATE;
+
+ALTER TABLE chunks ADD COLUMN IF NOT EXISTS processo_id UUID REFERENCES processos(id) ON DELETE CASCADE;
+
+UPDATE chunks c
+SET processo_id = d.processo_id
+FROM documents d
+WHERE c.documento_id = d.id AND c.processo_id IS NULL;
+
+ALTER TABLE chunks ALTER COLUMN processo_id SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_chunks_processo ON chunks(processo_id);
+
+ANALYZE chunks;
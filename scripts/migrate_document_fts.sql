@@ -0,0 +1,10 @@
+-- Migration: Full-text search on extracted document text
+-- Adds a stored tsvector generated from texto_extraido and a GIN index on it,
+-- so document search probes an index instead of scanning every text with ILIKE.
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_document_fts.sql
+
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS texto_tsv TSVECTOR
+    GENERATED ALWAYS AS (to_tsvector('portuguese'::regconfig, COALESCE(texto_extraido, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_documents_texto_tsv ON documents USING GIN (texto_tsv);
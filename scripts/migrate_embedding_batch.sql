@@ -0,0 +1,7 @@
+-- Migration: Track OpenAI Batch API embedding jobs per document
+-- Large documents store their chunks first and get embeddings from a batch job;
+-- embedding_batch_id is set while that job is pending (resumed on API startup).
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_embedding_batch.sql
+
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS embedding_batch_id TEXT;
@@ -0,0 +1,33 @@
+-- Migration: Denormalized message counter on conversations
+-- Adds conversations.message_count, backfills it and keeps it up to date with a trigger
+-- on messages, so conversation listings read a column instead of counting messages.
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_message_count.sql
+
+BEGIN;
+
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS message_count INT NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION update_conversation_message_count() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE conversations SET message_count = message_count + 1 WHERE id = NEW.conversation_id;
+    ELSE
+        UPDATE conversations SET message_count = message_count - 1 WHERE id = OLD.conversation_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_messages_count ON messages;
+CREATE TRIGGER trg_messages_count
+    AFTER INSERT OR DELETE ON messages
+    FOR EACH ROW EXECUTE FUNCTION update_conversation_message_count();
+
+-- Backfill existing conversations
+UPDATE conversations c
+SET message_count = m.total
+FROM (SELECT conversation_id, COUNT(*) AS total FROM messages GROUP BY conversation_id) m
+WHERE m.conversation_id = c.id;
+
+COMMIT;
@@ -0,0 +1,11 @@
+-- Migration: Background report generation
+-- Reports are now created in 'pending' state and filled in by a background job,
+-- so arquivo_s3 is only known once generation finishes.
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_report_status.sql
+
+-- Existing reports were generated synchronously and are ready
+ALTER TABLE reports ADD COLUMN IF NOT EXISTS status VARCHAR(20) NOT NULL DEFAULT 'ready';
+ALTER TABLE reports ALTER COLUMN status SET DEFAULT 'pending';
+ALTER TABLE reports ADD COLUMN IF NOT EXISTS error_message TEXT;
+ALTER TABLE reports ALTER COLUMN arquivo_s3 DROP NOT NULL;
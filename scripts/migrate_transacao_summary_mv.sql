@@ -0,0 +1,14 @@
+-- Migration: Pre-aggregated transacao rollups for the summary endpoint
+-- transacao_summary_mv holds sum/count per (processo, categoria, pagador); the API
+-- refreshes it concurrently in the background after transacao writes.
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_transacao_summary_mv.sql
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS transacao_summary_mv AS
+    SELECT processo_id, categoria, pagador, SUM(valor) AS total, COUNT(*) AS cnt
+    FROM transacoes
+    GROUP BY processo_id, categoria, pagador;
+
+-- Required by REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS idx_transacao_summary_mv
+    ON transacao_summary_mv (processo_id, categoria, pagador) NULLS NOT DISTINCT;
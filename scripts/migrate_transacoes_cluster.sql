@@ -0,0 +1,14 @@
+-- Migration: Store transacoes physically ordered by processo
+-- Every transacao query filters by processo_id; clustering the table on
+-- idx_transacoes_processo_data_id keeps each processo's rows on adjacent pages,
+-- so list/summary reads touch few heap pages. CLUSTER takes an exclusive lock
+-- and rewrites the table: run it in a maintenance window. It can be re-run later
+-- with just "CLUSTER transacoes;" as rows accumulate out of order.
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_transacoes_cluster.sql
+
+ALTER TABLE transacoes CLUSTER ON idx_transacoes_processo_data_id;
+
+CLUSTER transacoes;
+
+ANALYZE transacoes;
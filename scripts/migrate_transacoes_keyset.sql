@@ -0,0 +1,11 @@
+-- Migration: Composite index for keyset pagination of transacoes
+-- Listing orders by (data DESC NULLS LAST, id DESC) within a processo; this index
+-- serves both the first page and every cursor page with a single index seek.
+-- It also covers lookups by processo_id alone, so idx_transacoes_processo is dropped.
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_transacoes_keyset.sql
+
+CREATE INDEX IF NOT EXISTS idx_transacoes_processo_data_id
+    ON transacoes (processo_id, data DESC NULLS LAST, id DESC);
+
+DROP INDEX IF EXISTS idx_transacoes_processo;
@@ -0,0 +1,12 @@
+-- Migration: Partial index for the unreviewed transacoes listing
+-- revisado=false is the common filter on GET /transacoes (review queue); this index
+-- holds only unreviewed rows in the same (data DESC NULLS LAST, id DESC) order as
+-- idx_transacoes_processo_data_id, so that listing is an index range scan + LIMIT.
+-- Built CONCURRENTLY so writes to transacoes are not blocked during the deploy
+-- (do not wrap this script in a transaction).
+--
+-- Run with: docker exec -i apoioprocessual-db psql -U legal -d legal_assistant < scripts/migrate_transacoes_unreviewed_index.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_transacoes_unreviewed
+    ON transacoes (processo_id, data DESC NULLS LAST, id DESC)
+    WHERE revisado_humano = FALSE;